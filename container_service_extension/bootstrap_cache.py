@@ -0,0 +1,109 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import time
+
+from cachetools import LRUCache
+
+# maximum number of clusters whose bootstrap info is kept
+BOOTSTRAP_CACHE_SIZE = 1024
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class BootstrapCache(object):
+    """Master IP and join token of clusters, by cluster vApp href.
+
+    A join token is only returned while it has at least a tenth of its
+    lifetime, and at most a minute, left, so that a node doesn't get a
+    token that expires while it joins.
+    """
+
+    def __init__(self, maxsize=BOOTSTRAP_CACHE_SIZE):
+        """Constructor for BootstrapCache.
+
+        :param int maxsize: maximum number of clusters kept. The least
+            recently used ones are dropped first.
+        """
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get_master_ip(self, vapp_href):
+        """Get the IP address of the master node of a cluster.
+
+        :param str vapp_href: href of the cluster vApp.
+
+        :return: the IP address, or None if it is not cached.
+
+        :rtype: str
+        """
+        with self._lock:
+            return self._cache.get(vapp_href, {}).get('master_ip')
+
+    def put_master_ip(self, vapp_href, master_ip):
+        with self._lock:
+            self._entry(vapp_href)['master_ip'] = master_ip
+
+    def get_join_token(self, vapp_href):
+        """Get a join token of a cluster that is still valid.
+
+        :param str vapp_href: href of the cluster vApp.
+
+        :return: the token, or None if no valid token is cached.
+
+        :rtype: str
+        """
+        with self._lock:
+            entry = self._cache.get(vapp_href, {})
+            if entry.get('token_usable_until', 0) > time.time():
+                return entry['token']
+        return None
+
+    def put_join_token(self, vapp_href, token, ttl):
+        """Cache a join token of a cluster.
+
+        :param str vapp_href: href of the cluster vApp.
+        :param str token: the token.
+        :param int ttl: number of seconds the token is valid for, from now.
+        """
+        margin = min(60, ttl / 10)
+        with self._lock:
+            entry = self._entry(vapp_href)
+            entry['token'] = token
+            entry['token_usable_until'] = time.time() + ttl - margin
+
+    def invalidate_join_token(self, vapp_href):
+        with self._lock:
+            entry = self._cache.get(vapp_href)
+            if entry is not None:
+                entry.pop('token', None)
+                entry.pop('token_usable_until', None)
+
+    def remove(self, vapp_href):
+        """Remove all the bootstrap info of a cluster.
+
+        :param str vapp_href: href of the cluster vApp.
+        """
+        with self._lock:
+            self._cache.pop(vapp_href, None)
+
+    def _entry(self, vapp_href):
+        entry = self._cache.get(vapp_href)
+        if entry is None:
+            entry = self._cache[vapp_href] = {}
+        return entry
+
+
+def get_bootstrap_cache():
+    """Get the process-wide bootstrap info cache.
+
+    :rtype: BootstrapCache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = BootstrapCache()
+        return _cache
@@ -1,25 +1,27 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
+import base64
+import binascii
 import functools
+import itertools
 import re
-import threading
+import time
 import traceback
 import uuid
 
 import click
 import pkg_resources
-import requests
-from pyvcloud.vcd.client import BasicLoginCredentials
-from pyvcloud.vcd.client import Client
 from pyvcloud.vcd.client import TaskStatus
-from pyvcloud.vcd.client import VCLOUD_STATUS_MAP
-from pyvcloud.vcd.client import _WellKnownEndpoint
+from pyvcloud.vcd.exceptions import UnauthorizedException
 from pyvcloud.vcd.org import Org
 from pyvcloud.vcd.task import Task
 from pyvcloud.vcd.vapp import VApp
 from pyvcloud.vcd.vdc import VDC
 from pyvcloud.vcd.vm import VM
 
+from container_service_extension.bootstrap_cache import get_bootstrap_cache
+from container_service_extension.client_pool import call_as_sysadmin
+from container_service_extension.client_pool import get_tenant_client
 from container_service_extension.cluster import TYPE_MASTER
 from container_service_extension.cluster import TYPE_NFS
 from container_service_extension.cluster import TYPE_NODE
@@ -28,9 +30,15 @@ from container_service_extension.cluster import delete_nodes_from_cluster
 from container_service_extension.cluster import execute_script_in_nodes
 from container_service_extension.cluster import get_cluster_config
 from container_service_extension.cluster import get_master_ip
+from container_service_extension.cluster import get_vm_info
 from container_service_extension.cluster import init_cluster
+from container_service_extension.cluster import iter_clusters
 from container_service_extension.cluster import join_cluster
 from container_service_extension.cluster import load_from_metadata
+from container_service_extension.cluster import set_cluster_metadata
+from container_service_extension.cluster_index import find_clusters
+from container_service_extension.cluster_index import get_cluster_index
+from container_service_extension.exceptions import BadRequestError
 from container_service_extension.exceptions import ClusterAlreadyExistsError
 from container_service_extension.exceptions import ClusterInitializationError
 from container_service_extension.exceptions import ClusterJoiningError
@@ -39,17 +47,28 @@ from container_service_extension.exceptions import CseServerError
 from container_service_extension.exceptions import MasterNodeCreationError
 from container_service_extension.exceptions import NFSNodeCreationError
 from container_service_extension.exceptions import NodeCreationError
+from container_service_extension.exceptions import ServiceBusyError
 from container_service_extension.exceptions import WorkerNodeCreationError
+from container_service_extension.kubeconfig_cache import \
+    get_kubeconfig_cache
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import BROKER_PHASE_DURATION
+from container_service_extension.scheduler import get_scheduler
+from container_service_extension.task_tracker import get_task_tracker
+from container_service_extension.task_tracker import wait_for_task
+from container_service_extension.tracing import start_span
 from container_service_extension.utils import ERROR_DESCRIPTION
 from container_service_extension.utils import ERROR_MESSAGE
-from container_service_extension.utils import SYSTEM_ORG_NAME
 from container_service_extension.utils import error_to_json
+from container_service_extension.utils import SYSTEM_ORG_NAME
 
 OK = 200
 CREATED = 201
 ACCEPTED = 202
+BAD_REQUEST = 400
+UNAUTHORIZED = 401
 INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 
 OP_CREATE_CLUSTER = 'create_cluster'
 OP_DELETE_CLUSTER = 'delete_cluster'
@@ -64,6 +83,9 @@ OP_MESSAGE = {
 }
 
 MAX_HOST_NAME_LENGTH = 25
+DEFAULT_PAGE_SIZE = 25
+# vCD serves at most 128 records per query page by default
+MAX_PAGE_SIZE = 128
 ROLLBACK_FLAG = 'disable_rollback'
 
 
@@ -74,6 +96,17 @@ def get_new_broker(config):
         return None
 
 
+def encode_cursor(offset):
+    return base64.urlsafe_b64encode(str(offset).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError('invalid cursor: %s' % cursor)
+
+
 def spinning_cursor():
     while True:
         for cursor in '|/-\\':
@@ -132,6 +165,18 @@ def exception_handler(func):
         result = {}
         try:
             result = func(*args, **kwargs)
+        except UnauthorizedException as err:
+            result['status_code'] = UNAUTHORIZED
+            result['body'] = error_to_json(err)
+            LOGGER.error(traceback.format_exc())
+        except BadRequestError as err:
+            result['status_code'] = BAD_REQUEST
+            result['body'] = error_to_json(err)
+            LOGGER.warning(str(err))
+        except ServiceBusyError as err:
+            result['status_code'] = SERVICE_UNAVAILABLE
+            result['body'] = error_to_json(err)
+            LOGGER.warning(str(err))
         except Exception as err:
             result['status_code'] = INTERNAL_SERVER_ERROR
             result['body'] = error_to_json(err)
@@ -153,57 +198,43 @@ def task_callback(task):
     click.secho(message)
 
 
-class DefaultBroker(threading.Thread):
+class DefaultBroker(object):
     def __init__(self, config):
-        threading.Thread.__init__(self)
         self.config = config
         self.host = config['vcd']['host']
-        self.username = config['vcd']['username']
-        self.password = config['vcd']['password']
-        self.version = config['vcd']['api_version']
         self.verify = config['vcd']['verify']
         self.log = config['vcd']['log']
-
-    def _connect_sysadmin(self):
-        if not self.verify:
-            LOGGER.warning('InsecureRequestWarning: '
-                           'Unverified HTTPS request is being made. '
-                           'Adding certificate verification is strongly '
-                           'advised.')
-            requests.packages.urllib3.disable_warnings()
-        self.client_sysadmin = Client(
-            uri=self.host,
-            api_version=self.version,
-            verify_ssl_certs=self.verify,
-            log_headers=True,
-            log_bodies=True)
-        credentials = BasicLoginCredentials(self.username,
-                                            SYSTEM_ORG_NAME,
-                                            self.password)
-        self.client_sysadmin.set_credentials(credentials)
+        self.phase = None
+        self.span = None
 
     def _connect_tenant(self, headers):
-        token = headers.get('x-vcloud-authorization')
-        accept_header = headers.get('Accept')
-        version = accept_header.split('version=')[1]
-        self.client_tenant = Client(
-            uri=self.host,
-            api_version=version,
-            verify_ssl_certs=self.verify,
-            log_headers=True,
-            log_bodies=True)
-        session = self.client_tenant.rehydrate_from_token(token)
-        return {
-            'user_name':
-            session.get('user'),
-            'user_id':
-            session.get('userId'),
-            'org_name':
-            session.get('org'),
-            'org_href':
-            self.client_tenant._get_wk_endpoint(
-                _WellKnownEndpoint.LOGGED_IN_ORG)
-        }
+        self.client_tenant, session_info = get_tenant_client(self.config,
+                                                             headers)
+        self.tenant_info = session_info
+        return session_info
+
+    def _get_org_id(self):
+        if self.tenant_info['org_name'] == SYSTEM_ORG_NAME:
+            # the system administrator sees the clusters of every org
+            return None
+        return self.tenant_info['org_href'].split('/')[-1]
+
+    def _find_clusters(self, name):
+        return find_clusters(self.client_tenant, self._get_org_id(), name)
+
+    def _index_cluster(self):
+        org_id = self._get_org_id()
+        if org_id is None:
+            return
+        clusters = load_from_metadata(self.client_tenant,
+                                      cluster_id=self.cluster_id)
+        if len(clusters) == 1:
+            get_cluster_index().put(org_id, clusters[0])
+
+    def _unindex_cluster(self):
+        # by vApp href, as the system administrator can change the clusters
+        # of any org
+        get_cluster_index().remove(self.cluster['vapp_href'])
 
     def _to_message(self, e):
         if hasattr(e, 'message'):
@@ -212,15 +243,25 @@ class DefaultBroker(threading.Thread):
             return {'message': str(e)}
 
     def update_task(self, status, message=None, error_message=None):
-        if not hasattr(self, 'task'):
-            self.task = Task(self.client_sysadmin)
         if message is None:
             message = OP_MESSAGE[self.op]
+        if status == TaskStatus.ERROR:
+            for span in (self.span, self.phase and self.phase[2]):
+                if span is not None:
+                    span.set_error(error_message)
         if hasattr(self, 'task_resource'):
             task_href = self.task_resource.get('href')
         else:
             task_href = None
-        self.task_resource = self.task.update(
+        self.task_resource = call_as_sysadmin(
+            self.config,
+            lambda client: self._update_task(client, status, message,
+                                             task_href, error_message))
+
+    def _update_task(self, client, status, message, task_href,
+                     error_message):
+        task = Task(client)
+        return task.update(
             status.value,
             'vcloud.cse',
             message,
@@ -258,23 +299,128 @@ class DefaultBroker(threading.Thread):
 
     def run(self):
         LOGGER.debug('thread started op=%s' % self.op)
-        if self.op == OP_CREATE_CLUSTER:
-            self.create_cluster_thread()
-        elif self.op == OP_DELETE_CLUSTER:
-            self.delete_cluster_thread()
-        elif self.op == OP_CREATE_NODES:
-            self.create_nodes_thread()
-        elif self.op == OP_DELETE_NODES:
-            self.delete_nodes_thread()
+        BROKER_PHASE_DURATION.observe(time.time() - self.submitted_at,
+                                      operation=self.op, phase='queued')
+        self.span = start_span(self.op, attributes={
+            'cse.cluster.id': self.cluster_id,
+            'cse.cluster.name': self.cluster_name,
+            'cse.org.name': self.tenant_info['org_name'],
+            'cse.queued_ms': round((time.time() - self.submitted_at) * 1000)
+        })
+        try:
+            if self.op == OP_CREATE_CLUSTER:
+                self.create_cluster_thread()
+            elif self.op == OP_DELETE_CLUSTER:
+                self.delete_cluster_thread()
+            elif self.op == OP_CREATE_NODES:
+                self.create_nodes_thread()
+                # the node count changed, the next lookup refreshes the entry
+                self._unindex_cluster()
+            elif self.op == OP_DELETE_NODES:
+                self.delete_nodes_thread()
+                self._unindex_cluster()
+        finally:
+            self._end_phase()
+            self.span.end()
+
+    def _capture_kubeconfig(self, vapp, template):
+        """Cache the kubeconfig of a newly initialized cluster.
+
+        A failure is only logged: the kubeconfig is downloaded again when
+        it is requested.
+        """
+        try:
+            kubeconfig = get_cluster_config(self.config, vapp,
+                                            template['admin_password'])
+            get_kubeconfig_cache(self.config).put(self.cluster_id, kubeconfig)
+        except Exception:
+            LOGGER.warning('couldn\'t capture the kubeconfig of cluster %s'
+                           % self.cluster_id, exc_info=True)
+
+    def _enter_phase(self, phase):
+        """Mark the start of a phase of the operation, ending the previous one.
+
+        :param str phase: name of the phase, used as a metric label.
+        """
+        self._end_phase()
+        self.phase = (phase, time.time(), start_span(phase))
+
+    def _end_phase(self):
+        if self.phase is not None:
+            phase, started_at, span = self.phase
+            span.end()
+            BROKER_PHASE_DURATION.observe(time.time() - started_at,
+                                          operation=self.op, phase=phase)
+            self.phase = None
+
+    def _schedule(self):
+        """Schedule the operation to run on a broker worker.
+
+        :return: 'running' or 'queued'.
+
+        :rtype: str
+
+        :raises ServiceBusyError: if CSE can't accept more operations, in
+            which case the operation's task is marked as failed.
+        """
+        self.submitted_at = time.time()
+        try:
+            return get_scheduler(self.config).submit(
+                self.op, self.run, org=self.tenant_info['org_name'])
+        except ServiceBusyError as e:
+            self.update_task(TaskStatus.ERROR, error_message=str(e))
+            raise
 
     @exception_handler
-    def list_clusters(self, headers, body):
+    def list_clusters(self, headers, body, params=None):
+        """List the clusters visible to the tenant.
+
+        Without paging parameters the whole list is returned, as before.
+        With 'page', 'pageSize' or 'cursor' one page is returned, along with
+        the cursor of the next page, which is None on the last page.
+
+        :param dict headers: request headers.
+        :param dict body: request body.
+        :param dict params: query string parameters of the request.
+
+        :return: (dict): list of clusters, or a page of it.
+        """
         result = {}
         result['body'] = []
         result['status_code'] = OK
         self._connect_tenant(headers)
-        clusters = load_from_metadata(self.client_tenant)
-        result['body'] = clusters
+        params = params or {}
+        if not any(p in params for p in ('page', 'pageSize', 'cursor')):
+            result['body'] = load_from_metadata(self.client_tenant)
+            return result
+
+        try:
+            page_size = int(params.get('pageSize', DEFAULT_PAGE_SIZE))
+            if page_size < 1:
+                raise ValueError('invalid page size: %s' % page_size)
+            page_size = min(page_size, MAX_PAGE_SIZE)
+            if 'cursor' in params:
+                offset = decode_cursor(params['cursor'])
+            else:
+                offset = (int(params.get('page', 1)) - 1) * page_size
+        except ValueError:
+            raise BadRequestError('Invalid paging parameters.')
+        if offset < 0:
+            raise BadRequestError('Invalid paging parameters.')
+
+        clusters = list(itertools.islice(
+            iter_clusters(self.client_tenant, page_size=page_size,
+                          offset=offset),
+            page_size))
+        next_cursor = None
+        if len(clusters) == page_size:
+            next_cursor = encode_cursor(offset + page_size)
+        result['body'] = {
+            'clusters': clusters,
+            'page': offset // page_size + 1,
+            'pageSize': page_size,
+            'nextCursor': next_cursor
+        }
         return result
 
     @exception_handler
@@ -291,22 +437,12 @@ class DefaultBroker(threading.Thread):
         result['body'] = []
         result['status_code'] = OK
         self._connect_tenant(headers)
-        clusters = load_from_metadata(self.client_tenant, name=name)
+        clusters = self._find_clusters(name)
         if len(clusters) == 0:
             raise CseServerError('Cluster \'%s\' not found.' % name)
         vapp = VApp(self.client_tenant, href=clusters[0]['vapp_href'])
-        vms = vapp.get_all_vms()
-        for vm in vms:
-            node_info = {
-                'name': vm.get('name'),
-                'ipAddress': ''
-            }
-            try:
-                node_info['ipAddress'] = vapp.get_primary_ip(
-                    vm.get('name'))
-            except Exception:
-                LOGGER.debug(
-                    'cannot get ip address for node %s' % vm.get('name'))
+        for vm in vapp.get_all_vms():
+            node_info = get_vm_info(vm)
             if vm.get('name').startswith(TYPE_MASTER):
                 clusters[0].get('master_nodes').append(node_info)
             elif vm.get('name').startswith(TYPE_NODE):
@@ -331,8 +467,7 @@ class DefaultBroker(threading.Thread):
         result['body'] = []
         result['status_code'] = OK
         self._connect_tenant(headers)
-        clusters = load_from_metadata(self.client_tenant,
-                                      name=cluster_name)
+        clusters = self._find_clusters(cluster_name)
         if len(clusters) == 0:
             raise CseServerError('Cluster \'%s\' not found.' % cluster_name)
         vapp = VApp(self.client_tenant, href=clusters[0]['vapp_href'])
@@ -340,25 +475,7 @@ class DefaultBroker(threading.Thread):
         node_info = None
         for vm in vms:
             if (node_name == vm.get('name')):
-                node_info = {
-                    'name': vm.get('name'),
-                    'numberOfCpus': '',
-                    'memoryMB': '',
-                    'status': VCLOUD_STATUS_MAP.get(int(vm.get('status'))),
-                    'ipAddress': ''
-                }
-                if hasattr(vm, 'VmSpecSection'):
-                    node_info[
-                        'numberOfCpus'] = vm.VmSpecSection.NumCpus.text
-                    node_info[
-                        'memoryMB'] = \
-                        vm.VmSpecSection.MemoryResourceMb.Configured.text
-                try:
-                    node_info['ipAddress'] = vapp.get_primary_ip(
-                        vm.get('name'))
-                except Exception:
-                    LOGGER.debug('cannot get ip address '
-                                 'for node %s' % vm.get('name'))
+                node_info = get_vm_info(vm)
                 if vm.get('name').startswith(TYPE_MASTER):
                     node_info['node_type'] = 'master'
                 elif vm.get('name').startswith(TYPE_NODE):
@@ -423,17 +540,16 @@ class DefaultBroker(threading.Thread):
         self.cluster_name = cluster_name
         self.cluster_id = str(uuid.uuid4())
         self.op = OP_CREATE_CLUSTER
-        self._connect_sysadmin()
         self.update_task(
             TaskStatus.RUNNING,
             message='Creating cluster %s(%s)' % (cluster_name,
                                                  self.cluster_id))
-        self.daemon = True
-        self.start()
+        state = self._schedule()
         response_body = {}
         response_body['name'] = self.cluster_name
         response_body['cluster_id'] = self.cluster_id
         response_body['task_href'] = self.task_resource.get('href')
+        response_body['state'] = state
         result['body'] = response_body
         result['status_code'] = ACCEPTED
         return result
@@ -442,6 +558,7 @@ class DefaultBroker(threading.Thread):
     def create_cluster_thread(self):
         network_name = self.body['network']
         try:
+            self._enter_phase('check_name')
             clusters = load_from_metadata(
                 self.client_tenant, name=self.cluster_name)
             if len(clusters) != 0:
@@ -451,6 +568,7 @@ class DefaultBroker(threading.Thread):
             vdc_resource = org.get_vdc(self.body['vdc'])
             vdc = VDC(self.client_tenant, resource=vdc_resource)
             template = self.get_template()
+            self._enter_phase('create_vapp')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Creating cluster vApp %s(%s)' % (self.cluster_name,
@@ -464,17 +582,16 @@ class DefaultBroker(threading.Thread):
             except Exception as e:
                 raise ClusterOperationError('Error while creating vApp:', str(e))
 
-            self.client_tenant.get_task_monitor().wait_for_status(
-                vapp_resource.Tasks.Task[0])
+            wait_for_task(self.client_tenant, vapp_resource.Tasks.Task[0])
+            self._enter_phase('set_metadata')
             tags = {}
             tags['cse.cluster.id'] = self.cluster_id
             tags['cse.version'] = pkg_resources.require(
                 'container-service-extension')[0].version
             tags['cse.template'] = template['name']
             vapp = VApp(self.client_tenant, href=vapp_resource.get('href'))
-            for k, v in tags.items():
-                task = vapp.set_metadata('GENERAL', 'READWRITE', k, v)
-                self.client_tenant.get_task_monitor().wait_for_status(task)
+            set_cluster_metadata(self.client_tenant, vapp, tags)
+            self._enter_phase('create_master')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Creating master node for %s(%s)' % (self.cluster_name,
@@ -487,17 +604,20 @@ class DefaultBroker(threading.Thread):
             except Exception as e:
                 raise MasterNodeCreationError("Error while adding master node:", str(e))
 
+            self._enter_phase('init_cluster')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Initializing cluster %s(%s)' % (self.cluster_name,
                                                          self.cluster_id))
             vapp.reload()
             init_cluster(self.config, vapp, template)
+            self._capture_kubeconfig(vapp, template)
+            self._enter_phase('get_master_ip')
             master_ip = get_master_ip(self.config, vapp, template)
-            task = vapp.set_metadata('GENERAL', 'READWRITE', 'cse.master.ip',
-                                     master_ip)
-            self.client_tenant.get_task_monitor().wait_for_status(task)
+            set_cluster_metadata(self.client_tenant, vapp,
+                                 {'cse.master.ip': master_ip})
             if self.body['node_count'] > 0:
+                self._enter_phase('create_workers')
                 self.update_task(
                     TaskStatus.RUNNING,
                     message='Creating %s node(s) for %s(%s)' %
@@ -510,6 +630,7 @@ class DefaultBroker(threading.Thread):
                 except Exception as e:
                     raise WorkerNodeCreationError("Error while creating worker node:", str(e))
 
+                self._enter_phase('join_cluster')
                 self.update_task(
                     TaskStatus.RUNNING,
                     message='Adding %s node(s) to %s(%s)' %
@@ -518,6 +639,7 @@ class DefaultBroker(threading.Thread):
                 vapp.reload()
                 join_cluster(self.config, vapp, template)
             if self.body['enable_nfs']:
+                self._enter_phase('create_nfs')
                 self.update_task(
                     TaskStatus.RUNNING,
                     message='Creating NFS node for %s(%s)' %
@@ -534,6 +656,7 @@ class DefaultBroker(threading.Thread):
                 TaskStatus.SUCCESS,
                 message='Created cluster %s(%s)' % (self.cluster_name,
                                                     self.cluster_id))
+            self._index_cluster()
         except (MasterNodeCreationError, WorkerNodeCreationError,
                 NFSNodeCreationError, ClusterJoiningError,
                 ClusterInitializationError, ClusterOperationError) as e:
@@ -558,9 +681,7 @@ class DefaultBroker(threading.Thread):
         self.headers = headers
         self.body = body
         self.op = OP_DELETE_CLUSTER
-        self._connect_sysadmin()
-        clusters = load_from_metadata(
-            self.client_tenant, name=self.cluster_name)
+        clusters = self._find_clusters(self.cluster_name)
         if len(clusters) != 1:
             raise CseServerError('Cluster %s not found.' % self.cluster_name)
         self.cluster = clusters[0]
@@ -569,11 +690,11 @@ class DefaultBroker(threading.Thread):
             TaskStatus.RUNNING,
             message='Deleting cluster %s(%s)' % (self.cluster_name,
                                                  self.cluster_id))
-        self.daemon = True
-        self.start()
+        state = self._schedule()
         response_body = {}
         response_body['cluster_name'] = self.cluster_name
         response_body['task_href'] = self.task_resource.get('href')
+        response_body['state'] = state
         result['body'] = response_body
         result['status_code'] = ACCEPTED
         return result
@@ -583,8 +704,12 @@ class DefaultBroker(threading.Thread):
                      self.cluster_name)
         try:
             vdc = VDC(self.client_tenant, href=self.cluster['vdc_href'])
+            self._enter_phase('delete_vapp')
             task = vdc.delete_vapp(self.cluster['name'], force=True)
-            self.client_tenant.get_task_monitor().wait_for_status(task)
+            wait_for_task(self.client_tenant, task)
+            self._unindex_cluster()
+            get_kubeconfig_cache(self.config).remove(self.cluster_id)
+            get_bootstrap_cache().remove(self.cluster['vapp_href'])
             self.update_task(
                 TaskStatus.SUCCESS,
                 message='Deleted cluster %s(%s)' % (self.cluster_name,
@@ -594,17 +719,39 @@ class DefaultBroker(threading.Thread):
             self.update_task(TaskStatus.ERROR, error_message=str(e))
 
     @exception_handler
-    def get_cluster_config(self, cluster_name, headers):
+    def get_cluster_config(self, cluster_name, headers, params=None):
+        """Get the kubeconfig of a cluster.
+
+        The kubeconfig is served from the kubeconfig cache, and only
+        downloaded from the master node if it is not cached, or if the
+        'refresh' query parameter is 'true'. The cluster vApp is read with
+        the tenant's session first, so that a cached kubeconfig is only
+        served to a tenant who can still access the cluster.
+        """
         result = {}
         self._connect_tenant(headers)
-        clusters = load_from_metadata(
-            self.client_tenant, name=cluster_name)
+        clusters = self._find_clusters(cluster_name)
         if len(clusters) != 1:
             raise CseServerError('Cluster \'%s\' not found' % cluster_name)
-        vapp = VApp(self.client_tenant, href=clusters[0]['vapp_href'])
-        template = self.get_template(name=clusters[0]['template'])
-        result['body'] = get_cluster_config(self.config, vapp,
+        vapp_resource = self.client_tenant.get_resource(
+            clusters[0]['vapp_href'])
+        cluster_id = clusters[0]['cluster_id']
+        refresh = (params or {}).get('refresh', '').lower() == 'true'
+        cache = get_kubeconfig_cache(self.config)
+        cached = None
+        if cluster_id and not refresh:
+            cached = cache.get(cluster_id)
+        if cached is None:
+            vapp = VApp(self.client_tenant, resource=vapp_resource)
+            template = self.get_template(name=clusters[0]['template'])
+            kubeconfig = get_cluster_config(self.config, vapp,
                                             template['admin_password'])
+            if cluster_id:
+                cached = (kubeconfig, cache.put(cluster_id, kubeconfig))
+        if cached is not None:
+            kubeconfig, version = cached
+            result['headers'] = {'ETag': '"%s"' % version}
+        result['body'] = kubeconfig
         result['status_code'] = OK
         return result
 
@@ -618,8 +765,7 @@ class DefaultBroker(threading.Thread):
         if body['node_count'] < 1:
             raise CseServerError('Invalid node count: %s.' % body['node_count'])
         self.tenant_info = self._connect_tenant(headers)
-        clusters = load_from_metadata(
-            self.client_tenant, name=self.cluster_name)
+        clusters = self._find_clusters(self.cluster_name)
         if len(clusters) != 1:
             raise CseServerError(
                 'Cluster \'%s\' not found.' % self.cluster_name)
@@ -627,17 +773,16 @@ class DefaultBroker(threading.Thread):
         self.headers = headers
         self.body = body
         self.op = OP_CREATE_NODES
-        self._connect_sysadmin()
         self.cluster_id = self.cluster['cluster_id']
         self.update_task(
             TaskStatus.RUNNING,
             message='Adding %s node(s) to cluster %s(%s)' %
                     (body['node_count'], self.cluster_name, self.cluster_id))
-        self.daemon = True
-        self.start()
+        state = self._schedule()
         response_body = {}
         response_body['cluster_name'] = self.cluster_name
         response_body['task_href'] = self.task_resource.get('href')
+        response_body['state'] = state
         result['body'] = response_body
         result['status_code'] = ACCEPTED
         return result
@@ -653,6 +798,7 @@ class DefaultBroker(threading.Thread):
             vdc = VDC(self.client_tenant, href=self.cluster['vdc_href'])
             vapp = VApp(self.client_tenant, href=self.cluster['vapp_href'])
             template = self.get_template()
+            self._enter_phase('create_nodes')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Creating %s node(s) for %s(%s)' %
@@ -671,6 +817,7 @@ class DefaultBroker(threading.Thread):
                              self.cluster_name,
                              self.cluster_id))
             elif self.body['node_type'] == TYPE_NODE:
+                self._enter_phase('join_cluster')
                 self.update_task(
                     TaskStatus.RUNNING,
                     message='Adding %s node(s) to %s(%s)' %
@@ -712,8 +859,7 @@ class DefaultBroker(threading.Thread):
                 raise CseServerError(
                     'Can\'t delete a master node: \'%s\'.' % node)
         self.tenant_info = self._connect_tenant(headers)
-        clusters = load_from_metadata(
-            self.client_tenant, name=self.cluster_name)
+        clusters = self._find_clusters(self.cluster_name)
         if len(clusters) != 1:
             raise CseServerError(
                 'Cluster \'%s\' not found.' % self.cluster_name)
@@ -721,17 +867,16 @@ class DefaultBroker(threading.Thread):
         self.headers = headers
         self.body = body
         self.op = OP_DELETE_NODES
-        self._connect_sysadmin()
         self.cluster_id = self.cluster['cluster_id']
         self.update_task(
             TaskStatus.RUNNING,
             message='Deleting %s node(s) from cluster %s(%s)' %
                     (len(body['nodes']), self.cluster_name, self.cluster_id))
-        self.daemon = True
-        self.start()
+        state = self._schedule()
         response_body = {}
         response_body['cluster_name'] = self.cluster_name
         response_body['task_href'] = self.task_resource.get('href')
+        response_body['state'] = state
         result['body'] = response_body
         result['status_code'] = ACCEPTED
         return result
@@ -742,6 +887,7 @@ class DefaultBroker(threading.Thread):
         try:
             vapp = VApp(self.client_tenant, href=self.cluster['vapp_href'])
             template = self.get_template()
+            self._enter_phase('drain_nodes')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Deleting %s node(s) from %s(%s)' %
@@ -751,23 +897,32 @@ class DefaultBroker(threading.Thread):
                                       self.body['nodes'], self.body['force'])
             except Exception:
                 LOGGER.error("Couldn't delete node %s from cluster:%s" % (self.body['nodes'], self.cluster_name))
+            self._enter_phase('undeploy_vms')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Undeploying %s node(s) for %s(%s)' %
                 (len(self.body['nodes']), self.cluster_name, self.cluster_id))
+            # undeploy all the VMs at once, and wait for all of them
+            undeploying = {}
             for vm_name in self.body['nodes']:
                 vm = VM(self.client_tenant, resource=vapp.get_vm(vm_name))
                 try:
-                    task = vm.undeploy()
-                    self.client_tenant.get_task_monitor().wait_for_status(task)
-                except Exception as e:
+                    undeploying[vm_name] = get_task_tracker().track(
+                        self.client_tenant, vm.undeploy())
+                except Exception:
+                    LOGGER.warning('couldn\'t undeploy VM %s' % vm_name)
+            for vm_name, future in undeploying.items():
+                try:
+                    future.result()
+                except Exception:
                     LOGGER.warning('couldn\'t undeploy VM %s' % vm_name)
+            self._enter_phase('delete_vms')
             self.update_task(
                 TaskStatus.RUNNING,
                 message='Deleting %s VM(s) for %s(%s)' %
                 (len(self.body['nodes']), self.cluster_name, self.cluster_id))
             task = vapp.delete_vms(self.body['nodes'])
-            self.client_tenant.get_task_monitor().wait_for_status(task)
+            wait_for_task(self.client_tenant, task)
             self.update_task(
                 TaskStatus.SUCCESS,
                 message='Deleted %s node(s) to cluster %s(%s)' %
@@ -811,5 +966,8 @@ class DefaultBroker(threading.Thread):
         self.cluster = clusters[0]
         vdc = VDC(self.client_tenant, href=self.cluster['vdc_href'])
         vdc.delete_vapp(self.cluster['name'], force=True)
+        self._unindex_cluster()
+        get_kubeconfig_cache(self.config).remove(self.cluster_id)
+        get_bootstrap_cache().remove(self.cluster['vapp_href'])
         LOGGER.info('Successfully deleted cluster: %s' % self.cluster_name)
 
@@ -2,6 +2,8 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+from urllib.parse import urlencode
+
 import requests
 
 from container_service_extension.cluster import TYPE_NODE
@@ -11,6 +13,7 @@ from container_service_extension.utils import ERROR_UNKNOWN
 from container_service_extension.utils import process_response
 from container_service_extension.utils import response_to_exception
 
+DEFAULT_PAGE_SIZE = 50
 
 
 class Cluster(object):
@@ -32,17 +35,41 @@ class Cluster(object):
         return process_response(response)
 
     def get_clusters(self):
+        clusters = []
+        for page in self.iter_clusters():
+            clusters.extend(page)
+        return clusters
+
+    def iter_clusters(self, page_size=DEFAULT_PAGE_SIZE):
+        """Get the list of clusters one page at a time.
+
+        :param int page_size: number of clusters per page.
+
+        :return: generator of lists of clusters.
+
+        :rtype: generator
+        """
         method = 'GET'
-        uri = self._uri
-        response = self.client._do_request_prim(
-            method,
-            uri,
-            self.client._session,
-            contents=None,
-            media_type=None,
-            accept_type='application/*+json',
-            auth=None)
-        return process_response(response)
+        params = {'pageSize': page_size}
+        while True:
+            uri = '%s?%s' % (self._uri, urlencode(params))
+            response = self.client._do_request_prim(
+                method,
+                uri,
+                self.client._session,
+                contents=None,
+                media_type=None,
+                accept_type='application/*+json',
+                auth=None)
+            result = process_response(response)
+            if isinstance(result, list):
+                # server without paging support, the full list was returned
+                yield result
+                return
+            yield result['clusters']
+            if result['nextCursor'] is None:
+                return
+            params['cursor'] = result['nextCursor']
 
     def get_cluster_info(self, name):
         method = 'GET'
@@ -143,9 +170,11 @@ class Cluster(object):
                 raise e
         return result
 
-    def get_config(self, cluster_name):
+    def get_config(self, cluster_name, refresh=False):
         method = 'GET'
         uri = '%s/%s/config' % (self._uri, cluster_name)
+        if refresh:
+            uri += '?refresh=true'
         response = self.client._do_request_prim(
             method,
             uri,
@@ -120,6 +120,8 @@ def list_templates(ctx):
                 'catalog': t['catalog'],
                 'catalog_item': t['catalog_item'],
                 'is_default': t['is_default'],
+                # not reported by older servers
+                'available': t.get('available'),
             })
         stdout(result, ctx, show_id=True)
     except Exception as e:
@@ -134,19 +136,29 @@ def list_clusters(ctx):
         restore_session(ctx)
         client = ctx.obj['client']
         cluster = Cluster(client)
+        json_output = ctx.find_root().params.get('json_output')
         result = []
-        clusters = cluster.get_clusters()
-        for c in clusters:
-            result.append({
-                'name': c['name'],
-                'IP master': c['leader_endpoint'],
-                'template': c['template'],
-                'VMs': c['number_of_vms'],
-                'vdc': c['vdc_name'],
-                'status': c['status']
-            })
-
-        stdout(result, ctx, show_id=True)
+        show_headers = True
+        for clusters in cluster.iter_clusters():
+            page = []
+            for c in clusters:
+                page.append({
+                    'name': c['name'],
+                    'IP master': c['leader_endpoint'],
+                    'template': c['template'],
+                    'VMs': c['number_of_vms'],
+                    'vdc': c['vdc_name'],
+                    'status': c['status']
+                })
+            if json_output:
+                # JSON output is a single document, printed after last page
+                result.extend(page)
+            elif page:
+                # each page is printed as it arrives, with the header once
+                stdout(page, ctx, show_id=True, show_headers=show_headers)
+                show_headers = False
+        if json_output:
+            stdout(result, ctx, show_id=True)
     except Exception as e:
         stderr(e, ctx)
 
@@ -275,13 +287,18 @@ def create(ctx, name, node_count, cpu, memory, network_name, storage_profile,
 @click.pass_context
 @click.argument('name', required=True)
 @click.option('-s', '--save', is_flag=True)
-def config(ctx, name, save):
+@click.option(
+    '-r',
+    '--refresh',
+    is_flag=True,
+    help='Download the configuration from the cluster again')
+def config(ctx, name, save, refresh):
     """Display cluster configuration info."""
     try:
         restore_session(ctx)
         client = ctx.obj['client']
         cluster = Cluster(client)
-        cluster_config = cluster.get_config(name)
+        cluster_config = cluster.get_config(name, refresh=refresh)
         if os.name == 'nt':
             cluster_config = str.replace(cluster_config, '\n', '\r\n')
         if save:
@@ -0,0 +1,309 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import time
+
+from cachetools import TTLCache
+from pyvcloud.vcd.client import _WellKnownEndpoint
+from pyvcloud.vcd.client import BasicLoginCredentials
+from pyvcloud.vcd.client import Client
+from pyvcloud.vcd.exceptions import UnauthorizedException
+import requests
+
+from container_service_extension.exceptions import BadRequestError
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import instrument_client
+from container_service_extension.utils import SYSTEM_ORG_NAME
+
+_sysadmin_pool = None
+_sysadmin_pool_lock = threading.Lock()
+_tenant_cache = None
+_tenant_cache_lock = threading.Lock()
+
+
+class SysadminClientPool(object):
+    """Pool of vCD clients logged in as the CSE system administrator.
+
+    A client is handed out to one caller at a time, with acquire(), until
+    the caller gives it back with release(). Idle clients are reused, and a
+    new client is logged in when none is idle, up to a fixed number of
+    clients: past it, callers wait for a client to be given back, so that a
+    burst of requests doesn't log in and out a session per request. Clients
+    stay logged in while they are idle. Since a client is never
+    shared, it can be logged in again without swapping the session of a
+    request in progress: this is done when its session is older than the
+    configured session lifetime, and by the caller holding it after vCD
+    rejected its session.
+    """
+
+    def __init__(self, config, size=4, session_ttl=1200):
+        """Constructor for SysadminClientPool.
+
+        :param dict config: CSE config.
+        :param int size: maximum number of clients, in use or idle.
+        :param int session_ttl: number of seconds after which a client is
+            logged in again.
+        """
+        self.host = config['vcd']['host']
+        self.version = config['vcd']['api_version']
+        self.verify = config['vcd']['verify']
+        self.credentials = BasicLoginCredentials(config['vcd']['username'],
+                                                 SYSTEM_ORG_NAME,
+                                                 config['vcd']['password'])
+        self.size = size
+        self.session_ttl = session_ttl
+        if not self.verify:
+            LOGGER.warning('InsecureRequestWarning: '
+                           'Unverified HTTPS request is being made. '
+                           'Adding certificate verification is strongly '
+                           'advised.')
+            requests.packages.urllib3.disable_warnings()
+        self._idle = []
+        self._logged_in_at = {}
+        # number of clients handed out or idle
+        self._count = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    def acquire(self):
+        """Get a logged-in sysadmin client for the exclusive use of the caller.
+
+        Blocks until a client is idle if all the clients of the pool are in
+        use.
+
+        :return: client, to be given back with release().
+
+        :rtype: pyvcloud.vcd.client.Client
+        """
+        with self._available:
+            while not self._idle and self._count >= self.size:
+                self._available.wait()
+            if self._idle:
+                client = self._idle.pop()
+                logged_in_at = self._logged_in_at.get(client)
+            else:
+                client = None
+                self._count += 1
+        try:
+            if client is None:
+                client = Client(uri=self.host,
+                                api_version=self.version,
+                                verify_ssl_certs=self.verify,
+                                log_headers=True,
+                                log_bodies=True)
+                self._login(client)
+            elif time.time() - logged_in_at > self.session_ttl:
+                self._login(client)
+        except Exception:
+            self.discard(client)
+            raise
+        return client
+
+    def release(self, client):
+        """Give a client back to the pool.
+
+        :param pyvcloud.vcd.client.Client client: client obtained through
+            acquire().
+        """
+        with self._available:
+            self._idle.append(client)
+            self._available.notify()
+
+    def invalidate(self, client):
+        """Log a client in again after vCD rejected its session.
+
+        :param pyvcloud.vcd.client.Client client: client obtained through
+            acquire(), and not released yet.
+        """
+        self._login(client)
+
+    def _login(self, client):
+        LOGGER.debug('logging in to vCD %s as sysadmin' % self.host)
+        client.set_credentials(self.credentials)
+        instrument_client(client)
+        with self._lock:
+            self._logged_in_at[client] = time.time()
+
+    def discard(self, client):
+        """Drop a client that could not be logged in, instead of releasing it.
+
+        :param pyvcloud.vcd.client.Client client: client obtained through
+            acquire().
+        """
+        with self._available:
+            self._logged_in_at.pop(client, None)
+            self._count -= 1
+            self._available.notify()
+
+
+def get_sysadmin_pool(config):
+    """Get the process-wide pool of sysadmin clients.
+
+    :param dict config: CSE config, used to create the pool the first time
+        it is requested.
+
+    :rtype: SysadminClientPool
+    """
+    global _sysadmin_pool
+    with _sysadmin_pool_lock:
+        if _sysadmin_pool is None:
+            _sysadmin_pool = SysadminClientPool(
+                config,
+                size=config['service']['sysadmin_pool_size'],
+                session_ttl=config['service']['sysadmin_session_ttl'])
+        return _sysadmin_pool
+
+
+def call_as_sysadmin(config, func):
+    """Call a function with a logged-in sysadmin client from the pool.
+
+    If vCD rejects the session of the client, which happens when it expired
+    on the vCD side before its configured lifetime, the client is logged in
+    again and the function is called a second time. The function must
+    therefore be safe to call again after it failed with an
+    UnauthorizedException.
+
+    :param dict config: CSE config.
+    :param function func: function taking the client as its only argument.
+
+    :return: what @func returns.
+    """
+    pool = get_sysadmin_pool(config)
+    client = pool.acquire()
+    try:
+        for attempt in range(2):
+            try:
+                return func(client)
+            except UnauthorizedException:
+                LOGGER.debug('pooled sysadmin session rejected by vCD, '
+                             'logging in again')
+                # to retry, or not to give back a session known to be stale
+                try:
+                    pool.invalidate(client)
+                except Exception:
+                    pool.discard(client)
+                    client = None
+                    raise
+                if attempt > 0:
+                    raise
+    finally:
+        if client is not None:
+            pool.release(client)
+
+
+class TenantClientCache(object):
+    """Cache of rehydrated tenant clients, keyed by auth token and version.
+
+    A cached client keeps its connection to vCD open, and saves the
+    rehydration of the session and the TLS handshake on repeated requests
+    with the same token. The token is not checked with vCD on a hit: entries
+    expire after a fixed lifetime, and are dropped as soon as vCD rejects
+    the token of a request made with them.
+    """
+
+    def __init__(self, config, maxsize=1024, ttl=300):
+        """Constructor for TenantClientCache.
+
+        :param dict config: CSE config.
+        :param int maxsize: maximum number of cached sessions.
+        :param int ttl: number of seconds a cached session is reused for.
+        """
+        self.host = config['vcd']['host']
+        self.verify = config['vcd']['verify']
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, headers):
+        """Get the client and session info for a tenant request.
+
+        :param dict headers: request headers, with the
+            'x-vcloud-authorization' token and an 'Accept' header carrying
+            the API version.
+
+        :return: tuple of the rehydrated client and a dictionary with keys
+            'user_name', 'user_id', 'org_name' and 'org_href'.
+
+        :rtype: tuple
+
+        :raises BadRequestError: if the token or the API version is missing
+            from the headers.
+        """
+        key = _to_tenant_key(headers)
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None:
+            return entry
+
+        token, version = key
+        client = Client(
+            uri=self.host,
+            api_version=version,
+            verify_ssl_certs=self.verify,
+            log_headers=True,
+            log_bodies=True)
+        session = client.rehydrate_from_token(token)
+        instrument_client(client)
+        session_info = {
+            'user_name': session.get('user'),
+            'user_id': session.get('userId'),
+            'org_name': session.get('org'),
+            'org_href': client._get_wk_endpoint(
+                _WellKnownEndpoint.LOGGED_IN_ORG)
+        }
+        entry = (client, session_info)
+        with self._lock:
+            self._cache[key] = entry
+        return entry
+
+    def invalidate(self, headers):
+        """Drop the cached session for a request's auth token.
+
+        :param dict headers: request headers.
+        """
+        with self._lock:
+            self._cache.pop(_to_tenant_key(headers), None)
+
+
+def _to_tenant_key(headers):
+    token = headers.get('x-vcloud-authorization')
+    if not token:
+        raise BadRequestError('Missing x-vcloud-authorization header.')
+    accept = headers.get('Accept') or ''
+    for part in accept.split(';'):
+        name, _, value = part.strip().partition('=')
+        if name.strip() == 'version' and value.strip():
+            return (token, value.strip())
+    raise BadRequestError('Missing API version in Accept header.')
+
+
+def get_tenant_cache(config):
+    """Get the process-wide cache of tenant clients.
+
+    :param dict config: CSE config, used to create the cache the first time
+        it is requested.
+
+    :rtype: TenantClientCache
+    """
+    global _tenant_cache
+    with _tenant_cache_lock:
+        if _tenant_cache is None:
+            _tenant_cache = TenantClientCache(
+                config,
+                maxsize=config['service']['tenant_session_cache_size'],
+                ttl=config['service']['tenant_session_cache_ttl'])
+        return _tenant_cache
+
+
+def get_tenant_client(config, headers):
+    """Get the (possibly cached) client and session info for a request.
+
+    :param dict config: CSE config.
+    :param dict headers: request headers.
+
+    :return: tuple of the rehydrated client and its session info.
+
+    :rtype: tuple
+    """
+    return get_tenant_cache(config).get(headers)
@@ -2,47 +2,89 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+from concurrent.futures import ThreadPoolExecutor
+import itertools
 import random
 import re
 import string
 import time
+from urllib.parse import urlencode
 
+from lxml import etree
+from pyvcloud.vcd.client import E
+from pyvcloud.vcd.client import EntityType
+from pyvcloud.vcd.client import NSMAP
 from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import RelationType
+from pyvcloud.vcd.client import VCLOUD_STATUS_MAP
 from pyvcloud.vcd.vapp import VApp
 from pyvcloud.vcd.vm import VM
 
+from container_service_extension.bootstrap_cache import get_bootstrap_cache
 from container_service_extension.exceptions import ClusterInitializationError
 from container_service_extension.exceptions import ClusterJoiningError
-from container_service_extension.exceptions import CseServerError
 from container_service_extension.exceptions import DeleteNodeError
 from container_service_extension.exceptions import NodeCreationError
 from container_service_extension.exceptions import ScriptExecutionError
-from container_service_extension.utils import get_data_file
-from container_service_extension.utils import get_vsphere
+from container_service_extension.logger import current_log_tag
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.logger import use_log_tag
+from container_service_extension.metrics import GUEST_OPERATION_DURATION
+from container_service_extension.readiness import wait_until_ready
+from container_service_extension.task_tracker import wait_for_task
+from container_service_extension.task_tracker import wait_for_tasks
+from container_service_extension.tracing import current_span
+from container_service_extension.tracing import span
+from container_service_extension.tracing import use_span
+from container_service_extension.utils import get_data_file
+from container_service_extension.vsphere_pool import vsphere_session
 
 TYPE_MASTER = 'mstr'
 TYPE_NODE = 'node'
 TYPE_NFS = 'nfsd'
 
-
-def wait_until_tools_ready(vm):
-    while True:
-        try:
-            status = vm.guest.toolsRunningStatus
-            if 'guestToolsRunning' == status:
-                LOGGER.debug('vm tools %s are ready' % vm)
-                return
-            LOGGER.debug('waiting for vm tools %s to be ready (%s)' % (vm,
-                                                                       status))
-            time.sleep(1)
-        except Exception:
-            LOGGER.debug('waiting for vm tools %s to be ready (%s)* ' %
-                         (vm, status))
-            time.sleep(1)
+_MASTER_IP_SCRIPT = "ip route get 1 | awk '{print $NF;exit}'\n"
 
 
 def load_from_metadata(client, name=None, cluster_id=None):
+    return list(iter_clusters(client, name=name, cluster_id=cluster_id))
+
+
+def iter_clusters(client, name=None, cluster_id=None, page_size=None,
+                  offset=0):
+    """Lazily list the clusters visible to a client, sorted by name.
+
+    Query result pages are fetched from vCD only as the generator is
+    consumed, so callers that need a slice of the list never materialize the
+    whole of it.
+
+    :param pyvcloud.vcd.client.Client client: client to query vCD with.
+    :param str name: if set, only list the cluster with this name.
+    :param str cluster_id: if set, only list the cluster with this id.
+    :param int page_size: number of records fetched per vCD query page.
+    :param int offset: number of clusters to skip. If it is a multiple of
+        page_size, the skipped query pages are not fetched at all.
+
+    :return: generator of cluster dictionaries.
+
+    :rtype: generator
+    """
+    records = iter_cluster_records(client, name=name, cluster_id=cluster_id,
+                                   page_size=page_size, offset=offset)
+    return (to_cluster(client, record) for record in records)
+
+
+def iter_cluster_records(client, name=None, cluster_id=None, page_size=None,
+                         offset=0):
+    """Lazily list the vApp query records of clusters, sorted by name.
+
+    Parameters are the same as for iter_clusters().
+
+    :return: generator of vApp (or adminVApp, for the system administrator)
+        query records.
+
+    :rtype: generator
+    """
     if cluster_id is None:
         query_filter = 'metadata:cse.cluster.id==STRING:*'
     else:
@@ -52,49 +94,102 @@ def load_from_metadata(client, name=None, cluster_id=None):
     resource_type = 'vApp'
     if client.is_sysadmin():
         resource_type = 'adminVApp'
-    q = client.get_typed_query(
-        resource_type,
-        query_result_format=QueryResultFormat.ID_RECORDS,
-        qfilter=query_filter,
-        fields='metadata:cse.cluster.id,metadata:cse.master.ip,'
-               'metadata:cse.version,metadata:cse.template')
-    records = list(q.execute())
-
-    clusters = []
-    for record in records:
-        vapp_id = record.get('id').split(':')[-1]
-        vdc_id = record.get('vdc').split(':')[-1]
-
-        cluster = {
-            'name': record.get('name'),
-            'vapp_id': vapp_id,
-            'vapp_href': f'{client._uri}/vApp/vapp-{vapp_id}',
-            'vdc_name': record.get('vdcName'),
-            'vdc_href': f'{client._uri}/vdc/{vdc_id}',
-            'leader_endpoint': '',
-            'master_nodes': [],
-            'nodes': [],
-            'nfs_nodes': [],
-            'number_of_vms': record.get('numberOfVMs'),
-            'template': '',
-            'cse_version': '',
-            'cluster_id': '',
-            'status': record.get('status')
-        }
-        if hasattr(record, 'Metadata'):
-            for entry in record.Metadata.MetadataEntry:
-                if entry.Key == 'cse.cluster.id':
-                    cluster['cluster_id'] = str(entry.TypedValue.Value)
-                elif entry.Key == 'cse.version':
-                    cluster['cse_version'] = str(entry.TypedValue.Value)
-                elif entry.Key == 'cse.master.ip':
-                    cluster['leader_endpoint'] = str(entry.TypedValue.Value)
-                elif entry.Key == 'cse.template':
-                    cluster['template'] = str(entry.TypedValue.Value)
-
-        clusters.append(cluster)
-
-    return clusters
+    # the query is built here rather than with client.get_typed_query(),
+    # which can't start at a given page
+    params = {
+        'type': resource_type,
+        'format': QueryResultFormat.ID_RECORDS.value[1],
+        'page': 1,
+        'filter': query_filter,
+        'sortAsc': 'name',
+        'fields': 'metadata:cse.cluster.id,metadata:cse.master.ip,'
+                  'metadata:cse.version,metadata:cse.template'
+    }
+    if page_size:
+        params['pageSize'] = page_size
+        # start the query at the page holding the first requested record
+        params['page'] = offset // page_size + 1
+        offset = offset % page_size
+    uri = f'{client._uri}/query?{urlencode(params)}'
+    return itertools.islice(_iter_query_records(client, uri), offset, None)
+
+
+def _iter_query_records(client, uri):
+    """Lazily get the records of a query, following its next page links.
+
+    :param pyvcloud.vcd.client.Client client: client to query vCD with.
+    :param str uri: uri of the first page of the query.
+
+    :return: generator of query records.
+
+    :rtype: generator
+    """
+    while uri is not None:
+        results = client.get_resource(uri)
+        uri = None
+        for record in results.iterchildren():
+            if etree.QName(record.tag).localname != 'Link':
+                yield record
+            elif record.get('rel') == RelationType.NEXT_PAGE.value:
+                uri = record.get('href')
+
+
+def to_cluster(client, record):
+    vapp_id = record.get('id').split(':')[-1]
+    vdc_id = record.get('vdc').split(':')[-1]
+
+    cluster = {
+        'name': record.get('name'),
+        'vapp_id': vapp_id,
+        'vapp_href': f'{client._uri}/vApp/vapp-{vapp_id}',
+        'vdc_name': record.get('vdcName'),
+        'vdc_href': f'{client._uri}/vdc/{vdc_id}',
+        'leader_endpoint': '',
+        'master_nodes': [],
+        'nodes': [],
+        'nfs_nodes': [],
+        'number_of_vms': record.get('numberOfVMs'),
+        'template': '',
+        'cse_version': '',
+        'cluster_id': '',
+        'status': record.get('status')
+    }
+    if hasattr(record, 'Metadata'):
+        for entry in record.Metadata.MetadataEntry:
+            if entry.Key == 'cse.cluster.id':
+                cluster['cluster_id'] = str(entry.TypedValue.Value)
+            elif entry.Key == 'cse.version':
+                cluster['cse_version'] = str(entry.TypedValue.Value)
+            elif entry.Key == 'cse.master.ip':
+                cluster['leader_endpoint'] = str(entry.TypedValue.Value)
+            elif entry.Key == 'cse.template':
+                cluster['template'] = str(entry.TypedValue.Value)
+    return cluster
+
+
+def set_cluster_metadata(client, vapp, metadata):
+    """Write metadata entries on a cluster vApp, with a single request.
+
+    Entries are written as strings in the GENERAL domain, readable and
+    writable by the tenant, like VApp.set_metadata() does for one entry.
+
+    :param pyvcloud.vcd.client.Client client: client to write with.
+    :param pyvcloud.vcd.vapp.VApp vapp: cluster vApp.
+    :param dict metadata: keys and values to write.
+    """
+    entries = [
+        E.MetadataEntry(
+            {'type': 'xs:string'},
+            E.Domain('GENERAL', visibility='READWRITE'),
+            E.Key(key),
+            E.TypedValue(
+                {'{' + NSMAP['xsi'] + '}type': 'MetadataStringValue'},
+                E.Value(value)))
+        for key, value in metadata.items()
+    ]
+    task = client.post_resource(vapp.href + '/metadata', E.Metadata(*entries),
+                                EntityType.METADATA.value)
+    wait_for_task(client, task)
 
 
 def add_nodes(qty, template, node_type, config, client, org, vdc, vapp, body):
@@ -160,22 +255,21 @@ def add_nodes(qty, template, node_type, config, client, org, vdc, vapp, body):
             reconfigure_hw = False
         task = vapp.add_vms(specs, power_on=not reconfigure_hw)
         # TODO(get details of the exception like not enough resources avail)
-        client.get_task_monitor().wait_for_status(task)
+        wait_for_task(client, task)
         if reconfigure_hw:
             vapp.reload()
-            for spec in specs:
-                vm_resource = vapp.get_vm(spec['target_vm_name'])
-                if 'cpu' in body and body['cpu'] is not None:
-                    vm = VM(client, resource=vm_resource)
-                    task = vm.modify_cpu(body['cpu'])
-                    client.get_task_monitor().wait_for_status(task)
-                if 'memory' in body and body['memory'] is not None:
-                    vm = VM(client, resource=vm_resource)
-                    task = vm.modify_memory(body['memory'])
-                    client.get_task_monitor().wait_for_status(task)
-                vm = VM(client, resource=vm_resource)
-                task = vm.power_on()
-                client.get_task_monitor().wait_for_status(task)
+            vms = [VM(client, resource=vapp.get_vm(spec['target_vm_name']))
+                   for spec in specs]
+            # a VM runs one task at a time, so each step is submitted for all
+            # the VMs at once, and the next step starts when all are done
+            if 'cpu' in body and body['cpu'] is not None:
+                _run_on_vms(client, vms,
+                            lambda vm: vm.modify_cpu(body['cpu']))
+            if 'memory' in body and body['memory'] is not None:
+                _run_on_vms(client, vms,
+                            lambda vm: vm.modify_memory(body['memory']))
+            tasks = _run_on_vms(client, vms, lambda vm: vm.power_on())
+            task = tasks[-1]
         password = source_vapp.get_admin_password(source_vm)
         vapp.reload()
         for spec in specs:
@@ -207,6 +301,36 @@ def add_nodes(qty, template, node_type, config, client, org, vdc, vapp, body):
     return {'task': task, 'specs': specs}
 
 
+def _run_on_vms(client, vms, start):
+    """Start a task on each of a list of VMs, and wait until all are done.
+
+    If a task can't be started, the tasks already started are waited for
+    before the error is raised, so that they don't overlap with the
+    rollback of the VMs.
+
+    :param pyvcloud.vcd.client.Client client: client allowed to read the
+        tasks.
+    :param list vms: list of pyvcloud.vcd.vm.VM objects.
+    :param function start: callable taking a VM and returning the task
+        resource of the operation it started on the VM.
+
+    :return: the final task resources, in the same order as @vms.
+
+    :rtype: list
+    """
+    tasks = []
+    try:
+        for vm in vms:
+            tasks.append(start(vm))
+    except Exception:
+        try:
+            wait_for_tasks(client, tasks)
+        except Exception as e:
+            LOGGER.debug('task on vm failed: %s' % str(e))
+        raise
+    return wait_for_tasks(client, tasks)
+
+
 def get_nodes(vapp, node_type):
     nodes = []
     for node in vapp.get_all_vms():
@@ -215,10 +339,49 @@ def get_nodes(vapp, node_type):
     return nodes
 
 
-def wait_for_tools_ready_callback(message, exception=None):
-    LOGGER.debug('waiting for guest tools, status: %s' % message)
-    if exception is not None:
-        LOGGER.error('exception: %s' % str(exception))
+def get_vm_info(vm):
+    """Get name, IP address, status, CPU and memory of a cluster VM.
+
+    Everything is read from the VM element of an already fetched vApp
+    resource, so no request is made to vCD.
+
+    :param lxml.objectify.ObjectifiedElement vm: VM element of a vApp
+        resource, as returned by VApp.get_all_vms().
+
+    :return: node information.
+
+    :rtype: dict
+    """
+    node_info = {
+        'name': vm.get('name'),
+        'numberOfCpus': '',
+        'memoryMB': '',
+        'status': VCLOUD_STATUS_MAP.get(int(vm.get('status'))),
+        'ipAddress': _get_primary_ip(vm)
+    }
+    if hasattr(vm, 'VmSpecSection'):
+        node_info['numberOfCpus'] = vm.VmSpecSection.NumCpus.text
+        node_info['memoryMB'] = \
+            vm.VmSpecSection.MemoryResourceMb.Configured.text
+    return node_info
+
+
+def _get_primary_ip(vm):
+    if not hasattr(vm, 'NetworkConnectionSection'):
+        return ''
+    section = vm.NetworkConnectionSection
+    if not hasattr(section, 'NetworkConnection'):
+        return ''
+    primary_index = None
+    if hasattr(section, 'PrimaryNetworkConnectionIndex'):
+        primary_index = section.PrimaryNetworkConnectionIndex.text
+    for connection in section.NetworkConnection:
+        if primary_index is not None and \
+                connection.NetworkConnectionIndex.text != primary_index:
+            continue
+        if hasattr(connection, 'IpAddress'):
+            return connection.IpAddress.text
+    return ''
 
 
 def wait_for_guest_execution_callback(message, exception=None):
@@ -228,23 +391,42 @@ def wait_for_guest_execution_callback(message, exception=None):
 
 
 def get_init_info(config, vapp, password):
-    script = \
-"""#!/usr/bin/env bash
-kubeadm token create
-ip route get 1 | awk '{print $NF;exit}'
-""" # NOQA
+    """Get a join token and the IP address of the master node of a cluster.
+
+    Both are taken from the bootstrap cache when possible, and created or
+    read on the master node otherwise.
+
+    :return: list of the join token and the master IP address.
+
+    :rtype: list
+    """
+    cache = get_bootstrap_cache()
+    token = cache.get_join_token(vapp.href)
+    master_ip = cache.get_master_ip(vapp.href)
+    if token is not None and master_ip is not None:
+        return [token, master_ip]
+    ttl = config['service']['join_token_ttl']
+    script = '#!/usr/bin/env bash\nkubeadm token create --ttl %ss\n' % ttl
+    if master_ip is None:
+        script += _MASTER_IP_SCRIPT
     nodes = get_nodes(vapp, TYPE_MASTER)
     result = execute_script_in_nodes(
         config, vapp, password, script, nodes, check_tools=False)
-    return result[0][1].content.decode().split()
+    init_info = result[0][1].content.decode().split()
+    cache.put_join_token(vapp.href, init_info[0], ttl)
+    if master_ip is None:
+        cache.put_master_ip(vapp.href, init_info[1])
+    else:
+        init_info.append(master_ip)
+    return init_info
 
 
 def get_master_ip(config, vapp, template):
+    master_ip = get_bootstrap_cache().get_master_ip(vapp.href)
+    if master_ip is not None:
+        return master_ip
     LOGGER.debug('getting master IP for vapp: %s' % vapp.resource.get('name'))
-    script = \
-"""#!/usr/bin/env bash
-ip route get 1 | awk '{print $NF;exit}'
-""" # NOQA
+    script = '#!/usr/bin/env bash\n' + _MASTER_IP_SCRIPT
     nodes = get_nodes(vapp, TYPE_MASTER)
     result = execute_script_in_nodes(
         config,
@@ -256,6 +438,7 @@ ip route get 1 | awk '{print $NF;exit}'
     master_ip = result[0][1].content.decode().split()[0]
     LOGGER.debug('getting master IP for vapp: %s, ip: %s' %
                  (vapp.resource.get('name'), master_ip))
+    get_bootstrap_cache().put_master_ip(vapp.href, master_ip)
     return master_ip
 
 
@@ -272,8 +455,13 @@ def get_cluster_config(config, vapp, password):
 def init_cluster(config, vapp, template):
     script = get_data_file('mstr-%s.sh' % template['name'])
     nodes = get_nodes(vapp, TYPE_MASTER)
-    result = execute_script_in_nodes(config, vapp, template['admin_password'],
-                                     script, nodes)
+    try:
+        result = execute_script_in_nodes(config, vapp,
+                                         template['admin_password'],
+                                         script, nodes)
+    except ScriptExecutionError as e:
+        raise ClusterInitializationError(
+            'Couldn\'t initialize cluster:\n%s' % str(e))
     if result[0][0] != 0:
         raise ClusterInitializationError('Couldn\'t initialize cluster:\n%s' %
                         result[0][2].content.decode())
@@ -290,42 +478,20 @@ def join_cluster(config, vapp, template, target_nodes=None):
         for node in vapp.get_all_vms():
             if node.get('name') in target_nodes:
                 nodes.append(node)
-    results = execute_script_in_nodes(config, vapp, template['admin_password'],
-                                      script, nodes)
-    for result in results:
-        if result[0] != 0:
-            raise ClusterJoiningError(
-                'Couldn\'t join cluster:\n%s' % result[2].content.decode())
-
-
-def wait_until_ready_to_exec(vs, vm, password, tries=30):
-    ready = False
-    script = \
-"""#!/usr/bin/env bash
-uname -a
-""" # NOQA
-    for n in range(tries):
-        try:
-            result = vs.execute_script_in_guest(
-                vm,
-                'root',
-                password,
-                script,
-                target_file=None,
-                wait_for_completion=True,
-                wait_time=5,
-                get_output=True,
-                delete_script=True,
-                callback=wait_for_guest_execution_callback)
-            if result[0] == 0:
-                ready = True
-                break
-            raise Exception('script returned %s' % result[0])
-        except Exception:
-            LOGGER.info('VM is not ready to execute scripts, yet')
-            time.sleep(2)
-    if not ready:
-        raise CseServerError('VM is not ready to execute scripts')
+    try:
+        results = execute_script_in_nodes(config, vapp,
+                                          template['admin_password'],
+                                          script, nodes)
+    except ScriptExecutionError as e:
+        get_bootstrap_cache().invalidate_join_token(vapp.href)
+        raise ClusterJoiningError('Couldn\'t join cluster:\n%s' % str(e))
+    errors = get_script_execution_errors(results)
+    if errors:
+        # the token may have been deleted on the master, get a new one next
+        # time
+        get_bootstrap_cache().invalidate_join_token(vapp.href)
+        raise ClusterJoiningError(
+            'Couldn\'t join cluster:\n%s' % '\n'.join(errors))
 
 
 def execute_script_in_nodes(config,
@@ -335,26 +501,75 @@ def execute_script_in_nodes(config,
                             nodes,
                             check_tools=True,
                             wait=True):
+    """Execute a script in the guest OS of each node, concurrently.
+
+    At most config['service']['guest_exec_workers'] nodes are worked on at a
+    time. Every node is attempted even if the script fails to run on some of
+    them.
+
+    :return: one execution result per node, in the same order as @nodes.
+
+    :rtype: list
+
+    :raises ScriptExecutionError: if the script could not be run on one or
+        more of the nodes.
+    """
+    if len(nodes) == 0:
+        return []
+    max_workers = min(len(nodes), config['service']['guest_exec_workers'])
+    parent_span = current_span()
+    log_tag = current_log_tag()
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='guest-exec') as executor:
+        futures = [
+            executor.submit(_run_in_span, parent_span, log_tag, 'guest exec',
+                            {'cse.node.name': node.get('name')},
+                            _execute_script_in_node, config, vapp, password,
+                            script, node, check_tools, wait)
+            for node in nodes
+        ]
     all_results = []
-    for node in nodes:
-        if 'chpasswd' in script:
-            p = re.compile(':.*\"')
-            debug_script = p.sub(':***\"', script)
-        else:
-            debug_script = script
-        LOGGER.debug('will try to execute script on %s:\n%s' %
-                     (node.get('name'), debug_script))
-        vs = get_vsphere(config, vapp, node.get('name'))
-        vs.connect()
+    errors = {}
+    for node, future in zip(nodes, futures):
+        try:
+            all_results.append(future.result())
+        except Exception as e:
+            LOGGER.error('failed to execute script on %s: %s' %
+                         (node.get('name'), str(e)))
+            errors[node.get('name')] = str(e)
+    if errors:
+        raise ScriptExecutionError(
+            f"Script execution failed on node(s): {errors}")
+    return all_results
+
+
+def _run_in_span(parent_span, log_tag, name, attributes, func, *args):
+    with use_span(parent_span), use_log_tag(log_tag), \
+            span(name, attributes=attributes):
+        return func(*args)
+
+
+def _execute_script_in_node(config, vapp, password, script, node,
+                            check_tools, wait):
+    if 'chpasswd' in script:
+        p = re.compile(':.*\"')
+        debug_script = p.sub(':***\"', script)
+    else:
+        debug_script = script
+    LOGGER.debug('will try to execute script on %s:\n%s' %
+                 (node.get('name'), debug_script))
+    if check_tools:
+        LOGGER.debug('waiting for tools on %s' % node.get('name'))
+        with GUEST_OPERATION_DURATION.time(operation='wait_tools'), \
+                span('guest wait_tools'):
+            wait_until_ready(config, vapp, node.get('name'),
+                             timeout=config['service']['vm_ready_timeout'])
+    with vsphere_session(config, vapp, node.get('name')) as vs:
         moid = vapp.get_vm_moid(node.get('name'))
         vm = vs.get_vm_by_moid(moid)
-        if check_tools:
-            LOGGER.debug('waiting for tools on %s' % node.get('name'))
-            vs.wait_until_tools_ready(
-                vm, sleep=5, callback=wait_for_tools_ready_callback)
-            wait_until_ready_to_exec(vs, vm, password)
         LOGGER.debug('about to execute script on %s (vm=%s), wait=%s' %
                      (node.get('name'), vm, wait))
+        started_at = time.time()
         if wait:
             result = vs.execute_script_in_guest(
                 vm,
@@ -381,11 +596,13 @@ def execute_script_in_nodes(config,
             ]
             result_stdout = ''
             result_stderr = ''
+        GUEST_OPERATION_DURATION.observe(
+            time.time() - started_at,
+            operation='execute_script' if wait else 'start_program')
         LOGGER.debug(result[0])
         LOGGER.debug(result_stderr)
         LOGGER.debug(result_stdout)
-        all_results.append(result)
-    return all_results
+    return result
 
 
 def get_file_from_nodes(config,
@@ -397,15 +614,19 @@ def get_file_from_nodes(config,
     all_results = []
     for node in nodes:
         LOGGER.debug('getting file from node %s' % node.get('name'))
-        vs = get_vsphere(config, vapp, node.get('name'))
-        vs.connect()
-        moid = vapp.get_vm_moid(node.get('name'))
-        vm = vs.get_vm_by_moid(moid)
         if check_tools:
-            vs.wait_until_tools_ready(
-                vm, sleep=5, callback=wait_for_tools_ready_callback)
-            wait_until_ready_to_exec(vs, vm, password)
-        result = vs.download_file_from_guest(vm, 'root', password, file_name)
+            with GUEST_OPERATION_DURATION.time(operation='wait_tools'):
+                wait_until_ready(
+                    config, vapp, node.get('name'),
+                    timeout=config['service']['vm_ready_timeout'])
+        with vsphere_session(config, vapp, node.get('name')) as vs:
+            moid = vapp.get_vm_moid(node.get('name'))
+            vm = vs.get_vm_by_moid(moid)
+            with GUEST_OPERATION_DURATION.time(operation='download_file'), \
+                    span('guest download_file',
+                         attributes={'cse.node.name': node.get('name')}):
+                result = vs.download_file_from_guest(vm, 'root', password,
+                                                     file_name)
         all_results.append(result)
     return all_results
 
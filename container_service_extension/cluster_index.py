@@ -0,0 +1,245 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import copy
+import threading
+import time
+import traceback
+
+from pyvcloud.vcd.exceptions import AccessForbiddenException
+from pyvcloud.vcd.exceptions import NotFoundException
+
+from container_service_extension.client_pool import call_as_sysadmin
+from container_service_extension.cluster import iter_cluster_records
+from container_service_extension.cluster import load_from_metadata
+from container_service_extension.cluster import to_cluster
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+
+# number of records fetched per query page when reconciling
+_RECONCILE_PAGE_SIZE = 128
+
+_index = None
+_index_lock = threading.Lock()
+
+
+class ClusterIndex(object):
+    """In-memory index of CSE clusters, by org and name, and by id.
+
+    Clusters are keyed by the href of their vApp, so that clusters of the
+    same name in different VDCs of an org are indexed side by side. Only
+    clusters that are known to exist are indexed: a lookup that misses the
+    index always goes to vCD. Entries are added when a lookup goes to vCD or
+    when the broker creates a cluster, removed when the broker deletes a
+    cluster, and all of them are periodically replaced by a fresh listing
+    from vCD, so that changes made outside of CSE are picked up.
+    """
+
+    def __init__(self):
+        # (org_id, cluster) by vApp href
+        self._clusters = {}
+        # set of vApp hrefs by (org_id, name)
+        self._by_name = {}
+        # vApp href by cluster id
+        self._by_id = {}
+        # removal time by vApp href
+        self._removed = {}
+        self._lock = threading.Lock()
+
+    def get(self, org_id, name):
+        """Get the indexed clusters of an org with a given name.
+
+        :param str org_id: id of the org the clusters belong to.
+        :param str name: name of the clusters.
+
+        :return: copies of the cluster dictionaries, one per VDC the name is
+            used in. The list is empty if no such cluster is indexed.
+
+        :rtype: list
+        """
+        with self._lock:
+            clusters = [
+                self._clusters[vapp_href][1]
+                for vapp_href in self._by_name.get((org_id, name), ())
+            ]
+        return copy.deepcopy(clusters)
+
+    def get_by_id(self, cluster_id):
+        """Get an indexed cluster by id.
+
+        :param str cluster_id: id of the cluster.
+
+        :return: a copy of the cluster dictionary, or None if the cluster is
+            not indexed.
+
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self._clusters.get(self._by_id.get(cluster_id))
+        return copy.deepcopy(entry[1]) if entry is not None else None
+
+    def put(self, org_id, cluster):
+        """Add or update a cluster.
+
+        :param str org_id: id of the org the cluster belongs to.
+        :param dict cluster: cluster dictionary, as returned by
+            load_from_metadata().
+        """
+        with self._lock:
+            self._put(org_id, copy.deepcopy(cluster))
+            self._removed.pop(cluster['vapp_href'], None)
+
+    def remove(self, vapp_href):
+        """Remove a cluster, if it is indexed.
+
+        :param str vapp_href: href of the vApp of the cluster.
+        """
+        with self._lock:
+            self._remove(vapp_href)
+            self._removed[vapp_href] = time.time()
+
+    def replace_all(self, entries, started_at):
+        """Replace the content of the index with a full listing from vCD.
+
+        :param list entries: list of (org_id, cluster) tuples.
+        :param float started_at: time at which the listing was started.
+            Clusters removed from the index after that time are not added
+            back, as the listing may predate their deletion.
+        """
+        with self._lock:
+            self._clusters = {}
+            self._by_name = {}
+            self._by_id = {}
+            for org_id, cluster in entries:
+                if self._removed.get(cluster['vapp_href'], 0) < started_at:
+                    self._put(org_id, cluster)
+            self._removed = {
+                vapp_href: removed_at
+                for vapp_href, removed_at in self._removed.items()
+                if removed_at >= started_at
+            }
+
+    def _put(self, org_id, cluster):
+        vapp_href = cluster['vapp_href']
+        self._remove(vapp_href)
+        self._clusters[vapp_href] = (org_id, cluster)
+        self._by_name.setdefault((org_id, cluster['name']),
+                                 set()).add(vapp_href)
+        if cluster['cluster_id']:
+            self._by_id[cluster['cluster_id']] = vapp_href
+
+    def _remove(self, vapp_href):
+        entry = self._clusters.pop(vapp_href, None)
+        if entry is None:
+            return
+        org_id, cluster = entry
+        key = (org_id, cluster['name'])
+        self._by_name[key].discard(vapp_href)
+        if not self._by_name[key]:
+            del self._by_name[key]
+        if self._by_id.get(cluster['cluster_id']) == vapp_href:
+            del self._by_id[cluster['cluster_id']]
+
+
+def get_cluster_index():
+    """Get the process-wide cluster index.
+
+    :rtype: ClusterIndex
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ClusterIndex()
+        return _index
+
+
+def _is_visible(client, cluster):
+    """Check that the tenant can see an indexed cluster.
+
+    The index is filled from a listing of the clusters of all orgs, so a hit
+    is only returned to a tenant that can read the vApp of the cluster.
+
+    :param pyvcloud.vcd.client.Client client: tenant client.
+    :param dict cluster: indexed cluster dictionary.
+
+    :rtype: bool
+    """
+    try:
+        client.get_resource(cluster['vapp_href'])
+    except AccessForbiddenException:
+        return False
+    except NotFoundException:
+        get_cluster_index().remove(cluster['vapp_href'])
+        return False
+    return True
+
+
+def find_clusters(client, org_id, name):
+    """Find a cluster by name, from the index if possible.
+
+    Index hits are checked with the tenant client. On a miss, or if the
+    tenant can't see one of the clusters found in the index, vCD is queried
+    with the tenant client and the clusters found are indexed.
+
+    :param pyvcloud.vcd.client.Client client: tenant client.
+    :param str org_id: id of the tenant's org. If None, the index is not
+        used, which is the case for the system administrator, who sees the
+        clusters of all orgs.
+    :param str name: name of the cluster.
+
+    :return: list of cluster dictionaries, as returned by
+        load_from_metadata().
+
+    :rtype: list
+    """
+    if org_id is None:
+        return load_from_metadata(client, name=name)
+    index = get_cluster_index()
+    clusters = index.get(org_id, name)
+    if clusters and all(_is_visible(client, c) for c in clusters):
+        return clusters
+    clusters = load_from_metadata(client, name=name)
+    for cluster in clusters:
+        index.put(org_id, cluster)
+    return clusters
+
+
+def reconcile(config):
+    """Rebuild the cluster index from a listing of all clusters in vCD.
+
+    :param dict config: CSE config.
+    """
+    started_at = time.time()
+    entries = call_as_sysadmin(config, lambda client: [
+        (record.get('org').split(':')[-1], to_cluster(client, record))
+        for record in iter_cluster_records(
+            client, page_size=_RECONCILE_PAGE_SIZE)
+    ])
+    get_cluster_index().replace_all(entries, started_at)
+    LOGGER.debug('cluster index reconciled, %s clusters' % len(entries))
+
+
+class IndexReconciler(threading.Thread):
+    """Thread that periodically reconciles the cluster index with vCD."""
+
+    def __init__(self, config):
+        """Constructor for IndexReconciler.
+
+        :param dict config: CSE config.
+        """
+        super(IndexReconciler, self).__init__(name='ClusterIndexReconciler')
+        self.daemon = True
+        self.config = config
+        self.interval = config['service']['cluster_index_refresh_interval']
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                reconcile(self.config)
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
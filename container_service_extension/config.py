@@ -2,9 +2,14 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import time
 from urllib.parse import urlparse
 
 import click
+from humanfriendly import format_timespan
 import pika
 import requests
 import yaml
@@ -25,9 +30,17 @@ from vsphere_guest_run.vsphere import VSphere
 
 from container_service_extension.exceptions import AmqpConnectionError
 from container_service_extension.exceptions import AmqpError
+from container_service_extension.exceptions import TemplateCreationError
 from container_service_extension.logger import configure_install_logger
+from container_service_extension.logger import DEBUG_LOG_FORMATTER
+from container_service_extension.logger import \
+    get_template_install_log_filepath
 from container_service_extension.logger import INSTALL_LOGGER as LOGGER
 from container_service_extension.logger import INSTALL_LOG_FILEPATH
+from container_service_extension.logger import LogTagFilter
+from container_service_extension.logger import SERVER_LOGGER
+from container_service_extension.logger import use_log_tag
+from container_service_extension.task_tracker import wait_for_task
 from container_service_extension.utils import catalog_exists
 from container_service_extension.utils import catalog_item_exists
 from container_service_extension.utils import check_file_permissions
@@ -38,12 +51,13 @@ from container_service_extension.utils import EXCHANGE_TYPE
 from container_service_extension.utils import get_data_file
 from container_service_extension.utils import get_org
 from container_service_extension.utils import get_vdc
-from container_service_extension.utils import get_vsphere
 from container_service_extension.utils import SYSTEM_ORG_NAME
 from container_service_extension.utils import upload_ova_to_catalog
 from container_service_extension.utils import vgr_callback
 from container_service_extension.utils import wait_until_tools_ready
 from container_service_extension.utils import wait_for_catalog_item_to_resolve
+from container_service_extension.vsphere_pool import get_vsphere_pool
+from container_service_extension.vsphere_pool import vsphere_session
 
 # used for creating temp vapp
 TEMP_VAPP_NETWORK_ADAPTER_TYPE = 'vmxnet3'
@@ -94,7 +108,47 @@ SAMPLE_VCS_CONFIG = {
     }]
 }
 
-SAMPLE_SERVICE_CONFIG = {'service': {'listeners': 5}}
+# 'service' properties that older config files may not have. Missing
+# properties are filled in with these values when the config is validated.
+SERVICE_CONFIG_DEFAULTS = {
+    'cluster_index_refresh_interval': 300,
+    'guest_exec_workers': 10,
+    'join_token_ttl': 3600,
+    'kubeconfig_cache_size': 1024,
+    'max_concurrent_ops': {
+        'create_cluster': 5,
+        'create_nodes': 5,
+        'delete_cluster': 10,
+        'delete_nodes': 10
+    },
+    'metrics_host': '127.0.0.1',
+    'metrics_port': 0,
+    'org_concurrency_caps': {},
+    'org_max_concurrent_ops': 5,
+    'org_queue_size': 20,
+    'org_weights': {},
+    'prefetch_count': 50,
+    'reply_cache_ttl': 600,
+    'reply_store_path': 'cse-replies.db',
+    'request_workers': 50,
+    'sysadmin_pool_size': 10,
+    'sysadmin_session_ttl': 1200,
+    'template_refresh_interval': 600,
+    'tenant_session_cache_size': 1024,
+    'tenant_session_cache_ttl': 300,
+    'vm_ready_timeout': 600,
+    'vsphere_max_idle_sessions': 10,
+    'vsphere_session_idle_timeout': 600,
+    'worker_pool_size': 10,
+    'worker_queue_size': 100
+}
+
+SAMPLE_SERVICE_CONFIG = {
+    'service': {
+        'listeners': 1,
+        **SERVICE_CONFIG_DEFAULTS
+    }
+}
 
 SAMPLE_TEMPLATE_PHOTON_V2 = {
     'name': 'photon-v2',
@@ -190,16 +244,39 @@ def get_validated_config(config_file_name):
 
     click.secho(f"Validating config file '{config_file_name}'", fg='yellow')
     check_keys_and_value_types(config, SAMPLE_CONFIG, location='config file')
+    config['service'] = _with_defaults(config['service'],
+                                       SERVICE_CONFIG_DEFAULTS)
     validate_amqp_config(config['amqp'])
     validate_vcd_and_vcs_config(config['vcd'], config['vcs'])
     validate_broker_config(config['broker'])
-    check_keys_and_value_types(config['service'],
-                               SAMPLE_SERVICE_CONFIG['service'],
-                               location="config file 'service' section")
+    validate_service_config(config['service'])
     click.secho(f"Config file '{config_file_name}' is valid", fg='green')
     return config
 
 
+def _with_defaults(values, defaults):
+    """Fills in the properties missing from a section of the config file.
+
+    Nested dictionaries, such as 'max_concurrent_ops', are filled in key by
+    key, so that a config file may set only some of their properties.
+
+    :param dict values: section of the config file as a dict.
+    :param dict defaults: default values of the properties of the section.
+
+    :return: a new dict with the properties of @values, and the defaults of
+        the properties that @values doesn't have.
+
+    :rtype: dict
+    """
+    merged = copy.deepcopy(defaults)
+    for key, value in values.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _with_defaults(value, merged[key])
+        else:
+            merged[key] = value
+    return merged
+
+
 def validate_amqp_config(amqp_dict):
     """Ensures that 'amqp' section of config is correct.
 
@@ -330,6 +407,40 @@ def validate_broker_config(broker_dict):
         raise ValueError(msg)
 
 
+def validate_service_config(service_dict):
+    """Ensures that 'service' section of config is correct.
+
+    Checks that 'service' section of config has correct keys and value
+    types. Also checks that the weights in 'org_weights' are positive
+    numbers, and that 'sysadmin_pool_size' is a positive integer.
+
+    :param dict service_dict: 'service' section of config file as a dict,
+        with the default values filled in.
+
+    :raises KeyError: if @service_dict has missing or extra properties.
+    :raises ValueError: if the value type for a @service_dict property is
+        incorrect, if an org has a weight that is not a positive number,
+        or if 'sysadmin_pool_size' is not positive.
+    """
+    check_keys_and_value_types(service_dict,
+                               SAMPLE_SERVICE_CONFIG['service'],
+                               location="config file 'service' section")
+
+    for org_name, weight in service_dict['org_weights'].items():
+        if isinstance(weight, bool) or \
+                not isinstance(weight, (int, float)) or weight <= 0:
+            msg = f"Weight of org '{org_name}' in 'org_weights' should be " \
+                  f"a positive number"
+            click.secho(msg, fg='red')
+            raise ValueError(msg)
+
+    if service_dict['sysadmin_pool_size'] <= 0:
+        msg = "'sysadmin_pool_size' in config file 'service' section " \
+              "should be a positive integer"
+        click.secho(msg, fg='red')
+        raise ValueError(msg)
+
+
 def check_cse_installation(config, check_template='*'):
     """Ensures that CSE is installed on vCD according to the config file.
 
@@ -440,7 +551,7 @@ def check_cse_installation(config, check_template='*'):
 
 def install_cse(ctx, config_file_name='config.yaml', template_name='*',
                 update=False, no_capture=False, ssh_key=None,
-                amqp_install='prompt', ext_install='prompt'):
+                amqp_install='prompt', ext_install='prompt', parallel=1):
     """Handles logistics for CSE installation.
 
     Handles decision making for configuring AMQP exchange/settings,
@@ -461,6 +572,9 @@ def install_cse(ctx, config_file_name='config.yaml', template_name='*',
     :param str ext_install: 'prompt' asks the user if CSE should be registered
         to vCD. 'skip' does not register CSE to vCD. 'config' registers CSE
         to vCD without asking the user.
+    :param int parallel: number of templates to create concurrently. If
+        greater than 1, each template is created with its own vCD session,
+        and also logged to its own file.
 
     :raises AmqpError: if AMQP exchange could not be created.
     """
@@ -472,16 +586,7 @@ def install_cse(ctx, config_file_name='config.yaml', template_name='*',
     LOGGER.info(msg)
     client = None
     try:
-        client = Client(config['vcd']['host'],
-                        api_version=config['vcd']['api_version'],
-                        verify_ssl_certs=config['vcd']['verify'],
-                        log_file=INSTALL_LOG_FILEPATH,
-                        log_headers=True,
-                        log_bodies=True)
-        credentials = BasicLoginCredentials(config['vcd']['username'],
-                                            SYSTEM_ORG_NAME,
-                                            config['vcd']['password'])
-        client.set_credentials(credentials)
+        client = _connect_to_vcd(config)
         msg = f"Connected to vCD as system administrator: " \
               f"{config['vcd']['host']}:{config['vcd']['port']}"
         click.secho(msg, fg='green')
@@ -508,8 +613,17 @@ def install_cse(ctx, config_file_name='config.yaml', template_name='*',
         create_and_share_catalog(org, config['broker']['catalog'],
                                  catalog_desc='CSE templates')
         # create, customize, capture VM templates
-        for template in config['broker']['templates']:
-            if template_name == '*' or template['name'] == template_name:
+        templates = [
+            template for template in config['broker']['templates']
+            if template_name == '*' or template['name'] == template_name
+        ]
+        if parallel > 1 and len(templates) > 1:
+            create_templates_in_parallel(ctx, config, templates, parallel,
+                                         update=update,
+                                         no_capture=no_capture,
+                                         ssh_key=ssh_key)
+        else:
+            for template in templates:
                 create_template(ctx, client, config, template, update=update,
                                 no_capture=no_capture, ssh_key=ssh_key,
                                 org=org)
@@ -520,6 +634,132 @@ def install_cse(ctx, config_file_name='config.yaml', template_name='*',
     finally:
         if client is not None:
             client.logout()
+        # log out of the vCenter sessions used to customize the templates
+        get_vsphere_pool(config).clear()
+
+
+def _connect_to_vcd(config):
+    """Logs in to vCD as system administrator.
+
+    :param dict config: CSE config.
+
+    :return: logged-in client, to be logged out by the caller.
+
+    :rtype: pyvcloud.vcd.client.Client
+    """
+    client = Client(config['vcd']['host'],
+                    api_version=config['vcd']['api_version'],
+                    verify_ssl_certs=config['vcd']['verify'],
+                    log_file=INSTALL_LOG_FILEPATH,
+                    log_headers=True,
+                    log_bodies=True)
+    credentials = BasicLoginCredentials(config['vcd']['username'],
+                                        SYSTEM_ORG_NAME,
+                                        config['vcd']['password'])
+    client.set_credentials(credentials)
+    return client
+
+
+def create_templates_in_parallel(ctx, config, templates, parallel,
+                                 update=False, no_capture=False,
+                                 ssh_key=None):
+    """Creates templates concurrently, and reports how each one went.
+
+    Each template is created in its own thread, with its own vCD session,
+    and is logged both to the install log and to a log file of its own. At
+    most @parallel vCenter sessions are used at the same time, and they are
+    logged out once all the templates are done.
+    A template that fails doesn't stop the creation of the others.
+
+    :param click.core.Context ctx: click context object.
+    :param dict config: CSE config.
+    :param list templates: template sections of @config to create.
+    :param int parallel: maximum number of templates created at a time.
+    :param bool update: if True and templates already exist in vCD,
+        overwrites existing templates.
+    :param bool no_capture: if True, temporary vApps will not be captured
+        or destroyed.
+    :param str ssh_key: public ssh key to place into the template vApp(s).
+
+    :raises TemplateCreationError: if one or more of the templates could
+        not be created.
+    """
+    msg = f"Creating {len(templates)} templates, {parallel} at a time"
+    click.secho(msg, fg='yellow')
+    LOGGER.info(msg)
+    vsphere_pool = get_vsphere_pool(config)
+    # one vCenter session at most per template being created
+    vsphere_pool.set_max_sessions(parallel)
+    try:
+        with ThreadPoolExecutor(max_workers=parallel,
+                                thread_name_prefix='install') as executor:
+            futures = [
+                executor.submit(_create_template_in_thread, ctx, config,
+                                template, update, no_capture, ssh_key)
+                for template in templates
+            ]
+        results = [future.result() for future in futures]
+    finally:
+        vsphere_pool.set_max_sessions(None)
+        vsphere_pool.clear()
+
+    click.secho('Template creation summary:', fg='yellow')
+    LOGGER.info('Template creation summary:')
+    failed = []
+    for template, (error, duration, log_filepath) in zip(templates,
+                                                         results):
+        status = 'succeeded' if error is None else f"failed: {error}"
+        msg = f"  {template['name']}: {status} " \
+              f"({format_timespan(duration)}, log: {log_filepath})"
+        click.secho(msg, fg='green' if error is None else 'red')
+        LOGGER.info(msg)
+        if error is not None:
+            failed.append(template['name'])
+    if failed:
+        raise TemplateCreationError(failed)
+
+
+def _create_template_in_thread(ctx, config, template_config, update,
+                               no_capture, ssh_key):
+    """Creates a template with its own vCD session and log file.
+
+    :return: tuple of the error, or None if the template was created, the
+        number of seconds it took, and the path of its log file.
+
+    :rtype: tuple
+    """
+    name = template_config['name']
+    log_filepath = get_template_install_log_filepath(name)
+    # only records tagged with the template name go to its log file, which
+    # also gets the records of the helper threads, such as the task tracker,
+    # that log to the server logger
+    file_handler = logging.FileHandler(log_filepath)
+    file_handler.setFormatter(DEBUG_LOG_FORMATTER)
+    file_handler.addFilter(LogTagFilter(name))
+    LOGGER.addHandler(file_handler)
+    SERVER_LOGGER.addHandler(file_handler)
+    started_at = time.time()
+    client = None
+    error = None
+    with use_log_tag(name):
+        try:
+            client = _connect_to_vcd(config)
+            # each thread sets the client of its own context
+            template_ctx = click.Context(ctx.command, parent=ctx, obj={})
+            create_template(template_ctx, client, config, template_config,
+                            update=update, no_capture=no_capture,
+                            ssh_key=ssh_key)
+        except Exception as err:
+            LOGGER.error(f"Failed to create template '{name}'",
+                         exc_info=True)
+            error = err
+        finally:
+            if client is not None:
+                client.logout()
+            LOGGER.removeHandler(file_handler)
+            SERVER_LOGGER.removeHandler(file_handler)
+            file_handler.close()
+    return error, time.time() - started_at, log_filepath
 
 
 def create_template(ctx, client, config, template_config, update=False,
@@ -740,7 +980,7 @@ def _create_vapp_from_config(client, vdc, config, template_config,
         hostname=template_config['temp_vapp'],
         storage_profile=config['broker']['storage_profile'])
     task = vapp_sparse_resource.Tasks.Task[0]
-    client.get_task_monitor().wait_for_success(task)
+    wait_for_task(client, task)
     vdc.reload()
     # we don't do lazy loading here using vapp_sparse_resource.get('href'),
     # because VApp would have an uninitialized attribute (vapp.name)
@@ -767,8 +1007,8 @@ def _customize_vm(ctx, config, vapp, vm_name, cust_script, is_photon=False):
     """
     callback = vgr_callback(prepend_msg='Waiting for guest tools, status: "')
     if not is_photon:
-        vs = get_vsphere(config, vapp, vm_name, logger=LOGGER)
-        wait_until_tools_ready(vapp, vs, callback=callback)
+        with vsphere_session(config, vapp, vm_name, logger=LOGGER) as vs:
+            wait_until_tools_ready(vapp, vs, callback=callback)
 
         vapp.reload()
         task = vapp.shutdown()
@@ -778,22 +1018,21 @@ def _customize_vm(ctx, config, vapp, vm_name, cust_script, is_photon=False):
         stdout(task, ctx=ctx)
         vapp.reload()
 
-    vs = get_vsphere(config, vapp, vm_name, logger=LOGGER)
-    wait_until_tools_ready(vapp, vs, callback=callback)
-    password_auto = vapp.get_admin_password(vm_name)
-
     try:
-        result = vs.execute_script_in_guest(
-            vs.get_vm_by_moid(vapp.get_vm_moid(vm_name)),
-            'root',
-            password_auto,
-            cust_script,
-            target_file=None,
-            wait_for_completion=True,
-            wait_time=10,
-            get_output=True,
-            delete_script=True,
-            callback=vgr_callback())
+        with vsphere_session(config, vapp, vm_name, logger=LOGGER) as vs:
+            wait_until_tools_ready(vapp, vs, callback=callback)
+            password_auto = vapp.get_admin_password(vm_name)
+            result = vs.execute_script_in_guest(
+                vs.get_vm_by_moid(vapp.get_vm_moid(vm_name)),
+                'root',
+                password_auto,
+                cust_script,
+                target_file=None,
+                wait_for_completion=True,
+                wait_time=10,
+                get_output=True,
+                delete_script=True,
+                callback=vgr_callback())
     except Exception as err:
         # TODO replace raw exception with specific exception
         # unsure all errors execute_script_in_guest can result in
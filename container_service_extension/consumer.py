@@ -2,20 +2,48 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import asyncio
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import json
 import sys
 import threading
+import time
 import traceback
 
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import AMQP_REPLY_LATENCY
 from container_service_extension.processor import ServiceProcessor
+from container_service_extension.reply_store import BUSY
+from container_service_extension.reply_store import CLAIMED
+from container_service_extension.reply_store import get_reply_store
 from container_service_extension.utils import EXCHANGE_TYPE
 
+# seconds between checks of a request being processed by another listener
+REPLY_POLL_INTERVAL = 1
+
 
 class MessageConsumer(object):
+    """AMQP consumer of CSE API requests.
+
+    The connection runs on an asyncio event loop owned by the consumer.
+    Each request is processed on a pool of request_workers threads, so a
+    slow request doesn't hold back the others, and its reply is published
+    from the event loop once processing is done.
+
+    At most prefetch_count requests are delivered to the consumer before
+    they are acknowledged, which happens once their reply is published, so
+    requests in progress are redelivered if the server stops. Requests are
+    claimed in the reply store, shared by all the listeners and worker
+    processes and kept across restarts, before they are processed, and
+    their reply is kept there. A request delivered again, to any listener,
+    waits for the processing in progress, or is answered with the reply
+    kept, instead of being processed twice.
+    """
+
     def __init__(self,
                  host,
                  port,
@@ -27,7 +55,10 @@ class MessageConsumer(object):
                  routing_key,
                  config,
                  verify,
-                 log=False):
+                 log=False,
+                 request_workers=50,
+                 prefetch_count=50,
+                 reply_store=None):
         self._connection = None
         self._channel = None
         self._closing = False
@@ -47,6 +78,17 @@ class MessageConsumer(object):
         self.service_processor = ServiceProcessor(self.config, self.verify,
                                                   self.log)
         self.fsencoding = sys.getfilesystemencoding()
+        self.request_workers = request_workers
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=request_workers, thread_name_prefix='RequestWorker')
+        self._in_flight = set()
+        self.prefetch_count = prefetch_count
+        self._reply_store = reply_store or get_reply_store(config)
+        # processing in progress in this consumer, by request id. Only used
+        # on the event loop, so not locked.
+        self._processing = {}
+        self._stopped = threading.Event()
 
     def connect(self):
         LOGGER.info('Connecting to %s:%s' % (self.host, self.port))
@@ -60,8 +102,11 @@ class MessageConsumer(object):
             connection_attempts=3,
             retry_delay=2,
             socket_timeout=5)
-        return pika.SelectConnection(
-            parameters, self.on_connection_open, stop_ioloop_on_close=False)
+        return AsyncioConnection(
+            parameters,
+            self.on_connection_open,
+            stop_ioloop_on_close=False,
+            custom_ioloop=self._loop)
 
     def on_connection_open(self, unused_connection):
         LOGGER.debug('Connection opened')
@@ -82,11 +127,9 @@ class MessageConsumer(object):
             self._connection.add_timeout(5, self.reconnect)
 
     def reconnect(self):
-        self._connection.ioloop.stop()
-
+        # the event loop keeps running, the new connection is added to it
         if not self._closing:
             self._connection = self.connect()
-            self._connection.ioloop.start()
 
     def open_channel(self):
         LOGGER.debug('Creating a new channel')
@@ -138,6 +181,11 @@ class MessageConsumer(object):
     def start_consuming(self):
         LOGGER.debug('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
+        self._channel.basic_qos(self.on_basic_qos_ok,
+                                prefetch_count=self.prefetch_count)
+
+    def on_basic_qos_ok(self, unused_frame):
+        LOGGER.debug('QOS set to: %d', self.prefetch_count)
         self._consumer_tag = self._channel.basic_consume(
             self.on_message, self.queue)
 
@@ -151,17 +199,108 @@ class MessageConsumer(object):
         if self._channel:
             self._channel.close()
 
-    def on_message(self, unused_channel, basic_deliver, properties, body):
-        self.acknowledge_message(basic_deliver.delivery_tag)
+    def on_message(self, channel, basic_deliver, properties, body):
+        received_at = time.time()
+        future = asyncio.ensure_future(
+            self.handle_message(channel, basic_deliver, properties, body,
+                                received_at),
+            loop=self._loop)
+        # the loop only keeps weak references to its tasks
+        self._in_flight.add(future)
+        future.add_done_callback(self._in_flight.discard)
+
+    async def handle_message(self, channel, basic_deliver, properties, body,
+                             received_at):
+        """Process a request on a worker thread, then publish its reply.
+
+        Runs on the event loop.
+        """
+        delivery_tag = basic_deliver.delivery_tag
         try:
             body_json = json.loads(body.decode(self.fsencoding))[0]
+            request_id = body_json['id']
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+            # redelivering a malformed message would fail the same way
+            self.reject_message(channel, delivery_tag)
+            return
+        if request_id in self._processing:
+            LOGGER.info('Request %s is already being processed', request_id)
+            reply = await self._processing[request_id]
+        else:
+            reply = await self._claim(request_id)
+        if reply is None:
+            processing = self._loop.run_in_executor(
+                self._executor, self.process_message, basic_deliver,
+                properties, body_json)
+            self._processing[request_id] = processing
+            try:
+                reply = await processing
+                await self._loop.run_in_executor(
+                    self._executor, self._reply_store.put, request_id, reply)
+            except Exception:
+                await self._loop.run_in_executor(
+                    self._executor, self._reply_store.release, request_id)
+                raise
+            finally:
+                del self._processing[request_id]
+        if properties.reply_to is not None:
+            self.publish_reply(properties, body_json, *reply)
+            AMQP_REPLY_LATENCY.observe(time.time() - received_at)
+        self.acknowledge_message(delivery_tag, channel=channel)
+
+    async def _claim(self, request_id):
+        """Claim a request in the reply store.
+
+        Runs on the event loop. If another listener is processing the
+        request, waits until it is done.
+
+        :return: the reply to the request if it was already processed, or
+            None if the request was claimed and must be processed.
+
+        :rtype: tuple
+        """
+        while True:
+            state, reply = await self._loop.run_in_executor(
+                self._executor, self._reply_store.claim, request_id)
+            if state == CLAIMED:
+                return None
+            if state != BUSY:
+                LOGGER.info('Replying to redelivered request %s with the '
+                            'reply kept', request_id)
+                return reply
+            LOGGER.debug('Request %s is being processed by another '
+                         'listener', request_id)
+            await asyncio.sleep(REPLY_POLL_INTERVAL)
+
+    def process_message(self, basic_deliver, properties, body_json):
+        """Process a request.
+
+        Runs on a worker thread.
+
+        :return: tuple of the serialized reply body, as bytes, the reply
+            status code, and the reply content type and additional reply
+            headers, if set by the request handler.
+
+        :rtype: tuple
+        """
+        content_type = None
+        headers = None
+        try:
             LOGGER.debug('Received message # %s from %s (%s): %s, props: %s',
                          basic_deliver.delivery_tag, properties.app_id,
                          threading.currentThread().ident,
                          json.dumps(body_json), properties)
             result = self.service_processor.process_request(body_json)
             status_code = result['status_code']
-            reply_body = json.dumps(result['body'])
+            content_type = result.get('content_type')
+            headers = result.get('headers')
+            if content_type is not None:
+                # the body is already serialized, e.g. plain text metrics or
+                # the swagger spec
+                reply_body = result['body']
+            else:
+                reply_body = json.dumps(result['body'])
             if status_code == 500 and \
                reply_body == '[]' and \
                'message' in result:
@@ -171,35 +310,61 @@ class MessageConsumer(object):
             status_code = 500
             tb = traceback.format_exc()
             LOGGER.error(tb)
-
-        if properties.reply_to is not None:
-            reply_msg = {
-                'id':
-                body_json['id'],
-                'headers': {
-                    'Content-Type': body_json['headers']['Accept'],
-                    'Content-Length': len(reply_body)
-                },
-                'statusCode':
-                status_code,
-                'body':
-                base64.b64encode(reply_body.encode()).decode(self.fsencoding),
-                'request':
-                False
-            }
-            LOGGER.debug('reply: %s', json.dumps(reply_body))
-            reply_properties = pika.BasicProperties(
-                correlation_id=properties.correlation_id)
-            result = self._channel.basic_publish(
-                exchange=properties.headers['replyToExchange'],
-                routing_key=properties.reply_to,
-                body=json.dumps(reply_msg),
-                properties=reply_properties)
-
-    def acknowledge_message(self, delivery_tag):
+        if isinstance(reply_body, str):
+            reply_body = reply_body.encode()
+        return reply_body, status_code, content_type, headers
+
+    def publish_reply(self, properties, body_json, reply_body, status_code,
+                      content_type, headers=None):
+        """Publish the reply to a request.
+
+        Must be called on the event loop, which owns the channel.
+        """
+        if self._channel is None:
+            LOGGER.error('channel closed, dropping reply to request %s',
+                         body_json['id'])
+            return
+        reply_headers = {
+            'Content-Type': content_type or body_json['headers']['Accept'],
+            'Content-Length': len(reply_body)
+        }
+        reply_headers.update(headers or {})
+        reply_msg = {
+            'id':
+            body_json['id'],
+            'headers':
+            reply_headers,
+            'statusCode':
+            status_code,
+            'body':
+            base64.b64encode(reply_body).decode(self.fsencoding),
+            'request':
+            False
+        }
+        LOGGER.debug('reply: %s', reply_body)
+        reply_properties = pika.BasicProperties(
+            correlation_id=properties.correlation_id)
+        self._channel.basic_publish(
+            exchange=properties.headers['replyToExchange'],
+            routing_key=properties.reply_to,
+            body=json.dumps(reply_msg),
+            properties=reply_properties)
+
+    def acknowledge_message(self, delivery_tag, channel=None):
+        if channel is not None and channel is not self._channel:
+            # delivery tags are per channel: the message was delivered on a
+            # channel that has been closed since, and will be redelivered
+            LOGGER.debug('Not acknowledging message %s of a closed channel',
+                         delivery_tag)
+            return
         LOGGER.debug('Acknowledging message %s', delivery_tag)
         self._channel.basic_ack(delivery_tag)
 
+    def reject_message(self, channel, delivery_tag):
+        if channel is self._channel:
+            LOGGER.debug('Rejecting message %s', delivery_tag)
+            self._channel.basic_reject(delivery_tag, requeue=False)
+
     def stop_consuming(self):
         if self._channel:
             LOGGER.info('Sending a Basic.Cancel RPC command to RabbitMQ')
@@ -208,6 +373,16 @@ class MessageConsumer(object):
     def on_cancelok(self, unused_frame):
         LOGGER.debug('RabbitMQ acknowledged the cancellation'
                      'of the consumer')
+        if self._in_flight:
+            # let requests being processed publish their reply and be
+            # acknowledged first
+            asyncio.ensure_future(self._close_channel_when_done(),
+                                  loop=self._loop)
+        else:
+            self.close_channel()
+
+    async def _close_channel_when_done(self):
+        await asyncio.wait(list(self._in_flight))
         self.close_channel()
 
     def close_channel(self):
@@ -215,16 +390,34 @@ class MessageConsumer(object):
         self._channel.close()
 
     def run(self):
-        self._connection = self.connect()
-        self._connection.ioloop.start()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+        finally:
+            self._executor.shutdown(wait=False)
+            self._stopped.set()
+
+    def stop(self, timeout=10):
+        """Stop consuming and close the connection.
 
-    def stop(self):
+        Can be called from any thread. Waits up to @timeout seconds for the
+        event loop to stop.
+        """
         LOGGER.info('Stopping')
         self._closing = True
-        self.stop_consuming()
-        self._connection.ioloop.start()
+        if not self._stopped.is_set():
+            self._loop.call_soon_threadsafe(self._shutdown)
+            self._stopped.wait(timeout)
         LOGGER.info('Stopped')
 
+    def _shutdown(self):
+        if self._channel:
+            self.stop_consuming()
+        else:
+            # reconnecting, there is nothing to cancel
+            self._loop.stop()
+
     def close_connection(self):
         LOGGER.info('Closing connection')
         self._connection.close()
@@ -207,8 +207,18 @@ def check(ctx, config, check_install, template):
     default='prompt',
     type=click.Choice(['prompt', 'skip', 'config']),
     help='API Extension configuration')
+@click.option(
+    '-p',
+    '--parallel',
+    'parallel',
+    type=click.IntRange(min=1),
+    default=1,
+    required=False,
+    metavar='<count>',
+    help='Number of templates to create concurrently, each logged to its '
+         'own file as well')
 def install(ctx, config, template, update, no_capture, ssh_key_file,
-            amqp_install, ext_install):
+            amqp_install, ext_install, parallel):
     """Install CSE on vCloud Director."""
     if no_capture and ssh_key_file is None:
         click.echo('Must provide ssh-key file (using --ssh-key OR -k) if '
@@ -220,7 +230,8 @@ def install(ctx, config, template, update, no_capture, ssh_key_file,
             ssh_key = ssh_key_file.read()
         install_cse(ctx, config_file_name=config, template_name=template,
                     update=update, no_capture=no_capture, ssh_key=ssh_key,
-                    amqp_install=amqp_install, ext_install=ext_install)
+                    amqp_install=amqp_install, ext_install=ext_install,
+                    parallel=parallel)
 
 
 @cli.command(short_help='run service')
@@ -241,9 +252,19 @@ def install(ctx, config, template, update, no_capture, ssh_key_file,
     default=False,
     required=False,
     help='Skip check')
-def run(ctx, config, skip_check):
+@click.option(
+    '-w',
+    '--workers',
+    'workers',
+    type=click.IntRange(min=1),
+    default=1,
+    required=False,
+    metavar='<workers>',
+    help='Number of worker processes')
+def run(ctx, config, skip_check, workers):
     """Run CSE service."""
-    service = Service(config, should_check_config=not skip_check)
+    service = Service(config, should_check_config=not skip_check,
+                      workers=workers)
     service.run()
 
 
@@ -8,6 +8,14 @@ class CseServerError(VcdException):
     """Base class for cse server side operation related exceptions"""
 
 
+class ServiceBusyError(CseServerError):
+    """Raised when CSE has no capacity left to accept an operation"""
+
+
+class BadRequestError(CseServerError):
+    """Raised when a request is malformed, e.g. misses a required header"""
+
+
 class CseClientError(Exception):
     """Raised for any client side error"""
 
@@ -63,6 +71,16 @@ class DeleteNodeError(NodeOperationError):
     """ Raised when there is any error while deleting node """
 
 
+class TemplateCreationError(CseServerError):
+    """Raised when one or more templates could not be created"""
+
+    def __init__(self, template_names):
+        self.template_names = template_names
+
+    def __str__(self):
+        return f"Failed to create template(s): {self.template_names}"
+
+
 class AmqpError(Exception):
     """Base class for Amqp related errors"""
 
@@ -0,0 +1,90 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import hashlib
+import threading
+
+from cachetools import LRUCache
+from cryptography.fernet import Fernet
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class KubeconfigCache(object):
+    """In-memory cache of cluster kubeconfigs, by cluster id.
+
+    Kubeconfigs hold cluster admin credentials, so they are kept encrypted,
+    with a key generated when the cache is created and never written out.
+    Each kubeconfig has a version, derived from its content, that changes
+    when the kubeconfig is rotated.
+    """
+
+    def __init__(self, maxsize=1024):
+        """Constructor for KubeconfigCache.
+
+        :param int maxsize: maximum number of kubeconfigs kept. The least
+            recently used ones are dropped first.
+        """
+        self._fernet = Fernet(Fernet.generate_key())
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, cluster_id):
+        """Get the kubeconfig of a cluster.
+
+        :param str cluster_id: id of the cluster.
+
+        :return: tuple of the kubeconfig and its version, or None if the
+            kubeconfig of the cluster is not cached.
+
+        :rtype: tuple
+        """
+        with self._lock:
+            entry = self._cache.get(cluster_id)
+        if entry is None:
+            return None
+        token, version = entry
+        return self._fernet.decrypt(token).decode(), version
+
+    def put(self, cluster_id, kubeconfig):
+        """Add or replace the kubeconfig of a cluster.
+
+        :param str cluster_id: id of the cluster.
+        :param str kubeconfig: the kubeconfig.
+
+        :return: the version of the kubeconfig.
+
+        :rtype: str
+        """
+        data = kubeconfig.encode()
+        version = hashlib.sha256(data).hexdigest()[:16]
+        token = self._fernet.encrypt(data)
+        with self._lock:
+            self._cache[cluster_id] = (token, version)
+        return version
+
+    def remove(self, cluster_id):
+        """Remove the kubeconfig of a cluster, if it is cached.
+
+        :param str cluster_id: id of the cluster.
+        """
+        with self._lock:
+            self._cache.pop(cluster_id, None)
+
+
+def get_kubeconfig_cache(config):
+    """Get the process-wide kubeconfig cache.
+
+    :param dict config: CSE config, used to size the cache the first time
+        it is requested.
+
+    :rtype: KubeconfigCache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = KubeconfigCache(
+                maxsize=config['service']['kubeconfig_cache_size'])
+        return _cache
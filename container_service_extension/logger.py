@@ -1,8 +1,11 @@
+from contextlib import contextmanager
 import datetime
 import logging
-from pathlib import Path
-
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
 from logging.handlers import RotatingFileHandler
+from pathlib import Path
+import threading
 
 # max size for log files (8MB)
 _MAX_BYTES = 2**23
@@ -37,6 +40,10 @@ def run_once(f):
     return wrapper
 
 
+# tag of the log records of each thread, see use_log_tag()
+_local = threading.local()
+
+
 # cse install logger and config
 # cse installation logs to: cse-logs/cse-install_year-mo-day_hr-min-sec.log
 INSTALL_LOGGER_NAME = 'container_service_extension.install'
@@ -63,6 +70,13 @@ SERVER_INFO_LOG_FILEPATH = f"{LOGS_DIR_NAME}/cse-server-info.log"
 SERVER_DEBUG_LOG_FILEPATH = f"{LOGS_DIR_NAME}/cse-server-debug.log"
 SERVER_LOGGER = logging.getLogger(SERVER_LOGGER_NAME)
 
+# cse server trace logger and config
+# cse server writes tracing spans, one JSON object per line, to:
+# cse-logs/cse-server-traces.jsonl
+TRACE_LOGGER_NAME = 'container_service_extension.trace'
+TRACE_LOG_FILEPATH = f"{LOGS_DIR_NAME}/cse-server-traces.jsonl"
+TRACE_LOGGER = logging.getLogger(TRACE_LOGGER_NAME)
+
 
 @run_once
 def configure_install_logger():
@@ -74,6 +88,65 @@ def configure_install_logger():
     INSTALL_LOGGER.addHandler(file_handler)
 
 
+def current_log_tag():
+    """Get the log tag of the calling thread.
+
+    :return: the tag, or None if the thread's records are not tagged.
+
+    :rtype: str
+    """
+    return getattr(_local, 'log_tag', None)
+
+
+@contextmanager
+def use_log_tag(tag):
+    """Tag the log records of the calling thread for a block.
+
+    Threads that do work handed over by another one, such as the guest exec
+    workers or the task tracker, use the current_log_tag() of that thread,
+    so that their records go to the same log files.
+
+    :param str tag: tag of the records, or None.
+    """
+    previous = current_log_tag()
+    _local.log_tag = tag
+    try:
+        yield
+    finally:
+        _local.log_tag = previous
+
+
+class LogTagFilter(logging.Filter):
+    """Filter that only keeps the records logged with a given tag."""
+
+    def __init__(self, tag):
+        """Constructor for LogTagFilter.
+
+        :param str tag: tag of the records to keep.
+        """
+        super(LogTagFilter, self).__init__()
+        self.tag = tag
+
+    def filter(self, record):
+        # filters run in the thread that logs the record
+        return current_log_tag() == self.tag
+
+
+def get_template_install_log_filepath(template_name):
+    """Gets the install log file of a template created in parallel.
+
+    Templates created in parallel are also logged, each on its own, to:
+    cse-logs/cse-install_year-mo-day_hr-min-sec_<template-name>.log
+    The records of a template are the ones tagged with its name, see
+    use_log_tag().
+
+    :param str template_name: name of the template.
+
+    :rtype: str
+    """
+    return f"{LOGS_DIR_NAME}/cse-install_{_TIMESTAMP}_{template_name}.log"
+
+
 @run_once
 def configure_client_logger():
     """Configures cse client logger if it is not configured."""
@@ -115,3 +188,59 @@ def configure_server_logger():
     pika_logger.setLevel(logging.WARNING)
     pika_logger.addHandler(info_file_handler)
     pika_logger.addHandler(debug_file_handler)
+
+    trace_file_handler = RotatingFileHandler(TRACE_LOG_FILEPATH,
+                                             maxBytes=_MAX_BYTES,
+                                             backupCount=_BACKUP_COUNT)
+    trace_file_handler.setFormatter(logging.Formatter(fmt='%(message)s'))
+    TRACE_LOGGER.setLevel(logging.INFO)
+    TRACE_LOGGER.propagate = False
+    TRACE_LOGGER.addHandler(trace_file_handler)
+
+
+class _LoggerHandler(logging.Handler):
+    """Handler that passes records to the handlers of their own logger."""
+
+    def handle(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def start_server_log_listener(queue):
+    """Writes the server logs of the worker processes sent to a queue.
+
+    The records are written by the handlers that configure_server_logger()
+    set up in this process, so that the log files are only written to by
+    one process.
+
+    :param multiprocessing.Queue queue: queue the worker processes send
+        their log records to.
+
+    :return: the started listener, to be stopped once the worker processes
+        are done.
+
+    :rtype: logging.handlers.QueueListener
+    """
+    listener = QueueListener(queue, _LoggerHandler())
+    listener.start()
+    return listener
+
+
+def forward_server_logs(queue):
+    """Sends the server logs of this worker process to a queue.
+
+    Sets up the cse server, pika and trace loggers as
+    configure_server_logger() does, with a handler sending to the queue
+    instead of the file handlers.
+
+    :param multiprocessing.Queue queue: queue read by the listener of
+        start_server_log_listener().
+    """
+    queue_handler = QueueHandler(queue)
+    SERVER_LOGGER.setLevel(logging.DEBUG)
+    logging.getLogger('pika').setLevel(logging.WARNING)
+    TRACE_LOGGER.setLevel(logging.INFO)
+    TRACE_LOGGER.propagate = False
+    for logger in (SERVER_LOGGER, logging.getLogger('pika'), TRACE_LOGGER):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
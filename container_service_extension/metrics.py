@@ -0,0 +1,332 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Runtime metrics of the CSE server, in the Prometheus text format."""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.tracing import record_span
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+LONG_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0,
+                1800.0, 3600.0)
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('%s expects labels %s, got %s' %
+                             (self.name, self.labelnames, tuple(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (n, _escape(v))
+                                 for n, v in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, per set of label values."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super(Counter, self).__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['%s%s %s' % (self.name, self._labels(k), _number(v))
+                for k, v in values]
+
+
+class Gauge(_Metric):
+    """Value read from a callback each time the metrics are collected.
+
+    The callback returns a list of (labels, value) tuples, where labels is
+    a dictionary of label values.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _samples(self):
+        if self.callback is None:
+            return []
+        try:
+            values = self.callback()
+        except Exception:
+            LOGGER.debug('cannot collect %s' % self.name, exc_info=True)
+            return []
+        return ['%s%s %s' % (self.name, self._labels(self._key(labels)),
+                             _number(v))
+                for labels, v in values]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, per set of label values."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # bucket counts, sum and count of the observed values
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block, in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((k, (list(c), s, n))
+                            for k, (c, s, n) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in values:
+            for bound, n in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %s' % (
+                    self.name, self._labels(key, [('le', _number(bound))]),
+                    n))
+            lines.append('%s_bucket%s %s' % (
+                self.name, self._labels(key, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (self.name, self._labels(key),
+                                          _number(total)))
+            lines.append('%s_count%s %s' % (self.name, self._labels(key),
+                                            count))
+        return lines
+
+
+class Registry(object):
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def merge(texts):
+    """Merge the metrics rendered by several processes.
+
+    Samples with the same name and labels are summed, so that counters,
+    gauges and histograms hold the totals of all the processes.
+
+    :param iterable texts: outputs of Registry.render().
+
+    :return: the merged metrics, in the Prometheus text exposition format.
+
+    :rtype: str
+    """
+    # header lines and sample values by metric name, in order of appearance
+    families = {}
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                headers, samples = families.setdefault(name, ([], {}))
+                if not headers:
+                    headers.append(line)
+            elif line.startswith('# TYPE '):
+                if len(headers) == 1:
+                    headers.append(line)
+            elif line:
+                sample, value = line.rsplit(' ', 1)
+                try:
+                    value = int(value)
+                except ValueError:
+                    value = float(value)
+                samples[sample] = samples.get(sample, 0) + value
+    lines = []
+    for headers, samples in families.values():
+        lines.extend(headers)
+        lines.extend('%s %s' % (sample, _number(value))
+                     for sample, value in samples.items())
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+REQUESTS = Counter(
+    'cse_requests_total',
+    'Number of API requests processed, by route and status code.',
+    ['route', 'status'])
+REQUEST_DURATION = Histogram(
+    'cse_request_duration_seconds',
+    'Time spent processing API requests, by route.',
+    ['route'])
+AMQP_REPLY_LATENCY = Histogram(
+    'cse_amqp_reply_latency_seconds',
+    'Time from consuming a request message to publishing its reply.')
+BROKER_PHASE_DURATION = Histogram(
+    'cse_broker_phase_duration_seconds',
+    'Duration of the phases of broker operations, by operation and phase.',
+    ['operation', 'phase'],
+    buckets=LONG_BUCKETS)
+VCD_REQUEST_DURATION = Histogram(
+    'cse_vcd_request_duration_seconds',
+    'Latency of requests made to vCD, by HTTP method and status code.',
+    ['method', 'status'])
+VCENTER_LOGIN_DURATION = Histogram(
+    'cse_vcenter_login_duration_seconds',
+    'Time taken to log in to vCenter.')
+GUEST_OPERATION_DURATION = Histogram(
+    'cse_guest_operation_duration_seconds',
+    'Duration of guest operations on cluster VMs, by operation.',
+    ['operation'],
+    buckets=LONG_BUCKETS)
+
+
+def record_vcd_response(response, *args, **kwargs):
+    """Record the latency of a vCD request, and a tracing span for it.
+
+    Meant to be added to the 'response' hooks of the requests session of a
+    pyvcloud client.
+
+    :param requests.Response response: response received from vCD.
+    """
+    elapsed = response.elapsed.total_seconds()
+    method = response.request.method
+    VCD_REQUEST_DURATION.observe(elapsed, method=method,
+                                 status=response.status_code)
+    now = time.time()
+    record_span('vcd %s' % method, now - elapsed, now, attributes={
+        'http.method': method,
+        'http.url': response.request.url,
+        'http.status_code': response.status_code
+    })
+
+
+def instrument_client(client):
+    """Record the latency of the requests made by a pyvcloud client.
+
+    Must be called again whenever the client logs in, as that replaces its
+    requests session.
+
+    :param pyvcloud.vcd.client.Client client: logged-in client.
+    """
+    session = client._session
+    if session is not None and \
+            record_vcd_response not in session.hooks['response']:
+        session.hooks['response'].append(record_vcd_response)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        content = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        LOGGER.debug('metrics: ' + format % args)
+
+
+def start_metrics_server(host, port):
+    """Serve the metrics over HTTP on a background thread.
+
+    :param str host: address to listen on.
+    :param int port: port to listen on.
+
+    :return: the HTTP server, to be stopped with shutdown().
+
+    :rtype: http.server.HTTPServer
+    """
+    server = _ThreadingHTTPServer((host, port), _MetricsHandler)
+    t = threading.Thread(name='MetricsServer', target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    LOGGER.info('serving metrics on http://%s:%s/metrics' % (host, port))
+    return server
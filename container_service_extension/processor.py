@@ -3,24 +3,49 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import base64
+import functools
+import hashlib
 import json
 import sys
+import threading
 import traceback
+from urllib.parse import parse_qs
 
 from pkg_resources import resource_string
+from pyvcloud.vcd.exceptions import UnauthorizedException
 import yaml
 
 from container_service_extension.broker import get_new_broker
+from container_service_extension.client_pool import get_tenant_cache
+from container_service_extension.exceptions import BadRequestError
 from container_service_extension.exceptions import CseServerError
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import REQUEST_DURATION
+from container_service_extension.metrics import REQUESTS
+from container_service_extension.router import Request
+from container_service_extension.router import Router
+from container_service_extension.template_registry import \
+    get_template_registry
+from container_service_extension.tracing import span
 
 
 OK = 200
 CREATED = 201
 ACCEPTED = 202
+NOT_MODIFIED = 304
+BAD_REQUEST = 400
 UNAUTHORIZED = 401
 INTERNAL_SERVER_ERROR = 500
 
+SPEC_CONTENT_TYPES = {
+    'swagger': 'application/json',
+    'swagger.json': 'application/json',
+    'swagger.yaml': 'application/x-yaml'
+}
+
+_specs = None
+_specs_lock = threading.Lock()
+
 
 class ServiceProcessor(object):
     def __init__(self, config, verify, log):
@@ -28,43 +53,52 @@ class ServiceProcessor(object):
         self.verify = verify
         self.log = log
         self.fsencoding = sys.getfilesystemencoding()
+        self._service = None
+        self.router = self._build_router()
+        try:
+            load_specs()
+        except Exception:
+            LOGGER.error(traceback.format_exc())
+
+    def _build_router(self):
+        router = Router(prefix='/api', middleware=[self._instrument])
+        enabled = [self._require_enabled]
+        for format in SPEC_CONTENT_TYPES:
+            router.add_route('GET', '/cse/%s' % format,
+                             functools.partial(self.get_spec, format=format),
+                             middleware=enabled + [self._conditional_get])
+        router.add_route('GET', '/cse/template', self.list_templates,
+                         middleware=enabled)
+        router.add_route('GET', '/cse/system', self.get_system_info)
+        router.add_route('PUT', '/cse/system', self.update_system_status)
+        router.add_route('GET', '/cse/system/metrics', self.get_metrics)
+        router.add_route('GET', '/cse', self.list_clusters,
+                         middleware=enabled)
+        router.add_route('POST', '/cse', self.create_cluster,
+                         middleware=enabled)
+        router.add_route('GET', '/cse/{cluster}/config',
+                         self.get_cluster_config, middleware=enabled)
+        router.add_route('GET', '/cse/{cluster}/info', self.get_cluster_info,
+                         middleware=enabled)
+        router.add_route('DELETE', '/cse/{cluster}', self.delete_cluster,
+                         middleware=enabled)
+        router.add_route('POST', '/cse/{cluster}/node', self.create_nodes,
+                         middleware=enabled)
+        router.add_route('DELETE', '/cse/{cluster}/node', self.delete_nodes,
+                         middleware=enabled)
+        router.add_route('GET', '/cse/{cluster}/{node}/info',
+                         self.get_node_info, middleware=enabled)
+        return router
+
+    @property
+    def service(self):
+        if self._service is None:
+            from container_service_extension.service import Service
+            self._service = Service()
+        return self._service
 
     def process_request(self, body):
         LOGGER.debug('body: %s' % json.dumps(body))
-        reply = {}
-        tokens = body['requestUri'].split('/')
-        cluster_name = None
-        node_name = None
-        spec_request = False
-        config_request = False
-        template_request = False
-        node_request = False
-        cluster_info_request = False
-        node_info_request = False
-        system_request = False
-        if len(tokens) > 3:
-            if tokens[3] in ['swagger', 'swagger.json', 'swagger.yaml']:
-                spec_request = True
-            elif tokens[3] == 'template':
-                template_request = True
-            elif tokens[3] == 'system':
-                system_request = True
-            elif tokens[3] != '':
-                cluster_name = tokens[3]
-        if len(tokens) > 4:
-            if cluster_name is not None:
-                if tokens[4] == 'config':
-                    config_request = True
-                elif tokens[4] == 'info':
-                    cluster_info_request = True
-                elif tokens[4] == 'node':
-                    node_request = True
-                elif tokens[4] != '':
-                    node_name = tokens[4]
-        if len(tokens) > 5:
-            if node_name is not None:
-                if tokens[5] == 'info':
-                    node_info_request = True
         if len(body['body']) > 0:
             try:
                 request_body = json.loads(
@@ -75,90 +109,124 @@ class ServiceProcessor(object):
         else:
             request_body = None
         LOGGER.debug('request body: %s' % json.dumps(request_body))
-        from container_service_extension.service import Service
-        service = Service()
-        if not system_request and not service.is_enabled:
+        query_params = {
+            k: v[0]
+            for k, v in parse_qs(body.get('queryString') or '').items()
+        }
+        request = Request(body['method'], body['requestUri'],
+                          headers=body['headers'], body=request_body,
+                          query=query_params, request_id=body.get('id'))
+        reply = self.router.dispatch(request)
+        LOGGER.debug('reply: %s' % str(reply))
+        return reply
+
+    def _instrument(self, request, route, call_next):
+        """Middleware recording metrics and a tracing span per request."""
+        status = INTERNAL_SERVER_ERROR
+        attributes = {'cse.request.id': request.id}
+        try:
+            with REQUEST_DURATION.time(route=route.name), \
+                    span(route.name, attributes=attributes):
+                try:
+                    reply = call_next(request)
+                except BadRequestError as e:
+                    reply = {
+                        'status_code': BAD_REQUEST,
+                        'body': {'message': str(e)}
+                    }
+            status = reply.get('status_code', OK)
+        except UnauthorizedException:
+            status = UNAUTHORIZED
+            get_tenant_cache(self.config).invalidate(request.headers)
+            raise
+        finally:
+            REQUESTS.inc(route=route.name, status=status)
+        if status == UNAUTHORIZED:
+            # the cached tenant session is no longer accepted by vCD
+            get_tenant_cache(self.config).invalidate(request.headers)
+        return reply
+
+    def _require_enabled(self, request, route, call_next):
+        """Middleware rejecting requests while the service is disabled."""
+        if not self.service.is_enabled:
             raise CseServerError('CSE service is disabled. '
                                  'Contact the System Administrator.')
+        return call_next(request)
 
-        if body['method'] == 'GET':
-            if spec_request:
-                reply = self.get_spec(tokens[3])
-            elif config_request:
-                broker = get_new_broker(self.config)
-                reply = broker.get_cluster_config(cluster_name,
-                                                  body['headers'])
-            elif template_request:
-                result = {}
-                templates = []
-                for t in self.config['broker']['templates']:
-                    is_default = \
-                        t['name'] == self.config['broker']['default_template']
-                    templates.append({
-                        'name':
-                        t['name'],
-                        'is_default':
-                        is_default,
-                        'catalog':
-                        self.config['broker']['catalog'],
-                        'catalog_item':
-                        t['catalog_item'],
-                        'description':
-                        t['description']
-                    })
-                result['body'] = templates
-                result['status_code'] = 200
-                reply = result
-            elif cluster_info_request:
-                broker = get_new_broker(self.config)
-                reply = broker.get_cluster_info(cluster_name, body['headers'],
-                                                request_body)
-            elif node_info_request:
-                broker = get_new_broker(self.config)
-                reply = broker.get_node_info(cluster_name,
-                                             node_name,
-                                             body['headers'])
-            elif system_request:
-                result = {}
-                result['body'] = service.info(body['headers'])
-                result['status_code'] = OK
-                reply = result
-            elif cluster_name is None:
-                broker = get_new_broker(self.config)
-                reply = broker.list_clusters(body['headers'], request_body)
-        elif body['method'] == 'POST':
-            if cluster_name is None:
-                broker = get_new_broker(self.config)
-                reply = broker.create_cluster(body['headers'], request_body)
-            else:
-                if node_request:
-                    broker = get_new_broker(self.config)
-                    reply = broker.create_nodes(body['headers'], request_body)
-        elif body['method'] == 'PUT':
-            if system_request:
-                reply = service.update_status(body['headers'], request_body)
-        elif body['method'] == 'DELETE':
-            if node_request:
-                broker = get_new_broker(self.config)
-                reply = broker.delete_nodes(body['headers'], request_body)
-            else:
-                broker = get_new_broker(self.config)
-                on_the_fly_request_body = {'name': cluster_name}
-                reply = broker.delete_cluster(body['headers'],
-                                              on_the_fly_request_body)
-        LOGGER.debug('reply: %s' % str(reply))
+    def _conditional_get(self, request, route, call_next):
+        """Middleware replying 304 if the client has the current version.
+
+        Applies to replies carrying an ETag header.
+        """
+        reply = call_next(request)
+        etag = reply.get('headers', {}).get('ETag')
+        if etag is None or reply['status_code'] != OK:
+            return reply
+        if_none_match = request.get_header('If-None-Match', '')
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag in tags or '*' in tags:
+            return {
+                'status_code': NOT_MODIFIED,
+                'body': b'',
+                'content_type': reply['content_type'],
+                'headers': {'ETag': etag}
+            }
         return reply
 
-    def get_spec(self, format):
+    def list_templates(self, request):
+        templates = get_template_registry(self.config).list()
+        return {'body': templates, 'status_code': OK}
+
+    def get_system_info(self, request):
+        return {'body': self.service.info(request.headers), 'status_code': OK}
+
+    def update_system_status(self, request):
+        return self.service.update_status(request.headers, request.body)
+
+    def get_metrics(self, request):
+        return self.service.metrics(request.headers)
+
+    def list_clusters(self, request):
+        broker = get_new_broker(self.config)
+        return broker.list_clusters(request.headers, request.body,
+                                    request.query)
+
+    def create_cluster(self, request):
+        broker = get_new_broker(self.config)
+        return broker.create_cluster(request.headers, request.body)
+
+    def get_cluster_config(self, request, cluster):
+        broker = get_new_broker(self.config)
+        return broker.get_cluster_config(cluster, request.headers,
+                                         request.query)
+
+    def get_cluster_info(self, request, cluster):
+        broker = get_new_broker(self.config)
+        return broker.get_cluster_info(cluster, request.headers, request.body)
+
+    def delete_cluster(self, request, cluster):
+        broker = get_new_broker(self.config)
+        return broker.delete_cluster(request.headers, {'name': cluster})
+
+    def create_nodes(self, request, cluster):
+        broker = get_new_broker(self.config)
+        return broker.create_nodes(request.headers, request.body)
+
+    def delete_nodes(self, request, cluster):
+        broker = get_new_broker(self.config)
+        return broker.delete_nodes(request.headers, request.body)
+
+    def get_node_info(self, request, cluster, node):
+        broker = get_new_broker(self.config)
+        return broker.get_node_info(cluster, node, request.headers)
+
+    def get_spec(self, request, format):
         result = {}
         try:
-            file_name = resource_string('container_service_extension',
-                                        'swagger/swagger.yaml')
-            if format == 'swagger.yaml':
-                result['body'] = file_name
-            else:
-                spec = yaml.safe_load(file_name)
-                result['body'] = json.loads(json.dumps(spec))
+            body, etag = load_specs()[format]
+            result['body'] = body
+            result['content_type'] = SPEC_CONTENT_TYPES[format]
+            result['headers'] = {'ETag': etag}
             result['status_code'] = OK
         except Exception:
             LOGGER.error(traceback.format_exc())
@@ -166,3 +234,26 @@ class ServiceProcessor(object):
             result['status_code'] = INTERNAL_SERVER_ERROR
             result['message'] = 'spec file not found: check installation.'
         return result
+
+
+def load_specs():
+    """Load the swagger spec, the first time it is requested.
+
+    :return: dictionary of spec format, like 'swagger.yaml', to a tuple of
+        the spec in that format, as bytes, and its entity tag.
+
+    :rtype: dict
+    """
+    global _specs
+    with _specs_lock:
+        if _specs is None:
+            spec_yaml = resource_string('container_service_extension',
+                                        'swagger/swagger.yaml')
+            spec_json = json.dumps(yaml.safe_load(spec_yaml)).encode('utf-8')
+            specs = {}
+            for format, content_type in SPEC_CONTENT_TYPES.items():
+                body = spec_yaml if format == 'swagger.yaml' else spec_json
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                specs[format] = (body, etag)
+            _specs = specs
+        return _specs
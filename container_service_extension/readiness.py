@@ -0,0 +1,296 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Waiting for cluster VMs to be ready for guest operations.
+
+Readiness is read from the guest properties that VMware Tools report to
+vCenter, without running anything in the guest. The VMs of a vCenter are
+not polled one by one: they are all registered with one property collector
+of that vCenter, and a single thread long-polls it for changes
+(WaitForUpdatesEx), notifying the waiters of each VM that changed.
+"""
+
+from concurrent.futures import Future
+import random
+import threading
+import time
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+from container_service_extension.exceptions import CseServerError
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.vsphere_pool import get_vcenter_info
+from container_service_extension.vsphere_pool import get_vsphere_pool
+
+DEFAULT_TIMEOUT = 600
+# guest properties watched for each VM
+GUEST_PROPERTIES = ('guest.guestOperationsReady', 'guest.ipAddress',
+                    'guest.toolsRunningStatus')
+# longest time, in seconds, a single WaitForUpdatesEx call blocks, so that
+# deadlines are enforced while no property changes
+MAX_WAIT_SECONDS = 5
+# backoff, in seconds, between attempts to reconnect to vCenter
+INITIAL_DELAY = 1
+MAX_DELAY = 15
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def is_ready(properties):
+    """Check if a VM is ready for guest operations.
+
+    :param dict properties: guest properties of the VM, by property path.
+
+    :rtype: bool
+    """
+    return properties.get('guest.toolsRunningStatus') == \
+        'guestToolsRunning' and \
+        bool(properties.get('guest.guestOperationsReady'))
+
+
+class _Watch(object):
+    def __init__(self, moid, condition, deadline):
+        self.moid = moid
+        self.condition = condition
+        self.deadline = deadline
+        self.future = Future()
+
+
+class VCenterWatcher(object):
+    """Watches the guest properties of VMs of one vCenter.
+
+    The watcher holds a vCenter session from the session pool, with its own
+    property collector, only while some VM is being watched. If the session
+    is lost, it reconnects with an exponential backoff, from INITIAL_DELAY
+    to MAX_DELAY seconds, with random jitter.
+    """
+
+    def __init__(self, config, vc_info):
+        """Constructor for VCenterWatcher.
+
+        :param dict config: CSE config.
+        :param dict vc_info: vCenter endpoint, with keys 'hostname', 'port',
+            'username' and 'password'.
+        """
+        self.config = config
+        self.vc_info = vc_info
+        self._vs = None
+        self._collector = None
+        # property filter of each watched VM, by moid
+        self._filters = {}
+        # last known guest properties of each watched VM, by moid
+        self._properties = {}
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = threading.Thread(
+            name='VCenterWatcher-%s' % vc_info['hostname'], target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, moid, condition=is_ready, timeout=DEFAULT_TIMEOUT):
+        """Start waiting for the guest properties of a VM to meet a condition.
+
+        :param str moid: managed object id of the VM.
+        :param function condition: callable taking the guest properties of
+            the VM, as a dictionary by property path, and returning True
+            once they are the expected ones. It is called each time one of
+            GUEST_PROPERTIES changes.
+        :param int timeout: number of seconds after which to give up.
+
+        :return: future resolved with the guest properties of the VM that
+            met the condition. Its exception is a CseServerError if the
+            condition is not met in time.
+
+        :rtype: concurrent.futures.Future
+        """
+        watch = _Watch(moid, condition, time.time() + timeout)
+        with self._lock:
+            self._watches.setdefault(moid, []).append(watch)
+            if moid in self._properties:
+                self._evaluate(moid)
+            elif self._collector is not None and moid not in self._filters:
+                try:
+                    self._add_filter(moid)
+                except Exception as e:
+                    # the watcher thread reconnects and adds the filters of
+                    # all the watched VMs
+                    LOGGER.debug('cannot watch vm %s: %s' % (moid, str(e)))
+                    self._disconnect(discard=True)
+            self._wakeup.notify()
+        return watch.future
+
+    def _run(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=MAX_WAIT_SECONDS)
+        version = ''
+        delay = INITIAL_DELAY
+        while True:
+            with self._lock:
+                if not self._watches:
+                    self._disconnect()
+                    while not self._watches:
+                        self._wakeup.wait()
+                collector = self._collector
+            try:
+                if collector is None:
+                    collector = self._connect()
+                    version = ''
+                update = collector.WaitForUpdatesEx(version, options)
+            except Exception as e:
+                LOGGER.warning('watching vms of vCenter %s failed, retrying '
+                               'in %ss: %s' %
+                               (self.vc_info['hostname'], delay, str(e)))
+                with self._lock:
+                    self._disconnect(discard=True)
+                    self._expire()
+                time.sleep(random.uniform(delay / 2, delay))
+                delay = min(delay * 2, MAX_DELAY)
+                continue
+            delay = INITIAL_DELAY
+            with self._lock:
+                # drop updates of a collector replaced in the meantime
+                if update is not None and collector is self._collector:
+                    version = update.version
+                    self._apply(update)
+                self._expire()
+
+    def _connect(self):
+        vs = get_vsphere_pool(self.config).acquire(self.vc_info)
+        with self._lock:
+            self._vs = vs
+            self._collector = vs.service_instance.content.propertyCollector \
+                .CreatePropertyCollector()
+            for moid in self._watches:
+                self._add_filter(moid)
+            LOGGER.debug('watching %s vms of vCenter %s' %
+                         (len(self._watches), self.vc_info['hostname']))
+            return self._collector
+
+    def _disconnect(self, discard=False):
+        if self._collector is not None:
+            try:
+                # also destroys the filters of the collector
+                self._collector.DestroyPropertyCollector()
+            except Exception:
+                discard = True
+        if self._vs is not None:
+            get_vsphere_pool(self.config).release(self.vc_info, self._vs,
+                                                  discard=discard)
+        self._vs = None
+        self._collector = None
+        self._filters = {}
+        self._properties = {}
+
+    def _add_filter(self, moid):
+        spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[
+                vmodl.query.PropertyCollector.ObjectSpec(
+                    obj=self._vs.get_vm_by_moid(moid))
+            ],
+            propSet=[
+                vmodl.query.PropertyCollector.PropertySpec(
+                    type=vim.VirtualMachine, pathSet=list(GUEST_PROPERTIES))
+            ])
+        self._filters[moid] = self._collector.CreateFilter(
+            spec, partialUpdates=True)
+
+    def _apply(self, update):
+        for filter_set in update.filterSet or []:
+            for object_update in filter_set.objectSet or []:
+                moid = object_update.obj._moId
+                if moid not in self._watches:
+                    continue
+                if object_update.kind == 'leave':
+                    self._fail(moid, 'VM %s no longer exists' % moid)
+                    continue
+                properties = self._properties.setdefault(moid, {})
+                for change in object_update.changeSet or []:
+                    properties[change.name] = \
+                        change.val if change.op == 'assign' else None
+                self._evaluate(moid)
+
+    def _evaluate(self, moid):
+        properties = self._properties[moid]
+        pending = []
+        for watch in self._watches[moid]:
+            try:
+                if not watch.condition(properties):
+                    pending.append(watch)
+                    continue
+                watch.future.set_result(dict(properties))
+            except Exception as e:
+                watch.future.set_exception(e)
+        self._update_watches(moid, pending)
+
+    def _expire(self):
+        now = time.time()
+        for moid in list(self._watches):
+            pending = []
+            for watch in self._watches[moid]:
+                if watch.deadline > now:
+                    pending.append(watch)
+                    continue
+                watch.future.set_exception(CseServerError(
+                    'Timed out waiting for the guest of VM %s, last known '
+                    'state: %s' % (moid, self._properties.get(moid))))
+            self._update_watches(moid, pending)
+
+    def _fail(self, moid, message):
+        for watch in self._watches[moid]:
+            watch.future.set_exception(CseServerError(message))
+        self._update_watches(moid, [])
+
+    def _update_watches(self, moid, pending):
+        if pending:
+            self._watches[moid] = pending
+            return
+        del self._watches[moid]
+        self._properties.pop(moid, None)
+        property_filter = self._filters.pop(moid, None)
+        if property_filter is not None:
+            try:
+                property_filter.DestroyPropertyFilter()
+            except Exception as e:
+                LOGGER.debug('cannot destroy filter of vm %s: %s' %
+                             (moid, str(e)))
+
+
+def get_vcenter_watcher(config, vc_info):
+    """Get the process-wide watcher of a vCenter.
+
+    :param dict config: CSE config.
+    :param dict vc_info: vCenter endpoint, with keys 'hostname', 'port',
+        'username' and 'password'.
+
+    :rtype: VCenterWatcher
+    """
+    key = (vc_info['hostname'], vc_info['port'], vc_info['username'])
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = _watchers[key] = VCenterWatcher(config, vc_info)
+        return watcher
+
+
+def wait_until_ready(config, vapp, vm_name, timeout=DEFAULT_TIMEOUT):
+    """Wait until a VM is ready for guest operations.
+
+    :param dict config: CSE config.
+    :param pyvcloud.vcd.vapp.VApp vapp: vApp of the VM.
+    :param str vm_name: name of the VM in the vApp.
+    :param int timeout: number of seconds after which to give up.
+
+    :return: the guest properties of the VM, by property path.
+
+    :rtype: dict
+
+    :raises CseServerError: if the VM is not ready in time.
+    """
+    vc_info = get_vcenter_info(config, vapp, vm_name)
+    watcher = get_vcenter_watcher(config, vc_info)
+    return watcher.watch(vapp.get_vm_moid(vm_name),
+                         timeout=timeout).result()
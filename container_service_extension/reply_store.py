@@ -0,0 +1,186 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from cryptography.fernet import Fernet
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+
+# results of ReplyStore.claim()
+CLAIMED = 'claimed'
+BUSY = 'busy'
+REPLIED = 'replied'
+
+_PROCESSING = 'processing'
+_DONE = 'done'
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ReplyStore(object):
+    """Replies to the requests received over AMQP, by vCD request id.
+
+    The store is an SQLite database file, shared by all the listeners and
+    worker processes of a CSE Server, and kept across restarts. A listener
+    claims a request before processing it, and stores the reply once it
+    is done, so that the same request delivered again, to any listener,
+    is answered with that reply instead of being processed again.
+
+    Replies may hold secrets such as kubeconfigs, so they are encrypted,
+    with a key derived from the vCD password of the config and a random
+    salt kept in the database. Replies that can't be decrypted, e.g. after
+    the password was changed, are ignored.
+    """
+
+    def __init__(self, path, secret, ttl=600):
+        """Constructor for ReplyStore.
+
+        :param str path: path of the database file, created if needed.
+        :param str secret: secret the encryption key is derived from.
+        :param float ttl: number of seconds replies are kept for. A claim
+            is also given up after that time, even if the process that made
+            it is still running.
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # requests claimed by this process and not done yet
+        self._claimed = set()
+        # only used under the lock
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        os.chmod(path, 0o600)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                             '(name TEXT PRIMARY KEY, value BLOB)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS replies '
+                             '(request_id TEXT PRIMARY KEY, state TEXT, '
+                             'owner INTEGER, updated_at REAL, reply BLOB)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS replies_updated_at '
+                             'ON replies (updated_at)')
+            self._db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                             ('salt', os.urandom(16)))
+            salt = self._db.execute(
+                "SELECT value FROM meta WHERE name = 'salt'").fetchone()[0]
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                   info=b'cse-reply-store',
+                   backend=default_backend()).derive(secret.encode())
+        self._fernet = Fernet(base64.urlsafe_b64encode(key))
+
+    def claim(self, request_id):
+        """Claim a request for processing.
+
+        :param str request_id: vCD id of the request.
+
+        :return: tuple of CLAIMED and None if the caller must process the
+            request, BUSY and None if another listener is processing it, or
+            REPLIED and the reply if the request was already processed.
+
+        :rtype: tuple
+        """
+        now = time.time()
+        pid = os.getpid()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(
+                    'SELECT state, owner, updated_at, reply FROM replies '
+                    'WHERE request_id = ?', (request_id,)).fetchone()
+                if row is not None and row[2] >= now - self.ttl:
+                    state, owner, _, reply = row
+                    if state == _DONE:
+                        reply = self._decrypt(reply)
+                        if reply is not None:
+                            return REPLIED, reply
+                    elif request_id in self._claimed or \
+                            (owner != pid and _is_alive(owner)):
+                        return BUSY, None
+                    else:
+                        LOGGER.warning('Request %s was being processed by a '
+                                       'process that stopped, and is '
+                                       'processed again', request_id)
+                self._db.execute(
+                    'INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, NULL)',
+                    (request_id, _PROCESSING, pid, now))
+                self._claimed.add(request_id)
+                return CLAIMED, None
+            finally:
+                self._db.execute('COMMIT')
+
+    def put(self, request_id, reply):
+        """Store the reply to a claimed request, and drop expired replies.
+
+        :param str request_id: vCD id of the request.
+        :param tuple reply: reply body, as bytes, status code, content type
+            and headers, as returned by MessageConsumer.process_message().
+        """
+        body, status_code, content_type, headers = reply
+        data = json.dumps([base64.b64encode(body).decode(), status_code,
+                           content_type, headers]).encode()
+        now = time.time()
+        with self._lock:
+            self._claimed.discard(request_id)
+            self._db.execute(
+                'INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?)',
+                (request_id, _DONE, os.getpid(), now,
+                 self._fernet.encrypt(data)))
+            self._db.execute('DELETE FROM replies WHERE updated_at < ?',
+                             (now - self.ttl,))
+
+    def release(self, request_id):
+        """Give up the claim on a request that could not be processed.
+
+        :param str request_id: vCD id of the request.
+        """
+        with self._lock:
+            self._claimed.discard(request_id)
+            self._db.execute(
+                'DELETE FROM replies WHERE request_id = ? AND state = ? '
+                'AND owner = ?', (request_id, _PROCESSING, os.getpid()))
+
+    def _decrypt(self, reply):
+        try:
+            data = json.loads(self._fernet.decrypt(reply).decode())
+        except InvalidToken:
+            return None
+        body, status_code, content_type, headers = data
+        return base64.b64decode(body), status_code, content_type, headers
+
+
+def get_reply_store(config):
+    """Get the process-wide reply store.
+
+    :param dict config: CSE config, used to open the store the first time
+        it is requested.
+
+    :rtype: ReplyStore
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ReplyStore(config['service']['reply_store_path'],
+                                config['vcd']['password'],
+                                ttl=config['service']['reply_cache_ttl'])
+        return _store
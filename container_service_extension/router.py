@@ -0,0 +1,216 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Dispatch of CSE API requests to their handlers.
+
+Routes are declared with a method and a path pattern, like
+'/cse/{cluster}/node/{node}/info', and compiled once when they are added.
+Path parameters are passed to the handler as keyword arguments:
+
+    router.add_route('GET', '/cse/{cluster}/info', get_cluster_info)
+
+    def get_cluster_info(request, cluster):
+        ...
+
+A middleware wraps the handling of a request. It is called with the
+request, the matched route and the next step of the chain, and returns the
+reply, usually the one returned by call_next(request).
+"""
+
+import functools
+import re
+
+NOT_FOUND = 404
+
+_PARAMETER = re.compile(r'^{(\w+)}$')
+
+
+class Request(object):
+    """A CSE API request."""
+
+    def __init__(self, method, path, headers=None, body=None, query=None,
+                 request_id=None):
+        """Constructor for Request.
+
+        :param str method: HTTP method.
+        :param str path: request path, without the query string, like
+            '/api/cse/c1/info'.
+        :param dict headers: HTTP headers.
+        :param dict body: decoded JSON body, or None.
+        :param dict query: query string parameters.
+        :param str request_id: id of the request, set by vCD.
+        """
+        self.method = method
+        self.path = path
+        self.headers = headers or {}
+        self.body = body
+        self.query = query or {}
+        self.id = request_id
+        # path parameters, set when the request is matched to a route
+        self.params = {}
+
+    def get_header(self, name, default=None):
+        """Get a header of the request, by case-insensitive name.
+
+        :param str name: name of the header.
+        :param str default: value returned if the header is not set.
+
+        :rtype: str
+        """
+        value = self.headers.get(name)
+        if value is not None:
+            return value
+        name = name.lower()
+        for key, value in self.headers.items():
+            if key.lower() == name:
+                return value
+        return default
+
+
+class Route(object):
+    """A method and path pattern, with its handler and middleware."""
+
+    def __init__(self, method, pattern, handler, middleware=()):
+        """Constructor for Route.
+
+        :param str method: HTTP method.
+        :param str pattern: path pattern. A segment in braces, like
+            '{cluster}', matches any single path segment, and is passed to
+            the handler as a keyword argument of that name.
+        :param function handler: callable taking the request and the path
+            parameters, and returning the reply.
+        :param list middleware: middleware run for this route, outermost
+            first.
+        """
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.middleware = tuple(middleware)
+        self.name = '%s %s' % (method, pattern)
+        self.is_static = True
+        regex = []
+        for segment in pattern.strip('/').split('/'):
+            match = _PARAMETER.match(segment)
+            if match:
+                regex.append('(?P<%s>[^/]+)' % match.group(1))
+                self.is_static = False
+            else:
+                regex.append(re.escape(segment))
+        self.regex = re.compile('^/%s$' % '/'.join(regex))
+        self.call = self._handle
+
+    def _handle(self, request):
+        return self.handler(request, **request.params)
+
+
+class Router(object):
+    """Table of routes, matched in the order they are added.
+
+    Routes without path parameters are looked up in a dictionary before any
+    pattern is tried.
+    """
+
+    def __init__(self, prefix='', middleware=(), not_found=None):
+        """Constructor for Router.
+
+        :param str prefix: prefix of all request paths, not part of the
+            route patterns.
+        :param list middleware: middleware run for every request, before
+            the middleware of the route, outermost first.
+        :param function not_found: handler of requests that match no route.
+            It goes through the router middleware like the other routes.
+        """
+        self.prefix = prefix
+        self.middleware = tuple(middleware)
+        self._static = {}
+        self._routes = {}
+        self._not_found = {}
+        self._not_found_handler = not_found or _not_found
+
+    def add_route(self, method, pattern, handler, middleware=()):
+        """Add a route.
+
+        :param str method: HTTP method.
+        :param str pattern: path pattern, like '/cse/{cluster}/info'.
+        :param function handler: callable taking the request and the path
+            parameters, and returning the reply.
+        :param list middleware: middleware run for this route only.
+
+        :return: the route.
+
+        :rtype: Route
+        """
+        route = self._compile(Route(method, pattern, handler, middleware))
+        if route.is_static:
+            self._static.setdefault((method, route.pattern.rstrip('/')),
+                                    route)
+        self._routes.setdefault(method, []).append(route)
+        return route
+
+    def match(self, method, path):
+        """Find the route of a request.
+
+        :param str method: HTTP method.
+        :param str path: request path, with the router prefix.
+
+        :return: tuple of the route and the path parameters, or (None,
+            None) if no route matches.
+
+        :rtype: tuple
+        """
+        path = path.split('?')[0]
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):]
+        path = path.rstrip('/')
+        route = self._static.get((method, path))
+        if route is not None:
+            return route, {}
+        for route in self._routes.get(method, ()):
+            match = route.regex.match(path)
+            if match:
+                return route, match.groupdict()
+        return None, None
+
+    def dispatch(self, request):
+        """Handle a request with the handler of its route.
+
+        :param Request request: the request.
+
+        :return: the reply of the handler, or of the not found handler.
+
+        :rtype: dict
+        """
+        route, params = self.match(request.method, request.path)
+        if route is None:
+            route = self._not_found.get(request.method)
+            if route is None:
+                route = self._compile(Route(request.method, '{unmatched}',
+                                            self._not_found_handler))
+                self._not_found[request.method] = route
+            params = {}
+        request.params = params
+        return route.call(request)
+
+    def _compile(self, route):
+        # compose the middleware chain once, innermost last
+        call = route.call
+        for middleware in reversed(self.middleware + route.middleware):
+            call = functools.partial(_call_middleware, middleware, route,
+                                     call)
+        route.call = call
+        return route
+
+
+def _call_middleware(middleware, route, call_next, request):
+    return middleware(request, route, call_next)
+
+
+def _not_found(request, **params):
+    return {
+        'status_code': NOT_FOUND,
+        'body': {
+            'message': 'Unknown request: %s %s' % (request.method,
+                                                   request.path)
+        }
+    }
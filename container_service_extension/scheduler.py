@@ -0,0 +1,222 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import collections
+import threading
+import traceback
+
+from container_service_extension.exceptions import ServiceBusyError
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+
+STATE_RUNNING = 'running'
+STATE_QUEUED = 'queued'
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+_Job = collections.namedtuple('_Job', ['op', 'org', 'func'])
+
+
+class Scheduler(object):
+    """Runs long broker operations on a fixed pool of worker threads.
+
+    Jobs are queued per org. When a worker is free, it takes the oldest
+    runnable job of the org that has received the smallest share of work
+    relative to its weight, so that an org submitting many operations
+    doesn't starve the others. A job is runnable when its org is below its
+    concurrency cap and its operation is below the operation's limit.
+    """
+
+    def __init__(self, workers=10, queue_size=100, op_limits=None,
+                 org_queue_size=20, org_max_ops=5, org_caps=None,
+                 org_weights=None):
+        """Constructor for Scheduler.
+
+        :param int workers: number of worker threads.
+        :param int queue_size: maximum number of jobs waiting for a worker.
+        :param dict op_limits: maximum number of concurrently running jobs
+            per operation name. Operations not listed are limited only by
+            the number of workers.
+        :param int org_queue_size: maximum number of jobs of one org waiting
+            for a worker.
+        :param int org_max_ops: maximum number of concurrently running jobs
+            of one org.
+        :param dict org_caps: org_max_ops overrides, per org name.
+        :param dict org_weights: share of the workers given to an org, per
+            org name, relative to the default weight of 1.
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.op_limits = op_limits or {}
+        self.org_queue_size = org_queue_size
+        self.org_max_ops = org_max_ops
+        self.org_caps = org_caps or {}
+        self.org_weights = org_weights or {}
+        self._pending = collections.OrderedDict()
+        self._pending_count = 0
+        self._running = collections.Counter()
+        self._running_by_org = collections.Counter()
+        # virtual time of each org: work received divided by weight
+        self._pass = {}
+        self._vtime = 0.0
+        self._idle_workers = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        for n in range(workers):
+            t = threading.Thread(name='BrokerWorker-%s' % n,
+                                 target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, op, func, org=None):
+        """Schedule a job.
+
+        :param str op: name of the operation, used for per-operation limits.
+        :param function func: callable taking no argument, run on a worker.
+        :param str org: name of the org the job is run for.
+
+        :return: STATE_RUNNING if the job can start right away, or
+            STATE_QUEUED if it has to wait for capacity.
+
+        :rtype: str
+
+        :raises ServiceBusyError: if the queue, or the org's share of it, is
+            full.
+        """
+        with self._cond:
+            if self._pending_count >= self.queue_size:
+                raise ServiceBusyError(
+                    'CSE is busy, %s operations are already waiting. '
+                    'Try again later.' % self._pending_count)
+            jobs = self._pending.get(org)
+            if jobs is None:
+                jobs = self._pending[org] = collections.deque()
+                # an org that was idle doesn't get credit for that time
+                self._pass[org] = max(self._pass.get(org, 0.0), self._vtime)
+            if len(jobs) >= self.org_queue_size:
+                raise ServiceBusyError(
+                    'Org \'%s\' already has %s operations waiting. '
+                    'Try again later.' % (org, len(jobs)))
+            state = STATE_QUEUED
+            if self._idle_workers > self._pending_count and \
+                    self._can_run(op, org, queued=jobs):
+                state = STATE_RUNNING
+            jobs.append(_Job(op, org, func))
+            self._pending_count += 1
+            self._cond.notify_all()
+        LOGGER.debug('%s job %s for org %s' % (state, op, org))
+        return state
+
+    def running_count(self):
+        """Get the number of jobs being run.
+
+        :rtype: int
+        """
+        with self._cond:
+            return sum(self._running.values())
+
+    def queued_count(self):
+        """Get the number of jobs waiting to be run.
+
+        :rtype: int
+        """
+        with self._cond:
+            return self._pending_count
+
+    def active_count(self):
+        """Get the number of jobs running or waiting to be run.
+
+        :rtype: int
+        """
+        with self._cond:
+            return sum(self._running.values()) + self._pending_count
+
+    def org_stats(self):
+        """Get the number of running and queued jobs of each org.
+
+        :return: dictionary of org name to a dictionary with keys 'running'
+            and 'queued', for orgs that have running or queued jobs.
+
+        :rtype: dict
+        """
+        with self._cond:
+            orgs = set(self._pending) | set(
+                org for org, n in self._running_by_org.items() if n > 0)
+            return {
+                org: {
+                    'running': self._running_by_org[org],
+                    'queued': len(self._pending.get(org, ()))
+                }
+                for org in orgs
+            }
+
+    def _can_run(self, op, org, queued=()):
+        op_limit = self.op_limits.get(op)
+        if op_limit is not None and \
+                self._running[op] + sum(1 for j in queued if j.op == op) \
+                >= op_limit:
+            return False
+        org_cap = self.org_caps.get(org, self.org_max_ops)
+        return self._running_by_org[org] + len(queued) < org_cap
+
+    def _next_job(self):
+        orgs = sorted(self._pending, key=lambda org: self._pass[org])
+        for org in orgs:
+            jobs = self._pending[org]
+            for job in jobs:
+                if self._can_run(job.op, org):
+                    jobs.remove(job)
+                    if not jobs:
+                        del self._pending[org]
+                    self._pending_count -= 1
+                    self._vtime = self._pass[org]
+                    self._pass[org] += 1.0 / self.org_weights.get(org, 1)
+                    return job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._idle_workers += 1
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._idle_workers -= 1
+                self._running[job.op] += 1
+                self._running_by_org[job.org] += 1
+            try:
+                job.func()
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+            finally:
+                with self._cond:
+                    self._running[job.op] -= 1
+                    self._running_by_org[job.org] -= 1
+                    # a job held back by a concurrency limit may now run
+                    self._cond.notify_all()
+
+
+def get_scheduler(config):
+    """Get the process-wide scheduler.
+
+    :param dict config: CSE config, used to size the scheduler the first
+        time it is requested.
+
+    :rtype: Scheduler
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            service = config['service']
+            _scheduler = Scheduler(
+                workers=service['worker_pool_size'],
+                queue_size=service['worker_queue_size'],
+                op_limits=service['max_concurrent_ops'],
+                org_queue_size=service['org_queue_size'],
+                org_max_ops=service['org_max_concurrent_ops'],
+                org_caps=service['org_concurrency_caps'],
+                org_weights=service['org_weights'])
+        return _scheduler
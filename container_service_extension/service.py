@@ -2,6 +2,9 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import multiprocessing
+from multiprocessing.managers import SyncManager
+import os
 import platform
 import signal
 import sys
@@ -12,18 +15,31 @@ import traceback
 
 import click
 import pkg_resources
-from pyvcloud.vcd.client import Client
 
-from container_service_extension.broker import DefaultBroker
+from container_service_extension.client_pool import get_tenant_client
+from container_service_extension.cluster_index import IndexReconciler
 from container_service_extension.config import check_cse_installation
 from container_service_extension.config import get_validated_config
 from container_service_extension.consumer import MessageConsumer
 from container_service_extension.logger import configure_server_logger
+from container_service_extension.logger import forward_server_logs
 from container_service_extension.logger import SERVER_DEBUG_LOG_FILEPATH
 from container_service_extension.logger import SERVER_INFO_LOG_FILEPATH
 from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.logger import start_server_log_listener
+from container_service_extension.metrics import CONTENT_TYPE \
+    as METRICS_CONTENT_TYPE
+from container_service_extension.metrics import Gauge
+from container_service_extension.metrics import merge as merge_metrics
+from container_service_extension.metrics import REGISTRY
+from container_service_extension.metrics import start_metrics_server
+from container_service_extension.scheduler import get_scheduler
+from container_service_extension.template_registry import \
+    get_template_registry
+from container_service_extension.template_registry import TemplateRefresher
 
 from container_service_extension.utils import SYSTEM_ORG_NAME
+from container_service_extension.vsphere_pool import get_vsphere_pool
 
 
 class Singleton(type):
@@ -41,6 +57,18 @@ def signal_handler(signal, frame):
     raise KeyboardInterrupt()
 
 
+def serve_worker(service, worker_index):
+    """Run the server in a worker process started by Service.supervise().
+
+    :param Service service: the service of the supervising process.
+    :param int worker_index: index of the worker process.
+    """
+    # the worker process starts afresh, the service is not a singleton yet
+    Singleton._instances[Service] = service
+    signal.signal(signal.SIGINT, signal_handler)
+    service.serve(worker_index)
+
+
 def consumer_thread(c):
     try:
         LOGGER.info('about to start consumer_thread %s', c)
@@ -52,38 +80,61 @@ def consumer_thread(c):
 
 
 class Service(object, metaclass=Singleton):
-    def __init__(self, config_file, should_check_config=True):
+    def __init__(self, config_file, should_check_config=True, workers=1):
         self.config_file = config_file
         self.config = None
         self.should_check_config = should_check_config
-        self.is_enabled = False
+        self.workers = workers
+        self.worker_index = 0
+        # with several worker processes, the enabled and stopped flags and
+        # the template availability are shared between them, each of them
+        # publishes its stats and metrics, and their logs are written by the
+        # supervisor
+        self._enabled_flag = None
+        self._stop_flag = None
+        self._worker_stats = None
+        self._worker_metrics = None
+        self._template_status = None
+        self._log_queue = None
+        self._is_enabled = False
+        self._should_stop = False
         self.consumers = []
         self.threads = []
-        self.should_stop = False
+        self.index_reconciler = None
+        self.template_refresher = None
+        self.metrics_server = None
+
+    @property
+    def is_enabled(self):
+        if self._enabled_flag is not None:
+            return bool(self._enabled_flag.value)
+        return self._is_enabled
+
+    @is_enabled.setter
+    def is_enabled(self, value):
+        if self._enabled_flag is not None:
+            self._enabled_flag.value = int(value)
+        else:
+            self._is_enabled = value
+
+    @property
+    def should_stop(self):
+        if self._stop_flag is not None:
+            return bool(self._stop_flag.value)
+        return self._should_stop
+
+    @should_stop.setter
+    def should_stop(self, value):
+        if self._stop_flag is not None:
+            self._stop_flag.value = int(value)
+        else:
+            self._should_stop = value
 
     def connect_tenant(self, headers):
-        token = headers.get('x-vcloud-authorization')
-        accept_header = headers.get('Accept')
-        version = accept_header.split('version=')[1]
-        client_tenant = Client(
-            uri=self.config['vcd']['host'],
-            api_version=version,
-            verify_ssl_certs=self.config['vcd']['verify'],
-            log_file=SERVER_DEBUG_LOG_FILEPATH,
-            log_headers=True,
-            log_bodies=True)
-        session = client_tenant.rehydrate_from_token(token)
-        return (
-            client_tenant,
-            session,
-        )
+        return get_tenant_client(self.config, headers)
 
     def active_requests_count(self):
-        n = 0
-        for t in threading.enumerate():
-            if type(t) == DefaultBroker:
-                n += 1
-        return n
+        return get_scheduler(self.config).active_count()
 
     def get_status(self):
         if self.is_enabled:
@@ -95,18 +146,79 @@ class Service(object, metaclass=Singleton):
                 return 'Disabled'
 
     def info(self, headers):
-        client_tenant, session = self.connect_tenant(headers)
+        client_tenant, session_info = self.connect_tenant(headers)
         result = Service.version()
-        if session.get('org') == SYSTEM_ORG_NAME:
-            result['consumer_threads'] = len(self.threads)
-            result['all_threads'] = threading.activeCount()
-            result['requests_in_progress'] = self.active_requests_count()
+        if session_info['org_name'] == SYSTEM_ORG_NAME:
+            result.update(self.stats())
             result['config_file'] = self.config_file
             result['status'] = self.get_status()
         else:
             del result['python']
         return result
 
+    def worker_stats(self):
+        """Get the stats of this process.
+
+        :rtype: dict
+        """
+        scheduler = get_scheduler(self.config)
+        return {
+            'consumer_threads': len(self.threads),
+            'all_threads': threading.activeCount(),
+            'requests_in_progress': scheduler.active_count(),
+            'requests_queued': scheduler.queued_count(),
+            'requests_by_org': scheduler.org_stats()
+        }
+
+    def stats(self):
+        """Get the stats of the server, summed over all worker processes.
+
+        :rtype: dict
+        """
+        if self._worker_stats is None:
+            return self.worker_stats()
+        result = {
+            'workers': 0,
+            'consumer_threads': 0,
+            'all_threads': 0,
+            'requests_in_progress': 0,
+            'requests_queued': 0,
+            'requests_by_org': {}
+        }
+        for stats in self._worker_stats.values():
+            result['workers'] += 1
+            for key in ('consumer_threads', 'all_threads',
+                        'requests_in_progress', 'requests_queued'):
+                result[key] += stats[key]
+            for org, org_stats in stats['requests_by_org'].items():
+                total = result['requests_by_org'].setdefault(
+                    org, {'running': 0, 'queued': 0})
+                total['running'] += org_stats['running']
+                total['queued'] += org_stats['queued']
+        return result
+
+    def metrics(self, headers):
+        client_tenant, session_info = self.connect_tenant(headers)
+        reply = {}
+        if session_info['org_name'] == SYSTEM_ORG_NAME:
+            if self._worker_metrics is None:
+                reply['body'] = REGISTRY.render()
+            else:
+                # totals of all the workers, with the latest of this one
+                renders = dict(self._worker_metrics)
+                renders[os.getpid()] = REGISTRY.render()
+                reply['body'] = merge_metrics(renders.values())
+            reply['content_type'] = METRICS_CONTENT_TYPE
+            reply['status_code'] = 200
+        else:
+            reply['body'] = {'message': 'Unauthorized'}
+            reply['status_code'] = 401
+        return reply
+
+    def _scheduler_stats(self, key):
+        return [({'org': org or ''}, stats[key]) for org, stats in
+                get_scheduler(self.config).org_stats().items()]
+
     @classmethod
     def version(cls):
         ver = pkg_resources.require('container-service-extension')[0].version
@@ -123,9 +235,9 @@ class Service(object, metaclass=Singleton):
         return ver_obj
 
     def update_status(self, headers, body):
-        client_tenant, session = self.connect_tenant(headers)
+        client_tenant, session_info = self.connect_tenant(headers)
         reply = {}
-        if session.get('org') == SYSTEM_ORG_NAME:
+        if session_info['org_name'] == SYSTEM_ORG_NAME:
             if 'enabled' in body:
                 if body['enabled'] and self.should_stop:
                     reply['body'] = {
@@ -146,7 +258,7 @@ class Service(object, metaclass=Singleton):
                     reply['status_code'] = 500
                 else:
                     message = 'CSE graceful shutdown started.'
-                    n = self.active_requests_count()
+                    n = self.stats()['requests_in_progress']
                     if n > 0:
                         message += ' CSE will finish processing %s requests.' \
                             % n
@@ -178,6 +290,77 @@ class Service(object, metaclass=Singleton):
         click.secho(message)
         LOGGER.info(message)
 
+        if self.workers > 1:
+            self.supervise()
+        else:
+            self.serve()
+
+    def supervise(self):
+        """Run the server in worker processes, and wait for them to stop.
+
+        A worker that exits with an error while the server is not stopping
+        is restarted. The log records of the workers are sent to this
+        process, which is the only one writing the log files.
+
+        The workers are spawned, not forked: they don't inherit the threads,
+        locks, log handlers and sessions of this process, which a worker
+        restarted while this process runs would otherwise get in whatever
+        state they are in.
+        """
+        context = multiprocessing.get_context('spawn')
+        manager = SyncManager(ctx=context)
+        # the manager must outlive the workers, which are stopped by Ctrl+C
+        manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+        self._enabled_flag = context.Value('b', 1)
+        self._stop_flag = context.Value('b', 0)
+        self._worker_stats = manager.dict()
+        self._worker_metrics = manager.dict()
+        # refreshed by worker 0, read by all the workers
+        self._template_status = manager.dict()
+        self._log_queue = context.Queue()
+        log_listener = start_server_log_listener(self._log_queue)
+        processes = {}
+        for n in range(self.workers):
+            processes[n] = self._start_worker(context, n)
+        LOGGER.info('num of worker processes started: %s', len(processes))
+
+        while any(p.is_alive() for p in processes.values()):
+            try:
+                time.sleep(1)
+                for n, p in list(processes.items()):
+                    if p.is_alive() or p.exitcode == 0 or self.should_stop:
+                        continue
+                    LOGGER.error('worker %s (pid %s) exited with code %s, '
+                                 'restarting it', n, p.pid, p.exitcode)
+                    self._worker_stats.pop(p.pid, None)
+                    self._worker_metrics.pop(p.pid, None)
+                    processes[n] = self._start_worker(context, n)
+            except KeyboardInterrupt:
+                # the workers got the same signal, wait for them to stop
+                self.should_stop = True
+
+        log_listener.stop()
+        manager.shutdown()
+        LOGGER.info('done')
+
+    def _start_worker(self, context, n):
+        p = context.Process(name='CSEWorker-%s' % n, target=serve_worker,
+                            args=(self, n))
+        p.start()
+        LOGGER.info('started worker %s, pid %s', n, p.pid)
+        return p
+
+    def serve(self, worker_index=0):
+        """Consume and process requests until the server is stopped.
+
+        :param int worker_index: index of the worker process, 0 if the
+            server runs in a single process.
+        """
+        self.worker_index = worker_index
+        if self._log_queue is not None:
+            forward_server_logs(self._log_queue)
+        if self._template_status is not None:
+            get_template_registry(self.config, status=self._template_status)
         amqp = self.config['amqp']
         num_consumers = self.config['service']['listeners']
 
@@ -187,7 +370,9 @@ class Service(object, metaclass=Singleton):
                     amqp['host'], amqp['port'], amqp['ssl'], amqp['vhost'],
                     amqp['username'], amqp['password'], amqp['exchange'],
                     amqp['routing_key'], self.config,
-                    self.config['vcd']['verify'], self.config['vcd']['log'])
+                    self.config['vcd']['verify'], self.config['vcd']['log'],
+                    self.config['service']['request_workers'],
+                    self.config['service']['prefetch_count'])
                 name = 'MessageConsumer-%s' % n
                 t = Thread(name=name, target=consumer_thread, args=(c, ))
                 t.daemon = True
@@ -203,11 +388,43 @@ class Service(object, metaclass=Singleton):
 
         LOGGER.info('num of threads started: %s', len(self.threads))
 
-        self.is_enabled = True
+        # the cluster index is per process, so every worker rebuilds its own
+        self.index_reconciler = IndexReconciler(self.config)
+        self.index_reconciler.start()
+        if worker_index == 0:
+            # the other workers share the template registry of this one
+            self.template_refresher = TemplateRefresher(self.config)
+            self.template_refresher.start()
+
+        Gauge('cse_broker_operations_running',
+              'Number of broker operations being run, by org.', ['org'],
+              callback=lambda: self._scheduler_stats('running'))
+        Gauge('cse_broker_operations_queued',
+              'Number of broker operations waiting for a worker, by org.',
+              ['org'], callback=lambda: self._scheduler_stats('queued'))
+        if self.config['service']['metrics_port']:
+            # each worker process serves its own metrics
+            metrics_host = self.config['service']['metrics_host']
+            metrics_port = self.config['service']['metrics_port'] + \
+                worker_index
+            try:
+                self.metrics_server = start_metrics_server(metrics_host,
+                                                           metrics_port)
+            except OSError as e:
+                # metrics are not worth failing the worker for, requests are
+                # still served over AMQP
+                LOGGER.error('metrics listener not started on %s:%s: %s' %
+                             (metrics_host, metrics_port, e))
+
+        if self._enabled_flag is None:
+            self.is_enabled = True
 
         while True:
             try:
                 time.sleep(1)
+                if self._worker_stats is not None:
+                    self._worker_stats[os.getpid()] = self.worker_stats()
+                    self._worker_metrics[os.getpid()] = REGISTRY.render()
                 if self.should_stop and self.active_requests_count() == 0:
                     break
             except KeyboardInterrupt:
@@ -223,4 +440,14 @@ class Service(object, metaclass=Singleton):
                 c.stop()
             except Exception:
                 pass
+        if self.index_reconciler is not None:
+            self.index_reconciler.stop()
+        if self.template_refresher is not None:
+            self.template_refresher.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        get_vsphere_pool(self.config).clear()
+        if self._worker_stats is not None:
+            self._worker_stats.pop(os.getpid(), None)
+            self._worker_metrics.pop(os.getpid(), None)
         LOGGER.info('done')
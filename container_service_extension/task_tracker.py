@@ -0,0 +1,243 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import threading
+import time
+import traceback
+
+from pyvcloud.vcd.client import TaskStatus
+from pyvcloud.vcd.exceptions import TaskTimeoutException
+from pyvcloud.vcd.exceptions import VcdResponseException
+from pyvcloud.vcd.exceptions import VcdTaskException
+
+from container_service_extension.logger import current_log_tag
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.logger import use_log_tag
+
+DEFAULT_POLL_FREQUENCY = 5
+# maximum number of tasks polled at the same time
+DEFAULT_POLL_WORKERS = 10
+# number of consecutive failed polls of a task after which its waiters fail
+MAX_POLL_ERRORS = 3
+
+_FAILED = (TaskStatus.ABORTED.value, TaskStatus.CANCELED.value,
+           TaskStatus.ERROR.value)
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+class _Waiter(object):
+    def __init__(self, client, deadline):
+        self.client = client
+        self.deadline = deadline
+        self.future = Future()
+        # the poller logs about the task with the tag of the caller
+        self.log_tag = current_log_tag()
+
+
+class TaskTracker(object):
+    """Tracks the completion of vCD tasks from a single polling thread.
+
+    Callers get a future per task instead of polling the task themselves,
+    so the number of outstanding tasks doesn't change the number of threads
+    busy waiting on vCD. All tracked tasks are polled in one pass, once
+    every poll_frequency seconds, up to poll_workers of them at the same
+    time, so that a pass takes about one vCD round trip rather than one per
+    task. A poll that fails with a transient error is retried on the next
+    pass, and the waiters of the task only fail after MAX_POLL_ERRORS
+    failed polls in a row.
+    """
+
+    def __init__(self, poll_frequency=DEFAULT_POLL_FREQUENCY,
+                 poll_workers=DEFAULT_POLL_WORKERS):
+        """Constructor for TaskTracker.
+
+        :param int poll_frequency: number of seconds between two polls.
+        :param int poll_workers: maximum number of tasks polled at the same
+            time.
+        """
+        self.poll_frequency = poll_frequency
+        self._executor = ThreadPoolExecutor(
+            max_workers=poll_workers, thread_name_prefix='TaskPoller')
+        self._waiters = {}
+        # number of consecutive failed polls, by task href, only used by the
+        # polling thread
+        self._poll_errors = {}
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(name='TaskTracker', target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def track(self, client, task, timeout=None):
+        """Start tracking a task.
+
+        :param pyvcloud.vcd.client.Client client: client allowed to read the
+            task.
+        :param lxml.objectify.ObjectifiedElement task: task resource, as
+            returned when the task was started.
+        :param int timeout: number of seconds after which to give up, or
+            None to wait for as long as the task runs.
+
+        :return: future resolved with the final task resource when the task
+            succeeds. Its exception is a VcdTaskException if the task fails,
+            or a TaskTimeoutException if it is not done in time.
+
+        :rtype: concurrent.futures.Future
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        waiter = _Waiter(client, deadline)
+        if _resolve(waiter, task):
+            return waiter.future
+        with self._cond:
+            self._waiters.setdefault(task.get('href'), []).append(waiter)
+            self._cond.notify()
+        return waiter.future
+
+    def pending_count(self):
+        """Get the number of tasks being tracked.
+
+        :rtype: int
+        """
+        with self._cond:
+            return len(self._waiters)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._waiters:
+                    self._cond.wait()
+            time.sleep(self.poll_frequency)
+            with self._cond:
+                waiters = dict(self._waiters)
+            polls = {
+                href: self._executor.submit(
+                    task_waiters[0].client.get_resource, href)
+                for href, task_waiters in waiters.items()
+            }
+            for href, task_waiters in waiters.items():
+                task = None
+                error = None
+                try:
+                    task = polls[href].result()
+                    self._poll_errors.pop(href, None)
+                except Exception as e:
+                    errors = self._poll_errors.get(href, 0) + 1
+                    with use_log_tag(task_waiters[0].log_tag):
+                        if _is_transient(e) and errors < MAX_POLL_ERRORS:
+                            LOGGER.warning('polling task %s failed, '
+                                           'retrying: %s' % (href, str(e)))
+                            self._poll_errors[href] = errors
+                        else:
+                            LOGGER.error(traceback.format_exc())
+                            error = e
+                now = time.time()
+                done = []
+                for waiter in task_waiters:
+                    if error is not None:
+                        waiter.future.set_exception(error)
+                        done.append(waiter)
+                    elif task is not None and _resolve(waiter, task):
+                        done.append(waiter)
+                    elif waiter.deadline is not None and \
+                            now > waiter.deadline:
+                        waiter.future.set_exception(
+                            TaskTimeoutException('Task timeout'))
+                        done.append(waiter)
+                with self._cond:
+                    remaining = [w for w in self._waiters.get(href, [])
+                                 if w not in done]
+                    if remaining:
+                        self._waiters[href] = remaining
+                    else:
+                        self._waiters.pop(href, None)
+                        self._poll_errors.pop(href, None)
+
+
+def _is_transient(error):
+    """Check if a failed poll of a task is worth retrying.
+
+    vCD responses with a 4xx status code, such as a 404 for a task that no
+    longer exists, are not retried. Other errors, such as 5xx responses or
+    connection errors, are.
+
+    :param Exception error: error raised when polling the task.
+
+    :rtype: bool
+    """
+    return not isinstance(error, VcdResponseException) or \
+        error.status_code >= 500
+
+
+def _resolve(waiter, task):
+    status = task.get('status').lower()
+    if status == TaskStatus.SUCCESS.value.lower():
+        waiter.future.set_result(task)
+        return True
+    if status in (s.lower() for s in _FAILED):
+        error = task.Error if hasattr(task, 'Error') else None
+        waiter.future.set_exception(VcdTaskException(status, error))
+        return True
+    return False
+
+
+def get_task_tracker():
+    """Get the process-wide task tracker.
+
+    :rtype: TaskTracker
+    """
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = TaskTracker()
+        return _tracker
+
+
+def wait_for_task(client, task, timeout=None):
+    """Wait until a vCD task succeeds.
+
+    Drop-in replacement for client.get_task_monitor().wait_for_status():
+    like it, it waits for as long as the task runs unless a timeout is
+    given.
+
+    :param pyvcloud.vcd.client.Client client: client allowed to read the
+        task.
+    :param lxml.objectify.ObjectifiedElement task: task resource.
+    :param int timeout: number of seconds after which to give up, or None
+        to wait for as long as the task runs.
+
+    :return: the final task resource.
+
+    :rtype: lxml.objectify.ObjectifiedElement
+
+    :raises VcdTaskException: if the task fails.
+    :raises TaskTimeoutException: if the task is not done in time.
+    """
+    return get_task_tracker().track(client, task, timeout=timeout).result()
+
+
+def wait_for_tasks(client, tasks, timeout=None):
+    """Wait until all of a set of vCD tasks are done.
+
+    :param pyvcloud.vcd.client.Client client: client allowed to read the
+        tasks.
+    :param list tasks: task resources.
+    :param int timeout: number of seconds after which to give up, or None
+        to wait for as long as the tasks run.
+
+    :return: the final task resources, in the same order as @tasks.
+
+    :rtype: list
+
+    :raises VcdTaskException: if any of the tasks fails, once all of them
+        are done.
+    :raises TaskTimeoutException: if a task is not done in time.
+    """
+    tracker = get_task_tracker()
+    futures = [tracker.track(client, task, timeout=timeout) for task in tasks]
+    wait(futures)
+    return [future.result() for future in futures]
@@ -0,0 +1,183 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import copy
+from datetime import datetime
+from datetime import timezone
+import threading
+import traceback
+
+from pyvcloud.vcd.client import QueryResultFormat
+from pyvcloud.vcd.client import ResourceType
+
+from container_service_extension.client_pool import call_as_sysadmin
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.utils import get_org
+
+# status of a catalog item whose vApp template can be instantiated
+_RESOLVED = 'RESOLVED'
+# availability of a template until the first refresh
+_UNKNOWN = {'available': None, 'size_mb': None, 'last_verified': None}
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+class TemplateRegistry(object):
+    """Templates of the CSE config, with their availability in vCD.
+
+    The templates are listed from memory. Whether their catalog item
+    exists, and its size, are checked against vCD by refresh(), which is
+    meant to be called periodically.
+    """
+
+    def __init__(self, config, status=None):
+        """Constructor for TemplateRegistry.
+
+        :param dict config: CSE config.
+        :param dict status: where the availability of the templates is
+            kept, by template name. The server passes a dict shared between
+            its worker processes, so that one of them refreshes it for all.
+            Defaults to a new dict.
+        """
+        broker = config['broker']
+        self._templates = []
+        for t in broker['templates']:
+            self._templates.append({
+                'name': t['name'],
+                'is_default': t['name'] == broker['default_template'],
+                'catalog': broker['catalog'],
+                'catalog_item': t['catalog_item'],
+                'description': t['description']
+            })
+        self._status = status if status is not None else {}
+
+    def list(self):
+        """Get the templates.
+
+        :return: list of template dictionaries, with keys 'name',
+            'is_default', 'catalog', 'catalog_item', 'description',
+            'available', 'size_mb' and 'last_verified'.
+
+        :rtype: list
+        """
+        templates = copy.deepcopy(self._templates)
+        status = self._status.copy()
+        for t in templates:
+            t.update(status.get(t['name'], _UNKNOWN))
+        return templates
+
+    def refresh(self, config):
+        """Check the catalog items of the templates in vCD.
+
+        :param dict config: CSE config.
+        """
+        items = _get_catalog_items(config)
+        verified_at = datetime.now(timezone.utc).isoformat()
+        status = {}
+        for t in self._templates:
+            item, size = items.get(t['catalog_item'], (None, None))
+            resolved = item is not None and item.get('status') == _RESOLVED
+            size_mb = None
+            if size is not None:
+                size_mb = int(size) // 2**20
+            status[t['name']] = {
+                'available': resolved,
+                'size_mb': size_mb,
+                'last_verified': verified_at
+            }
+        self._status.update(status)
+        available = sum(1 for s in status.values() if s['available'])
+        LOGGER.debug('template registry refreshed, %s of %s templates '
+                     'available' % (available, len(self._templates)))
+
+
+def _get_catalog_items(config):
+    """Get the items of the CSE catalog, with the size of their template.
+
+    The size is the 'sizeInBytes' of the vApp template of the item, as
+    returned by the AdminVAppTemplate query.
+
+    :param dict config: CSE config.
+
+    :return: dictionary of catalog item name to a tuple of its query record
+        and the size of its vApp template in bytes, as a string, or None if
+        it is not known.
+
+    :rtype: dict
+    """
+    catalog_name = config['broker']['catalog']
+
+    def query(client):
+        org = get_org(client, org_name=config['broker']['org'])
+        catalog = org.get_catalog(catalog_name)
+        catalog_id = catalog.get('id').split(':')[-1]
+        q = client.get_typed_query(
+            ResourceType.ADMIN_CATALOG_ITEM.value,
+            query_result_format=QueryResultFormat.RECORDS,
+            equality_filter=('catalogName', catalog_name))
+        # catalogs of other orgs may have the same name
+        items = [
+            record for record in q.execute()
+            if record.get('catalog').split('/')[-1] == catalog_id
+        ]
+        q = client.get_typed_query(
+            ResourceType.ADMIN_VAPP_TEMPLATE.value,
+            query_result_format=QueryResultFormat.RECORDS,
+            equality_filter=('catalogName', catalog_name))
+        sizes = {
+            record.get('href'): record.get('sizeInBytes')
+            for record in q.execute()
+        }
+        return items, sizes
+    items, sizes = call_as_sysadmin(config, query)
+    return {
+        record.get('name'): (record, sizes.get(record.get('entity')))
+        for record in items
+    }
+
+
+def get_template_registry(config, status=None):
+    """Get the process-wide template registry.
+
+    :param dict config: CSE config, used to build the registry the first
+        time it is requested.
+    :param dict status: where the availability of the templates is kept,
+        used to build the registry the first time it is requested. See
+        TemplateRegistry.
+
+    :rtype: TemplateRegistry
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TemplateRegistry(config, status=status)
+        return _registry
+
+
+class TemplateRefresher(threading.Thread):
+    """Thread that periodically refreshes the template registry."""
+
+    def __init__(self, config):
+        """Constructor for TemplateRefresher.
+
+        :param dict config: CSE config.
+        """
+        super(TemplateRefresher, self).__init__(name='TemplateRefresher')
+        self.daemon = True
+        self.config = config
+        self.interval = config['service']['template_refresh_interval']
+        self._stopped = threading.Event()
+
+    def run(self):
+        registry = get_template_registry(self.config)
+        while not self._stopped.is_set():
+            try:
+                registry.refresh(self.config)
+            except Exception:
+                LOGGER.error(traceback.format_exc())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,197 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""Tracing spans of CSE server operations.
+
+Finished spans are written to the trace log, one JSON object per line, with
+the field names of the OpenTelemetry span data model, so that they can be
+loaded by OpenTelemetry tooling.
+
+The active span is kept per thread. Work handed to another thread must be
+wrapped with use_span() to keep its spans in the same trace.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from container_service_extension.logger import TRACE_LOGGER
+
+STATUS_OK = 'STATUS_CODE_OK'
+STATUS_ERROR = 'STATUS_CODE_ERROR'
+
+# attributes that child spans copy from their parent
+INHERITED_ATTRIBUTES = ('cse.cluster.id', 'cse.cluster.name')
+
+_local = threading.local()
+
+
+class Span(object):
+    """A timed operation, part of a trace."""
+
+    def __init__(self, name, parent=None, attributes=None, start_time=None):
+        """Constructor for Span.
+
+        :param str name: name of the operation.
+        :param Span parent: parent span, or None to start a new trace.
+        :param dict attributes: attributes of the span.
+        :param float start_time: start time of the span, in seconds since
+            the epoch. Defaults to now.
+        """
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = {}
+        if parent is not None:
+            for key in INHERITED_ATTRIBUTES:
+                if key in parent.attributes:
+                    self.attributes[key] = parent.attributes[key]
+        self.attributes.update(attributes or {})
+        self.start_time = start_time or time.time()
+        self.end_time = None
+        self.status = STATUS_OK
+        self.status_message = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    def end(self, end_time=None):
+        """End the span and write it to the trace log.
+
+        If the span is the active span of the calling thread, its parent
+        becomes active again.
+
+        :param float end_time: end time of the span, in seconds since the
+            epoch. Defaults to now.
+        """
+        if self.end_time is not None:
+            return
+        self.end_time = end_time or time.time()
+        stack = _stack()
+        if self in stack:
+            stack.remove(self)
+        _export(self)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'context': {
+                'trace_id': self.trace_id,
+                'span_id': self.span_id
+            },
+            'parent_id': self.parent_span_id,
+            'start_time_unix_nano': int(self.start_time * 1e9),
+            'end_time_unix_nano': int(self.end_time * 1e9),
+            'duration_ms': round((self.end_time - self.start_time) * 1000, 3),
+            'status': {
+                'status_code': self.status,
+                'description': self.status_message
+            },
+            'attributes': self.attributes,
+            'resource': {
+                'service.name': 'cse'
+            }
+        }
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _export(span):
+    if TRACE_LOGGER.handlers:
+        TRACE_LOGGER.info(json.dumps(span.to_dict(), default=str))
+
+
+def current_span():
+    """Get the active span of the calling thread.
+
+    :rtype: Span
+    """
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def start_span(name, attributes=None):
+    """Start a span, as a child of the active span, and make it active.
+
+    The span stays active until it is ended.
+
+    :param str name: name of the operation.
+    :param dict attributes: attributes of the span.
+
+    :rtype: Span
+    """
+    span = Span(name, parent=current_span(), attributes=attributes)
+    _stack().append(span)
+    return span
+
+
+@contextmanager
+def span(name, attributes=None):
+    """Run a block in a new span, marked as failed if the block raises.
+
+    :param str name: name of the operation.
+    :param dict attributes: attributes of the span.
+
+    :return: the span.
+
+    :rtype: Span
+    """
+    s = start_span(name, attributes=attributes)
+    try:
+        yield s
+    except Exception as e:
+        s.set_error(str(e))
+        raise
+    finally:
+        s.end()
+
+
+@contextmanager
+def use_span(parent):
+    """Make a span, started in another thread, active for a block.
+
+    :param Span parent: span to make active, usually the current_span() of
+        the thread that handed over the work.
+    """
+    stack = _stack()
+    if parent is not None:
+        stack.append(parent)
+    try:
+        yield parent
+    finally:
+        if parent is not None and parent in stack:
+            stack.remove(parent)
+
+
+def record_span(name, start_time, end_time, attributes=None, error=None):
+    """Record a finished operation, as a child of the active span.
+
+    Nothing is recorded if no span is active, so that calls made outside of
+    a traced operation don't each start a trace of their own.
+
+    :param str name: name of the operation.
+    :param float start_time: start time, in seconds since the epoch.
+    :param float end_time: end time, in seconds since the epoch.
+    :param dict attributes: attributes of the span.
+    :param str error: error message, if the operation failed.
+    """
+    parent = current_span()
+    if parent is None:
+        return
+    s = Span(name, parent=parent, attributes=attributes,
+             start_time=start_time)
+    if error is not None:
+        s.set_error(error)
+    s.end(end_time=end_time)
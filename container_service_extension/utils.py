@@ -9,24 +9,17 @@ import pathlib
 import stat
 import sys
 import traceback
-from urllib.parse import urlparse
 
 import click
-import requests
-from cachetools import LRUCache
-from container_service_extension.exceptions import VcdResponseError
 from lxml import objectify
-from pyvcloud.vcd.client import BasicLoginCredentials
-from pyvcloud.vcd.client import Client
 from pyvcloud.vcd.exceptions import EntityNotFoundException
 from pyvcloud.vcd.org import Org
-from pyvcloud.vcd.platform import Platform
-from pyvcloud.vcd.vapp import VApp
 from pyvcloud.vcd.vdc import VDC
-from pyvcloud.vcd.vm import VM
-from vsphere_guest_run.vsphere import VSphere
+import requests
+
+from container_service_extension.exceptions import VcdResponseError
+from container_service_extension.task_tracker import wait_for_task
 
-cache = LRUCache(maxsize=1024)
 SYSTEM_ORG_NAME = "System"
 CSE_SCRIPTS_DIR = 'container_service_extension_scripts'
 ERROR_REASON = "reason"
@@ -417,7 +410,7 @@ def wait_for_catalog_item_to_resolve(client, catalog_name, catalog_item_name,
         org = get_org(client, org_name=org_name)
     item = org.get_catalog_item(catalog_name, catalog_item_name)
     resource = client.get_resource(item.Entity.get('href'))
-    client.get_task_monitor().wait_for_success(resource.Tasks.Task[0])
+    wait_for_task(client, resource.Tasks.Task[0])
 
 
 def get_org(client, org_name=None):
@@ -550,59 +543,6 @@ def create_and_share_catalog(org, catalog_name, catalog_desc='', logger=None):
     return org.get_catalog(catalog_name)
 
 
-def get_vsphere(config, vapp, vm_name, logger=None):
-    """Get the VSphere object for a specific VM inside a VApp.
-
-    :param dict config: CSE config as a dictionary
-    :param pyvcloud.vcd.vapp.VApp vapp: VApp used to get the VM ID.
-    :param str vm_name:
-    :param logging.Logger logger: optional logger to log with.
-
-    :return: VSphere object for a specific VM inside a VApp
-
-    :rtype: vsphere_guest_run.vsphere.VSphere
-    """
-    global cache
-
-    # get vm id from vm resource
-    vm_id = vapp.get_vm(vm_name).get('id')
-    if vm_id not in cache:
-        client = Client(uri=config['vcd']['host'],
-                        api_version=config['vcd']['api_version'],
-                        verify_ssl_certs=config['vcd']['verify'],
-                        log_headers=True,
-                        log_bodies=True)
-        credentials = BasicLoginCredentials(config['vcd']['username'],
-                                            SYSTEM_ORG_NAME,
-                                            config['vcd']['password'])
-        client.set_credentials(credentials)
-
-        # must recreate vapp, or cluster creation fails
-        vapp = VApp(client, href=vapp.href)
-        vm_resource = vapp.get_vm(vm_name)
-        vm_sys = VM(client, resource=vm_resource)
-        vcenter_name = vm_sys.get_vc()
-        platform = Platform(client)
-        vcenter = platform.get_vcenter(vcenter_name)
-        vcenter_url = urlparse(vcenter.Url.text)
-        cache_item = {
-            'hostname': vcenter_url.hostname,
-            'port': vcenter_url.port
-        }
-        for vc in config['vcs']:
-            if vc['name'] == vcenter_name:
-                cache_item['username'] = vc['username']
-                cache_item['password'] = vc['password']
-                break
-        cache[vm_id] = cache_item
-
-    if logger:
-        logger.debug(f"VM ID: {vm_id}, Hostname: {cache[vm_id]['hostname']}")
-
-    return VSphere(cache[vm_id]['hostname'], cache[vm_id]['username'],
-                   cache[vm_id]['password'], cache[vm_id]['port'])
-
-
 def vgr_callback(prepend_msg='', logger=None):
     """Creates a callback function to use for vsphere-guest-run functions.
 
@@ -632,13 +572,12 @@ def wait_until_tools_ready(vapp, vsphere, callback=vgr_callback()):
     """Blocking function to ensure that a VSphere has VMware Tools ready.
 
     :param pyvcloud.vcd.vapp.VApp vapp:
-    :param vsphere_guest_run.vsphere.VSphere vsphere:
+    :param vsphere_guest_run.vsphere.VSphere vsphere: connected VSphere.
     :param function callback: a function to print out messages received from
         vsphere-guest-run functions. Function signature should be like this:
         def callback(message, exception=None), where parameter 'message'
         is a string.
     """
-    vsphere.connect()
     moid = vapp.get_vm_moid(vapp.name)
     vm = vsphere.get_vm_by_moid(moid)
     vsphere.wait_until_tools_ready(vm, sleep=5, callback=callback)
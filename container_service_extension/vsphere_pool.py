@@ -0,0 +1,255 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from contextlib import contextmanager
+import threading
+import time
+from urllib.parse import urlparse
+
+from cachetools import LRUCache
+from pyvcloud.vcd.platform import Platform
+from pyvcloud.vcd.vapp import VApp
+from pyvcloud.vcd.vm import VM
+from vsphere_guest_run.vsphere import VSphere
+
+from container_service_extension.client_pool import call_as_sysadmin
+from container_service_extension.logger import SERVER_LOGGER as LOGGER
+from container_service_extension.metrics import VCENTER_LOGIN_DURATION
+from container_service_extension.tracing import span
+
+# idle sessions older than this (in seconds) are checked for validity
+# before being handed out again
+_HEALTH_CHECK_AFTER = 30
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# vCenter endpoint of each VM, by VM id. It is read and written from the
+# guest operation threads, and cachetools caches are not thread-safe.
+_vcenter_info = LRUCache(maxsize=1024)
+_vcenter_info_lock = threading.Lock()
+
+
+class VSphereSessionPool(object):
+    """Pool of logged-in vCenter sessions, kept per vCenter endpoint.
+
+    A session is handed out to one caller at a time. Idle sessions are
+    reused until they expire, and sessions that vCenter has dropped are
+    replaced by a fresh login. The number of sessions handed out at the same
+    time can be capped with set_max_sessions(), past which callers wait for
+    a session to be given back.
+    """
+
+    def __init__(self, max_idle_sessions=10, idle_timeout=600):
+        """Constructor for VSphereSessionPool.
+
+        :param int max_idle_sessions: maximum number of idle sessions kept
+            per vCenter endpoint.
+        :param int idle_timeout: number of seconds after which an idle
+            session is logged out and discarded.
+        """
+        self.max_idle_sessions = max_idle_sessions
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        # bounds the number of sessions handed out, None if not capped
+        self._slots = None
+
+    def set_max_sessions(self, max_sessions):
+        """Cap the number of sessions handed out at the same time.
+
+        Must be called while no session is handed out.
+
+        :param int max_sessions: maximum number of sessions handed out at
+            the same time, or None to remove the cap.
+        """
+        self._slots = None
+        if max_sessions is not None:
+            self._slots = threading.BoundedSemaphore(max_sessions)
+
+    def acquire(self, vc_info):
+        """Get a logged-in session to a vCenter.
+
+        :param dict vc_info: vCenter endpoint, with keys 'hostname', 'port',
+            'username' and 'password'.
+
+        :return: connected VSphere object, to be given back with release().
+
+        :rtype: vsphere_guest_run.vsphere.VSphere
+        """
+        slots = self._slots
+        if slots is not None:
+            slots.acquire()
+        try:
+            return self._acquire(vc_info)
+        except Exception:
+            if slots is not None:
+                slots.release()
+            raise
+
+    def _acquire(self, vc_info):
+        key = _to_key(vc_info)
+        while True:
+            with self._lock:
+                idle_sessions = self._idle.get(key)
+                if not idle_sessions:
+                    break
+                vs, last_used = idle_sessions.pop()
+            idle_time = time.time() - last_used
+            if idle_time > self.idle_timeout:
+                _logout(vs)
+                continue
+            if idle_time < _HEALTH_CHECK_AFTER or _is_alive(vs):
+                return vs
+            LOGGER.debug('vCenter session to %s:%s was lost' % key[:2])
+
+        LOGGER.debug('logging in to vCenter %s:%s as %s' % key)
+        vs = VSphere(vc_info['hostname'], vc_info['username'],
+                     vc_info['password'], vc_info['port'])
+        with VCENTER_LOGIN_DURATION.time(), \
+                span('vcenter login', attributes={'vcenter': key[0]}):
+            vs.connect()
+        return vs
+
+    def release(self, vc_info, vs, discard=False):
+        """Give a session back to the pool.
+
+        :param dict vc_info: vCenter endpoint the session was acquired for.
+        :param vsphere_guest_run.vsphere.VSphere vs: session obtained
+            through acquire().
+        :param bool discard: if True, the session is logged out instead of
+            being kept for reuse.
+        """
+        try:
+            if not discard:
+                key = _to_key(vc_info)
+                with self._lock:
+                    idle_sessions = self._idle.setdefault(key, [])
+                    if len(idle_sessions) < self.max_idle_sessions:
+                        idle_sessions.append((vs, time.time()))
+                        return
+            _logout(vs)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    def clear(self):
+        """Log out and discard all idle sessions."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for idle_sessions in idle.values():
+            for vs, _ in idle_sessions:
+                _logout(vs)
+
+
+def _to_key(vc_info):
+    return (vc_info['hostname'], vc_info['port'], vc_info['username'])
+
+
+def _is_alive(vs):
+    try:
+        session_manager = vs.service_instance.content.sessionManager
+        return session_manager.currentSession is not None
+    except Exception:
+        return False
+
+
+def _logout(vs):
+    try:
+        vs.service_instance.content.sessionManager.Logout()
+    except Exception:
+        pass
+
+
+def get_vsphere_pool(config):
+    """Get the process-wide vCenter session pool.
+
+    :param dict config: CSE config, used to size the pool the first time it
+        is requested.
+
+    :rtype: VSphereSessionPool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = VSphereSessionPool(
+                max_idle_sessions=config['service']['vsphere_max_idle_sessions'],  # noqa
+                idle_timeout=config['service']['vsphere_session_idle_timeout'])
+        return _pool
+
+
+def get_vcenter_info(config, vapp, vm_name, logger=None):
+    """Get the endpoint and credentials of the vCenter hosting a VM.
+
+    Results are cached per VM, so vCD is only asked once for each VM.
+
+    :param dict config: CSE config as a dictionary
+    :param pyvcloud.vcd.vapp.VApp vapp: VApp used to get the VM ID.
+    :param str vm_name:
+    :param logging.Logger logger: optional logger to log with.
+
+    :return: dictionary with keys 'hostname', 'port', 'username' and
+        'password'.
+
+    :rtype: dict
+    """
+    # get vm id from vm resource
+    vm_id = vapp.get_vm(vm_name).get('id')
+    with _vcenter_info_lock:
+        vc_info = _vcenter_info.get(vm_id)
+    if vc_info is None:
+        def get_vcenter(client):
+            # must recreate vapp, or cluster creation fails
+            vapp_sys = VApp(client, href=vapp.href)
+            vm_resource = vapp_sys.get_vm(vm_name)
+            vm_sys = VM(client, resource=vm_resource)
+            vcenter_name = vm_sys.get_vc()
+            platform = Platform(client)
+            return vcenter_name, platform.get_vcenter(vcenter_name)
+        vcenter_name, vcenter = call_as_sysadmin(config, get_vcenter)
+        vcenter_url = urlparse(vcenter.Url.text)
+        vc_info = {
+            'hostname': vcenter_url.hostname,
+            'port': vcenter_url.port
+        }
+        for vc in config['vcs']:
+            if vc['name'] == vcenter_name:
+                vc_info['username'] = vc['username']
+                vc_info['password'] = vc['password']
+                break
+        with _vcenter_info_lock:
+            _vcenter_info[vm_id] = vc_info
+
+    if logger:
+        logger.debug(f"VM ID: {vm_id}, Hostname: {vc_info['hostname']}")
+
+    return vc_info
+
+
+@contextmanager
+def vsphere_session(config, vapp, vm_name, logger=None):
+    """Borrow a pooled vCenter session for the vCenter hosting a VM.
+
+    The session is given back to the pool when the block exits. If the block
+    raises, the session is discarded, so that a session that vCenter dropped
+    is never reused.
+
+    :param dict config: CSE config as a dictionary
+    :param pyvcloud.vcd.vapp.VApp vapp: VApp used to get the VM ID.
+    :param str vm_name:
+    :param logging.Logger logger: optional logger to log with.
+
+    :return: connected VSphere object for the VM's vCenter.
+
+    :rtype: vsphere_guest_run.vsphere.VSphere
+    """
+    vc_info = get_vcenter_info(config, vapp, vm_name, logger=logger)
+    pool = get_vsphere_pool(config)
+    vs = pool.acquire(vc_info)
+    try:
+        yield vs
+    except Exception:
+        pool.release(vc_info, vs, discard=True)
+        raise
+    pool.release(vc_info, vs)
@@ -0,0 +1,63 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+from unittest import mock
+
+from container_service_extension.bootstrap_cache import BootstrapCache
+
+VAPP_HREF = 'https://vcd/api/vApp/vapp-1'
+NOW = 1000000.0
+
+
+@mock.patch('container_service_extension.bootstrap_cache.time.time',
+            return_value=NOW)
+class TestBootstrapCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = BootstrapCache(maxsize=2)
+
+    def test_01_master_ip(self, time):
+        self.assertIsNone(self.cache.get_master_ip(VAPP_HREF))
+        self.cache.put_master_ip(VAPP_HREF, '10.0.0.1')
+        self.assertEqual('10.0.0.1', self.cache.get_master_ip(VAPP_HREF))
+
+    def test_02_join_token_expires_before_its_ttl(self, time):
+        self.cache.put_join_token(VAPP_HREF, 'token', 3600)
+        # at most a minute before the token expires
+        time.return_value = NOW + 3539
+        self.assertEqual('token', self.cache.get_join_token(VAPP_HREF))
+        time.return_value = NOW + 3541
+        self.assertIsNone(self.cache.get_join_token(VAPP_HREF))
+
+    def test_03_short_join_token_margin(self, time):
+        self.cache.put_join_token(VAPP_HREF, 'token', 100)
+        # a tenth of the lifetime of a short token
+        time.return_value = NOW + 89
+        self.assertEqual('token', self.cache.get_join_token(VAPP_HREF))
+        time.return_value = NOW + 91
+        self.assertIsNone(self.cache.get_join_token(VAPP_HREF))
+
+    def test_04_invalidate_join_token(self, time):
+        self.cache.put_master_ip(VAPP_HREF, '10.0.0.1')
+        self.cache.put_join_token(VAPP_HREF, 'token', 3600)
+        self.cache.invalidate_join_token(VAPP_HREF)
+        self.assertIsNone(self.cache.get_join_token(VAPP_HREF))
+        self.assertEqual('10.0.0.1', self.cache.get_master_ip(VAPP_HREF))
+
+    def test_05_remove(self, time):
+        self.cache.put_master_ip(VAPP_HREF, '10.0.0.1')
+        self.cache.put_join_token(VAPP_HREF, 'token', 3600)
+        self.cache.remove(VAPP_HREF)
+        self.assertIsNone(self.cache.get_master_ip(VAPP_HREF))
+        self.assertIsNone(self.cache.get_join_token(VAPP_HREF))
+
+    def test_06_least_recently_used_is_dropped(self, time):
+        for n in range(3):
+            self.cache.put_master_ip('vapp-%s' % n, '10.0.0.%s' % n)
+        self.assertIsNone(self.cache.get_master_ip('vapp-0'))
+        self.assertEqual('10.0.0.2', self.cache.get_master_ip('vapp-2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
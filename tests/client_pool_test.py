@@ -0,0 +1,111 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import unittest
+from unittest import mock
+
+from pyvcloud.vcd.exceptions import UnauthorizedException
+
+from container_service_extension.client_pool import call_as_sysadmin
+from container_service_extension.client_pool import SysadminClientPool
+
+CONFIG = {
+    'vcd': {
+        'host': 'vcd',
+        'api_version': '31.0',
+        'verify': True,
+        'username': 'administrator',
+        'password': 'password'
+    }
+}
+
+
+@mock.patch('container_service_extension.client_pool.instrument_client')
+@mock.patch('container_service_extension.client_pool.Client')
+class TestSysadminClientPool(unittest.TestCase):
+    def test_01_idle_client_is_reused(self, client_cls, instrument):
+        pool = SysadminClientPool(CONFIG, size=2)
+        client = pool.acquire()
+        pool.release(client)
+        self.assertIs(client, pool.acquire())
+        self.assertEqual(1, client_cls.call_count)
+
+    def test_02_acquire_waits_when_all_clients_are_in_use(self, client_cls,
+                                                          instrument):
+        client_cls.side_effect = lambda **kwargs: mock.Mock()
+        pool = SysadminClientPool(CONFIG, size=1)
+        client = pool.acquire()
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        pool.release(client)
+        waiter.join(1)
+        self.assertEqual([client], acquired)
+        self.assertEqual(1, client_cls.call_count)
+        client.logout.assert_not_called()
+
+    def test_03_failed_login_frees_its_slot(self, client_cls, instrument):
+        client_cls.side_effect = lambda **kwargs: mock.Mock()
+        pool = SysadminClientPool(CONFIG, size=1)
+        with mock.patch.object(pool, '_login', side_effect=IOError()):
+            self.assertRaises(IOError, pool.acquire)
+        self.assertIsNotNone(pool.acquire())
+        self.assertEqual(2, client_cls.call_count)
+
+
+def unauthorized():
+    return UnauthorizedException(401, None, None)
+
+
+@mock.patch('container_service_extension.client_pool.get_sysadmin_pool')
+class TestCallAsSysadmin(unittest.TestCase):
+    def test_01_result(self, get_sysadmin_pool):
+        pool = get_sysadmin_pool.return_value
+        self.assertEqual('result', call_as_sysadmin(CONFIG,
+                                                    lambda c: 'result'))
+        pool.release.assert_called_once_with(pool.acquire.return_value)
+        pool.invalidate.assert_not_called()
+
+    def test_02_rejected_session_is_renewed_and_retried(self,
+                                                        get_sysadmin_pool):
+        pool = get_sysadmin_pool.return_value
+        func = mock.Mock(side_effect=[unauthorized(), 'result'])
+        self.assertEqual('result', call_as_sysadmin(CONFIG, func))
+        client = pool.acquire.return_value
+        pool.invalidate.assert_called_once_with(client)
+        self.assertEqual(2, func.call_count)
+        pool.release.assert_called_once_with(client)
+
+    def test_03_retried_once(self, get_sysadmin_pool):
+        pool = get_sysadmin_pool.return_value
+        func = mock.Mock(side_effect=unauthorized())
+        self.assertRaises(UnauthorizedException, call_as_sysadmin, CONFIG,
+                          func)
+        self.assertEqual(2, func.call_count)
+        # the client is logged in again before it goes back to the pool
+        self.assertEqual(2, pool.invalidate.call_count)
+        pool.release.assert_called_once_with(pool.acquire.return_value)
+
+    def test_04_client_failing_to_log_in_is_dropped(self, get_sysadmin_pool):
+        pool = get_sysadmin_pool.return_value
+        pool.invalidate.side_effect = IOError()
+        self.assertRaises(IOError, call_as_sysadmin, CONFIG,
+                          mock.Mock(side_effect=unauthorized()))
+        pool.discard.assert_called_once_with(pool.acquire.return_value)
+        pool.release.assert_not_called()
+
+    def test_05_other_errors_are_not_retried(self, get_sysadmin_pool):
+        pool = get_sysadmin_pool.return_value
+        func = mock.Mock(side_effect=ValueError())
+        self.assertRaises(ValueError, call_as_sysadmin, CONFIG, func)
+        self.assertEqual(1, func.call_count)
+        pool.release.assert_called_once_with(pool.acquire.return_value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import time
+import unittest
+from unittest import mock
+
+from pyvcloud.vcd.exceptions import AccessForbiddenException
+from pyvcloud.vcd.exceptions import NotFoundException
+
+from container_service_extension.cluster_index import ClusterIndex
+from container_service_extension.cluster_index import find_clusters
+from container_service_extension.cluster_index import reconcile
+
+
+def new_cluster(name, vdc, cluster_id):
+    return {
+        'name': name,
+        'cluster_id': cluster_id,
+        'vdc_href': 'https://vcd/api/vdc/%s' % vdc,
+        'vapp_href': 'https://vcd/api/vApp/vapp-%s-%s' % (vdc, name)
+    }
+
+
+class TestClusterIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = ClusterIndex()
+
+    def test_01_same_name_in_two_vdcs(self):
+        c1 = new_cluster('c', 'vdc1', 'id1')
+        c2 = new_cluster('c', 'vdc2', 'id2')
+        self.index.put('org1', c1)
+        self.index.put('org1', c2)
+        clusters = self.index.get('org1', 'c')
+        self.assertEqual(['id1', 'id2'],
+                         sorted(c['cluster_id'] for c in clusters))
+        self.assertEqual([], self.index.get('org2', 'c'))
+        self.assertEqual(c2, self.index.get_by_id('id2'))
+
+    def test_02_put_replaces_the_cluster(self):
+        self.index.put('org1', new_cluster('c', 'vdc1', 'id1'))
+        self.index.put('org1', new_cluster('c', 'vdc1', 'id2'))
+        clusters = self.index.get('org1', 'c')
+        self.assertEqual(['id2'], [c['cluster_id'] for c in clusters])
+        self.assertIsNone(self.index.get_by_id('id1'))
+
+    def test_03_entries_are_copies(self):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        self.index.put('org1', cluster)
+        cluster['name'] = 'changed'
+        self.index.get('org1', 'c')[0]['name'] = 'changed'
+        self.assertEqual('c', self.index.get('org1', 'c')[0]['name'])
+
+    def test_04_remove_by_vapp_href(self):
+        c1 = new_cluster('c', 'vdc1', 'id1')
+        c2 = new_cluster('c', 'vdc2', 'id2')
+        self.index.put('org1', c1)
+        self.index.put('org1', c2)
+        self.index.remove(c1['vapp_href'])
+        self.assertEqual([c2], self.index.get('org1', 'c'))
+        self.assertIsNone(self.index.get_by_id('id1'))
+        # removing a cluster that isn't indexed is not an error
+        self.index.remove(c1['vapp_href'])
+
+    def test_05_replace_all(self):
+        self.index.put('org1', new_cluster('old', 'vdc1', 'id0'))
+        self.index.replace_all([
+            ('org1', new_cluster('c', 'vdc1', 'id1')),
+            ('org1', new_cluster('c', 'vdc2', 'id2')),
+            ('org2', new_cluster('c', 'vdc3', 'id3'))
+        ], time.time())
+        self.assertEqual([], self.index.get('org1', 'old'))
+        self.assertEqual(2, len(self.index.get('org1', 'c')))
+        self.assertEqual(1, len(self.index.get('org2', 'c')))
+
+    def test_06_replace_all_keeps_later_removals(self):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        started_at = time.time()
+        self.index.put('org1', cluster)
+        self.index.remove(cluster['vapp_href'])
+        # the listing started before the cluster was removed
+        self.index.replace_all([('org1', cluster)], started_at)
+        self.assertEqual([], self.index.get('org1', 'c'))
+        # a later listing that still has the cluster adds it back
+        self.index.replace_all([('org1', cluster)], time.time() + 1)
+        self.assertEqual([cluster], self.index.get('org1', 'c'))
+
+
+@mock.patch('container_service_extension.cluster_index.load_from_metadata')
+class TestFindClusters(unittest.TestCase):
+    def setUp(self):
+        self.index = ClusterIndex()
+        patcher = mock.patch(
+            'container_service_extension.cluster_index.get_cluster_index',
+            return_value=self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock()
+
+    def test_01_miss_queries_vcd(self, load_from_metadata):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        load_from_metadata.return_value = [cluster]
+        self.assertEqual([cluster], find_clusters(self.client, 'org1', 'c'))
+        load_from_metadata.assert_called_once_with(self.client, name='c')
+        self.assertEqual([cluster], self.index.get('org1', 'c'))
+
+    def test_02_hit_is_checked_with_tenant_client(self, load_from_metadata):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        self.index.put('org1', cluster)
+        self.assertEqual([cluster], find_clusters(self.client, 'org1', 'c'))
+        self.client.get_resource.assert_called_once_with(
+            cluster['vapp_href'])
+        load_from_metadata.assert_not_called()
+
+    def test_03_hit_not_visible_to_tenant(self, load_from_metadata):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        self.index.put('org1', cluster)
+        self.client.get_resource.side_effect = AccessForbiddenException(
+            403, None, None)
+        load_from_metadata.return_value = []
+        self.assertEqual([], find_clusters(self.client, 'org1', 'c'))
+        # other users of the org may still see the cluster
+        self.assertEqual([cluster], self.index.get('org1', 'c'))
+
+    def test_04_hit_deleted_in_vcd(self, load_from_metadata):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        self.index.put('org1', cluster)
+        self.client.get_resource.side_effect = NotFoundException(
+            404, None, None)
+        load_from_metadata.return_value = []
+        self.assertEqual([], find_clusters(self.client, 'org1', 'c'))
+        self.assertEqual([], self.index.get('org1', 'c'))
+
+    def test_05_system_administrator(self, load_from_metadata):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+        self.index.put('org1', cluster)
+        load_from_metadata.return_value = [cluster]
+        self.assertEqual([cluster], find_clusters(self.client, None, 'c'))
+        load_from_metadata.assert_called_once_with(self.client, name='c')
+
+    def test_06_other_org_does_not_get_hit(self, load_from_metadata):
+        self.index.put('org1', new_cluster('c', 'vdc1', 'id1'))
+        load_from_metadata.return_value = []
+        self.assertEqual([], find_clusters(self.client, 'org2', 'c'))
+        self.client.get_resource.assert_not_called()
+        load_from_metadata.assert_called_once_with(self.client, name='c')
+
+    def test_07_one_hit_not_visible(self, load_from_metadata):
+        c1 = new_cluster('c', 'vdc1', 'id1')
+        c2 = new_cluster('c', 'vdc2', 'id2')
+        self.index.put('org1', c1)
+        self.index.put('org1', c2)
+
+        def get_resource(href):
+            if href == c2['vapp_href']:
+                raise AccessForbiddenException(403, None, None)
+        self.client.get_resource.side_effect = get_resource
+        load_from_metadata.return_value = [c1]
+        # the tenant only gets the clusters vCD shows it
+        self.assertEqual([c1], find_clusters(self.client, 'org1', 'c'))
+        self.assertEqual(2, len(self.index.get('org1', 'c')))
+
+
+CLIENT = mock.Mock()
+
+
+def new_record(name, vdc, cluster_id, org_id):
+    return {
+        'name': name,
+        'cluster_id': cluster_id,
+        'vdc': vdc,
+        'org': 'urn:vcloud:org:%s' % org_id
+    }
+
+
+@mock.patch('container_service_extension.cluster_index.to_cluster',
+            side_effect=lambda client, record: new_cluster(
+                record['name'], record['vdc'], record['cluster_id']))
+@mock.patch('container_service_extension.cluster_index.iter_cluster_records')
+@mock.patch('container_service_extension.cluster_index.call_as_sysadmin',
+            side_effect=lambda config, func: func(CLIENT))
+class TestReconcile(unittest.TestCase):
+    def setUp(self):
+        self.index = ClusterIndex()
+        patcher = mock.patch(
+            'container_service_extension.cluster_index.get_cluster_index',
+            return_value=self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_01_index_is_replaced_by_listing(self, call_as_sysadmin,
+                                             iter_cluster_records,
+                                             to_cluster):
+        self.index.put('org1', new_cluster('gone', 'vdc1', 'id0'))
+        iter_cluster_records.return_value = iter([
+            new_record('c', 'vdc1', 'id1', 'org1'),
+            new_record('c', 'vdc2', 'id2', 'org2')
+        ])
+        reconcile({})
+        iter_cluster_records.assert_called_once_with(CLIENT, page_size=128)
+        self.assertEqual([], self.index.get('org1', 'gone'))
+        self.assertEqual(['id1'],
+                         [c['cluster_id'] for c in self.index.get('org1',
+                                                                  'c')])
+        self.assertEqual(['id2'],
+                         [c['cluster_id'] for c in self.index.get('org2',
+                                                                  'c')])
+
+    def test_02_removal_during_listing_is_kept(self, call_as_sysadmin,
+                                               iter_cluster_records,
+                                               to_cluster):
+        cluster = new_cluster('c', 'vdc1', 'id1')
+
+        def records(client, page_size):
+            # the cluster is deleted while the listing is in progress
+            self.index.remove(cluster['vapp_href'])
+            yield new_record('c', 'vdc1', 'id1', 'org1')
+        iter_cluster_records.side_effect = records
+        reconcile({})
+        self.assertEqual([], self.index.get('org1', 'c'))
+        self.assertIsNone(self.index.get_by_id('id1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from container_service_extension.consumer import MessageConsumer
+from container_service_extension.processor import ACCEPTED
+from container_service_extension.reply_store import ReplyStore
+
+OK = 200
+
+
+def new_message(request_id, delivery_tag=1, redelivered=False):
+    basic_deliver = mock.Mock(delivery_tag=delivery_tag,
+                              redelivered=redelivered)
+    properties = mock.Mock(reply_to='reply', correlation_id=request_id,
+                           headers={'replyToExchange': 'exchange'})
+    body = json.dumps([{
+        'id': request_id,
+        'method': 'POST',
+        'requestUri': '/api/cse',
+        'headers': {'Accept': 'application/json'},
+        'body': ''
+    }]).encode()
+    return basic_deliver, properties, body
+
+
+class TestMessageConsumer(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.store_path = os.path.join(tmp_dir.name, 'replies.db')
+        self.consumer = self.new_consumer()
+        self.channel = mock.Mock()
+        self.consumer._channel = self.channel
+        self.process = mock.Mock(
+            return_value=(b'{"href": "task"}', ACCEPTED, None, None))
+        self.consumer.process_message = self.process
+
+    def new_consumer(self):
+        consumer = MessageConsumer('amqp', 5672, False, '/', 'guest',
+                                   'guest', 'exchange', 'cse', {}, False,
+                                   reply_store=ReplyStore(self.store_path,
+                                                          'secret'))
+        self.addCleanup(consumer._executor.shutdown)
+        self.addCleanup(consumer._loop.close)
+        return consumer
+
+    def handle(self, *messages):
+        async def handle_all():
+            await asyncio.gather(*[
+                self.consumer.handle_message(self.channel, basic_deliver,
+                                             properties, body, 0)
+                for basic_deliver, properties, body in messages
+            ])
+        self.consumer._loop.run_until_complete(handle_all())
+
+    def test_01_ack_after_reply(self):
+        self.handle(new_message('r1', delivery_tag=7))
+        self.assertEqual(['basic_publish', 'basic_ack'],
+                         [call[0] for call in self.channel.mock_calls])
+        self.channel.basic_ack.assert_called_once_with(7)
+
+    def test_02_no_ack_when_processing_fails(self):
+        self.process.side_effect = RuntimeError()
+        with self.assertRaises(RuntimeError):
+            self.handle(new_message('r1'))
+        self.channel.basic_publish.assert_not_called()
+        self.channel.basic_ack.assert_not_called()
+
+    def test_03_no_ack_on_closed_channel(self):
+        old_channel = self.channel
+        self.consumer._channel = mock.Mock()
+        self.handle(new_message('r1'))
+        # the message will be redelivered on the new channel
+        old_channel.basic_ack.assert_not_called()
+        self.consumer._channel.basic_ack.assert_not_called()
+
+    def test_04_redelivered_operation_is_answered_from_store(self):
+        self.handle(new_message('r1', delivery_tag=1))
+        self.handle(new_message('r1', delivery_tag=2, redelivered=True))
+        self.assertEqual(1, self.process.call_count)
+        self.assertEqual(2, self.channel.basic_publish.call_count)
+        self.channel.basic_ack.assert_called_with(2)
+
+    def test_05_final_reply_is_kept(self):
+        self.process.return_value = (b'{}', OK, None, None)
+        self.handle(new_message('r1', delivery_tag=1))
+        self.handle(new_message('r1', delivery_tag=2, redelivered=True))
+        self.assertEqual(1, self.process.call_count)
+
+    def test_06_redelivered_while_processing(self):
+        release = threading.Event()
+
+        def process(*args):
+            release.wait(5)
+            return b'{"href": "task"}', ACCEPTED, None, None
+        self.process.side_effect = process
+        self.consumer._loop.call_later(0.1, release.set)
+        self.handle(new_message('r1', delivery_tag=1),
+                    new_message('r1', delivery_tag=2, redelivered=True))
+        self.assertEqual(1, self.process.call_count)
+        self.assertEqual(2, self.channel.basic_ack.call_count)
+
+    def test_07_reply_is_shared_with_other_listeners(self):
+        # e.g. a listener of another worker process, or of a restarted one
+        self.handle(new_message('r1', delivery_tag=1))
+        other = self.new_consumer()
+        other.process_message = mock.Mock()
+        other_channel = mock.Mock()
+        other._channel = other_channel
+
+        async def handle():
+            basic_deliver, properties, body = new_message(
+                'r1', delivery_tag=5, redelivered=True)
+            await other.handle_message(other_channel, basic_deliver,
+                                       properties, body, 0)
+        other._loop.run_until_complete(handle())
+        other.process_message.assert_not_called()
+        other_channel.basic_publish.assert_called_once()
+        other_channel.basic_ack.assert_called_once_with(5)
+
+    def test_08_failed_processing_is_not_kept(self):
+        self.process.side_effect = [RuntimeError(),
+                                    (b'{}', OK, None, None)]
+        with self.assertRaises(RuntimeError):
+            self.handle(new_message('r1', delivery_tag=1))
+        self.handle(new_message('r1', delivery_tag=2, redelivered=True))
+        self.assertEqual(2, self.process.call_count)
+        self.channel.basic_ack.assert_called_once_with(2)
+
+    def test_09_malformed_message_is_rejected(self):
+        basic_deliver, properties, _ = new_message('r1', delivery_tag=3)
+        self.handle((basic_deliver, properties, b'not json'))
+        self.process.assert_not_called()
+        self.channel.basic_reject.assert_called_once_with(3, requeue=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+
+from container_service_extension.kubeconfig_cache import KubeconfigCache
+
+KUBECONFIG = 'apiVersion: v1\nusers:\n- name: admin\n'
+
+
+class TestKubeconfigCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = KubeconfigCache(maxsize=2)
+
+    def test_01_put_and_get(self):
+        version = self.cache.put('id1', KUBECONFIG)
+        self.assertEqual((KUBECONFIG, version), self.cache.get('id1'))
+        self.assertIsNone(self.cache.get('id2'))
+
+    def test_02_kept_encrypted(self):
+        self.cache.put('id1', KUBECONFIG)
+        token, version = self.cache._cache['id1']
+        self.assertNotIn(b'admin', token)
+
+    def test_03_version_changes_with_content(self):
+        version = self.cache.put('id1', KUBECONFIG)
+        self.assertEqual(version, self.cache.put('id1', KUBECONFIG))
+        rotated = self.cache.put('id1', KUBECONFIG + '- name: new\n')
+        self.assertNotEqual(version, rotated)
+        self.assertEqual(rotated, self.cache.get('id1')[1])
+
+    def test_04_remove(self):
+        self.cache.put('id1', KUBECONFIG)
+        self.cache.remove('id1')
+        self.assertIsNone(self.cache.get('id1'))
+        # removing a kubeconfig that isn't cached is not an error
+        self.cache.remove('id1')
+
+    def test_05_least_recently_used_is_dropped(self):
+        self.cache.put('id1', KUBECONFIG)
+        self.cache.put('id2', KUBECONFIG)
+        self.cache.get('id1')
+        self.cache.put('id3', KUBECONFIG)
+        self.assertIsNotNone(self.cache.get('id1'))
+        self.assertIsNone(self.cache.get('id2'))
+        self.assertIsNotNone(self.cache.get('id3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+
+from container_service_extension.metrics import merge
+
+WORKER_0 = '''# HELP cse_requests_total Requests.
+# TYPE cse_requests_total counter
+cse_requests_total{route="a"} 1
+# HELP cse_duration_seconds Durations.
+# TYPE cse_duration_seconds histogram
+cse_duration_seconds_bucket{le="1.0"} 1
+cse_duration_seconds_bucket{le="+Inf"} 1
+cse_duration_seconds_sum 0.5
+cse_duration_seconds_count 1
+'''
+
+WORKER_1 = '''# HELP cse_requests_total Requests.
+# TYPE cse_requests_total counter
+cse_requests_total{route="a"} 2
+cse_requests_total{route="b"} 1
+# HELP cse_duration_seconds Durations.
+# TYPE cse_duration_seconds histogram
+cse_duration_seconds_bucket{le="1.0"} 0
+cse_duration_seconds_bucket{le="+Inf"} 1
+cse_duration_seconds_sum 2.5
+cse_duration_seconds_count 1
+'''
+
+
+class TestMerge(unittest.TestCase):
+    def test_01_samples_are_summed(self):
+        self.assertEqual(
+            '# HELP cse_requests_total Requests.\n'
+            '# TYPE cse_requests_total counter\n'
+            'cse_requests_total{route="a"} 3\n'
+            'cse_requests_total{route="b"} 1\n'
+            '# HELP cse_duration_seconds Durations.\n'
+            '# TYPE cse_duration_seconds histogram\n'
+            'cse_duration_seconds_bucket{le="1.0"} 1\n'
+            'cse_duration_seconds_bucket{le="+Inf"} 2\n'
+            'cse_duration_seconds_sum 3.0\n'
+            'cse_duration_seconds_count 2\n',
+            merge([WORKER_0, WORKER_1]))
+
+    def test_02_single_process(self):
+        self.assertEqual(WORKER_0, merge([WORKER_0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from container_service_extension.reply_store import BUSY
+from container_service_extension.reply_store import CLAIMED
+from container_service_extension.reply_store import REPLIED
+from container_service_extension.reply_store import ReplyStore
+
+REPLY = (b'{"kubeconfig": "secret"}', 200, None, {'ETag': '"1"'})
+
+
+class TestReplyStore(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, 'replies.db')
+        self.store = ReplyStore(self.path, 'secret')
+
+    def test_01_claim_and_reply(self):
+        self.assertEqual((CLAIMED, None), self.store.claim('r1'))
+        self.assertEqual((BUSY, None), self.store.claim('r1'))
+        self.store.put('r1', REPLY)
+        self.assertEqual((REPLIED, REPLY), self.store.claim('r1'))
+
+    def test_02_replies_survive_restarts(self):
+        self.store.claim('r1')
+        self.store.put('r1', REPLY)
+        self.assertEqual((REPLIED, REPLY),
+                         ReplyStore(self.path, 'secret').claim('r1'))
+
+    def test_03_replies_are_encrypted(self):
+        self.store.claim('r1')
+        self.store.put('r1', REPLY)
+        with open(self.path, 'rb') as f:
+            self.assertNotIn(b'kubeconfig', f.read())
+        # e.g. after the vCD password was changed
+        self.assertEqual((CLAIMED, None),
+                         ReplyStore(self.path, 'other').claim('r1'))
+
+    @mock.patch('container_service_extension.reply_store._is_alive',
+                return_value=True)
+    @mock.patch('container_service_extension.reply_store.os.getpid')
+    def test_04_claim_of_live_process_is_kept(self, getpid, is_alive):
+        getpid.return_value = 1
+        self.store.claim('r1')
+        getpid.return_value = 2
+        self.assertEqual((BUSY, None),
+                         ReplyStore(self.path, 'secret').claim('r1'))
+
+    @mock.patch('container_service_extension.reply_store._is_alive',
+                return_value=False)
+    @mock.patch('container_service_extension.reply_store.os.getpid')
+    def test_05_claim_of_stopped_process_is_taken_over(self, getpid,
+                                                       is_alive):
+        getpid.return_value = 1
+        self.store.claim('r1')
+        getpid.return_value = 2
+        self.assertEqual((CLAIMED, None),
+                         ReplyStore(self.path, 'secret').claim('r1'))
+
+    def test_06_released_claim(self):
+        self.store.claim('r1')
+        self.store.release('r1')
+        self.assertEqual((CLAIMED, None), self.store.claim('r1'))
+
+    @mock.patch('container_service_extension.reply_store.time')
+    def test_07_replies_expire(self, time):
+        store = ReplyStore(self.path, 'secret', ttl=600)
+        time.time.return_value = 1000
+        store.claim('r1')
+        store.put('r1', REPLY)
+        time.time.return_value = 1000 + 601
+        self.assertEqual((CLAIMED, None), store.claim('r1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
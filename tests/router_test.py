@@ -0,0 +1,140 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+from unittest import mock
+
+from container_service_extension.exceptions import CseServerError
+from container_service_extension.processor import NOT_MODIFIED
+from container_service_extension.processor import OK
+from container_service_extension.processor import ServiceProcessor
+from container_service_extension.router import NOT_FOUND
+from container_service_extension.router import Request
+from container_service_extension.router import Router
+
+
+def handler(name):
+    def handle(request, **params):
+        return {'status_code': OK, 'body': {'handler': name, **params}}
+    return handle
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = Router(prefix='/api')
+        self.router.add_route('GET', '/cse', handler('list'))
+        self.router.add_route('GET', '/cse/system', handler('system'))
+        self.router.add_route('GET', '/cse/{cluster}/info', handler('info'))
+        self.router.add_route('GET', '/cse/{cluster}/{node}/info',
+                              handler('node_info'))
+        self.router.add_route('DELETE', '/cse/{cluster}', handler('delete'))
+
+    def dispatch(self, method, path):
+        return self.router.dispatch(Request(method, path))
+
+    def test_01_static_route(self):
+        reply = self.dispatch('GET', '/api/cse/system')
+        self.assertEqual({'handler': 'system'}, reply['body'])
+        # a static route wins over a pattern that also matches
+        reply = self.dispatch('GET', '/api/cse/')
+        self.assertEqual({'handler': 'list'}, reply['body'])
+
+    def test_02_path_parameters(self):
+        reply = self.dispatch('GET', '/api/cse/c1/info')
+        self.assertEqual({'handler': 'info', 'cluster': 'c1'},
+                         reply['body'])
+        reply = self.dispatch('GET', '/api/cse/c1/node-abc/info?x=1')
+        self.assertEqual(
+            {'handler': 'node_info', 'cluster': 'c1', 'node': 'node-abc'},
+            reply['body'])
+
+    def test_03_method_is_part_of_the_route(self):
+        reply = self.dispatch('DELETE', '/api/cse/c1')
+        self.assertEqual({'handler': 'delete', 'cluster': 'c1'},
+                         reply['body'])
+        reply = self.dispatch('GET', '/api/cse/c1')
+        self.assertEqual(NOT_FOUND, reply['status_code'])
+
+    def test_04_not_found(self):
+        reply = self.dispatch('GET', '/api/cse/c1/info/extra')
+        self.assertEqual(NOT_FOUND, reply['status_code'])
+
+    def test_05_middleware_order(self):
+        calls = []
+
+        def middleware(name):
+            def run(request, route, call_next):
+                calls.append(name)
+                return call_next(request)
+            return run
+
+        router = Router(middleware=[middleware('outer')])
+        router.add_route('GET', '/cse', handler('list'),
+                         middleware=[middleware('inner')])
+        router.dispatch(Request('GET', '/cse'))
+        self.assertEqual(['outer', 'inner'], calls)
+
+
+class TestServiceProcessor(unittest.TestCase):
+    def setUp(self):
+        self.processor = ServiceProcessor({}, False, False)
+        self.processor._service = mock.Mock(is_enabled=False)
+
+    def get(self, path):
+        return self.processor.process_request({
+            'method': 'GET',
+            'requestUri': path,
+            'headers': {},
+            'body': ''
+        })
+
+    def test_01_disabled_service(self):
+        for path in ('/api/cse', '/api/cse/c1/info', '/api/cse/template',
+                     '/api/cse/swagger.yaml'):
+            with self.assertRaises(CseServerError):
+                self.get(path)
+
+    def test_02_spec_served_when_enabled(self):
+        self.processor._service.is_enabled = True
+        self.assertEqual(OK, self.get('/api/cse/swagger.json')['status_code'])
+
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        self.processor = ServiceProcessor({}, False, False)
+        self.processor._service = mock.Mock(is_enabled=True)
+
+    def get(self, path, headers=None):
+        return self.processor.process_request({
+            'method': 'GET',
+            'requestUri': path,
+            'headers': headers or {},
+            'body': ''
+        })
+
+    def test_01_etag(self):
+        reply = self.get('/api/cse/swagger.yaml')
+        self.assertEqual(OK, reply['status_code'])
+        self.assertIn('ETag', reply['headers'])
+        json_reply = self.get('/api/cse/swagger.json')
+        self.assertNotEqual(reply['headers']['ETag'],
+                            json_reply['headers']['ETag'])
+
+    def test_02_not_modified(self):
+        etag = self.get('/api/cse/swagger.yaml')['headers']['ETag']
+        reply = self.get('/api/cse/swagger.yaml',
+                         headers={'if-none-match': '"other", %s' % etag})
+        self.assertEqual(NOT_MODIFIED, reply['status_code'])
+        self.assertEqual(b'', reply['body'])
+        self.assertEqual(etag, reply['headers']['ETag'])
+
+    def test_03_modified(self):
+        reply = self.get('/api/cse/swagger.yaml',
+                         headers={'If-None-Match': '"other"'})
+        self.assertEqual(OK, reply['status_code'])
+        self.assertTrue(len(reply['body']) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import time
+import unittest
+
+from container_service_extension.exceptions import ServiceBusyError
+from container_service_extension.scheduler import Scheduler
+from container_service_extension.scheduler import STATE_QUEUED
+from container_service_extension.scheduler import STATE_RUNNING
+
+TIMEOUT = 5
+
+
+def wait_until(condition, timeout=TIMEOUT):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.01)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.order = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        # let the worker threads of the test finish their jobs
+        self.release.set()
+
+    def job(self, name):
+        def run():
+            self.order.append(name)
+        return run
+
+    def blocking_job(self, name):
+        def run():
+            self.order.append(name)
+            self.release.wait(TIMEOUT)
+        return run
+
+    def new_scheduler(self, **kwargs):
+        scheduler = Scheduler(**kwargs)
+        wait_until(lambda: scheduler._idle_workers == scheduler.workers)
+        return scheduler
+
+    def test_01_op_limit(self):
+        scheduler = self.new_scheduler(workers=3,
+                                       op_limits={'create_cluster': 1})
+        self.assertEqual(STATE_RUNNING, scheduler.submit(
+            'create_cluster', self.blocking_job('c1'), org='a'))
+        wait_until(lambda: self.order == ['c1'])
+        self.assertEqual(STATE_QUEUED, scheduler.submit(
+            'create_cluster', self.job('c2'), org='b'))
+        self.assertEqual(STATE_RUNNING, scheduler.submit(
+            'delete_cluster', self.job('d1'), org='b'))
+        wait_until(lambda: 'd1' in self.order)
+        self.assertEqual(1, scheduler.running_count())
+        self.assertEqual(1, scheduler.queued_count())
+        self.assertNotIn('c2', self.order)
+        self.release.set()
+        wait_until(lambda: 'c2' in self.order)
+        wait_until(lambda: scheduler.active_count() == 0)
+
+    def test_02_full_queue(self):
+        scheduler = self.new_scheduler(workers=1, queue_size=2)
+        scheduler.submit('op', self.blocking_job('x'))
+        wait_until(lambda: self.order == ['x'])
+        scheduler.submit('op', self.job('a'))
+        scheduler.submit('op', self.job('b'))
+        with self.assertRaises(ServiceBusyError):
+            scheduler.submit('op', self.job('c'))
+        self.assertEqual(2, scheduler.queued_count())
+
+    def test_03_orgs_share_workers_in_turn(self):
+        scheduler = self.new_scheduler(workers=1)
+        scheduler.submit('op', self.blocking_job('x'), org='x')
+        wait_until(lambda: self.order == ['x'])
+        for n in range(3):
+            scheduler.submit('op', self.job('a%s' % n), org='a')
+        scheduler.submit('op', self.job('b0'), org='b')
+        self.release.set()
+        wait_until(lambda: len(self.order) == 5)
+        # b doesn't wait for all the jobs a submitted before it
+        self.assertEqual(['x', 'a0', 'b0', 'a1', 'a2'], self.order)
+
+    def test_04_org_weights(self):
+        scheduler = self.new_scheduler(workers=1, org_weights={'a': 2})
+        scheduler.submit('op', self.blocking_job('x'), org='x')
+        wait_until(lambda: self.order == ['x'])
+        for n in range(4):
+            scheduler.submit('op', self.job('a'), org='a')
+            scheduler.submit('op', self.job('b'), org='b')
+        self.release.set()
+        wait_until(lambda: len(self.order) == 9)
+        # a gets twice the share of b while both have jobs queued
+        self.assertEqual(['a', 'b', 'a', 'a', 'b', 'a'], self.order[1:7])
+
+    def test_05_org_cap(self):
+        scheduler = self.new_scheduler(workers=3, org_max_ops=1,
+                                       org_caps={'big': 2})
+        self.assertEqual(STATE_RUNNING, scheduler.submit(
+            'op', self.blocking_job('a1'), org='a'))
+        wait_until(lambda: self.order == ['a1'])
+        self.assertEqual(STATE_QUEUED, scheduler.submit(
+            'op', self.job('a2'), org='a'))
+        self.assertEqual(STATE_RUNNING, scheduler.submit(
+            'op', self.blocking_job('big1'), org='big'))
+        wait_until(lambda: scheduler.running_count() == 2)
+        self.assertEqual({'running': 1, 'queued': 1},
+                         scheduler.org_stats()['a'])
+        self.release.set()
+        wait_until(lambda: scheduler.active_count() == 0)
+        self.assertIn('a2', self.order)
+
+    def test_06_full_org_queue(self):
+        scheduler = self.new_scheduler(workers=1, queue_size=3,
+                                       org_queue_size=2)
+        scheduler.submit('op', self.blocking_job('x'), org='x')
+        wait_until(lambda: self.order == ['x'])
+        scheduler.submit('op', self.job('a'), org='a')
+        scheduler.submit('op', self.job('a'), org='a')
+        with self.assertRaises(ServiceBusyError):
+            scheduler.submit('op', self.job('a'), org='a')
+        scheduler.submit('op', self.job('b'), org='b')
+        with self.assertRaises(ServiceBusyError):
+            scheduler.submit('op', self.job('c'), org='c')
+
+
+if __name__ == '__main__':
+    unittest.main()
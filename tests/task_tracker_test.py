@@ -0,0 +1,112 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import unittest
+from unittest import mock
+
+from lxml import objectify
+from pyvcloud.vcd.exceptions import InternalServerException
+from pyvcloud.vcd.exceptions import NotFoundException
+from pyvcloud.vcd.exceptions import TaskTimeoutException
+from pyvcloud.vcd.exceptions import VcdTaskException
+
+from container_service_extension.task_tracker import TaskTracker
+
+TIMEOUT = 5
+HREF = 'https://vcd/api/task/1'
+
+
+def new_task(status, href=HREF):
+    return objectify.fromstring(
+        '<Task href="%s" status="%s"/>' % (href, status))
+
+
+class TestTaskTracker(unittest.TestCase):
+    def setUp(self):
+        self.tracker = TaskTracker(poll_frequency=0.01)
+        self.client = mock.Mock()
+
+    def test_01_task_already_done(self):
+        future = self.tracker.track(self.client, new_task('success'))
+        self.assertEqual('success', future.result(TIMEOUT).get('status'))
+        self.client.get_resource.assert_not_called()
+
+    def test_02_task_succeeds(self):
+        self.client.get_resource.side_effect = [
+            new_task('running'), new_task('success')]
+        future = self.tracker.track(self.client, new_task('queued'))
+        self.assertEqual('success', future.result(TIMEOUT).get('status'))
+        self.client.get_resource.assert_called_with(HREF)
+
+    def test_03_task_fails(self):
+        self.client.get_resource.return_value = new_task('error')
+        future = self.tracker.track(self.client, new_task('running'))
+        self.assertIsInstance(future.exception(TIMEOUT), VcdTaskException)
+
+    def test_04_waiters_share_polls(self):
+        self.client.get_resource.side_effect = [new_task('success')]
+        futures = [self.tracker.track(self.client, new_task('running'))
+                   for _ in range(3)]
+        for future in futures:
+            self.assertEqual('success',
+                             future.result(TIMEOUT).get('status'))
+        self.assertEqual(1, self.client.get_resource.call_count)
+        self.assertEqual(0, self.tracker.pending_count())
+
+    def test_05_transient_poll_error_is_retried(self):
+        self.client.get_resource.side_effect = [
+            InternalServerException(500, None, None), new_task('success')]
+        future = self.tracker.track(self.client, new_task('running'))
+        self.assertEqual('success', future.result(TIMEOUT).get('status'))
+
+    def test_06_client_error_fails_waiters(self):
+        self.client.get_resource.side_effect = NotFoundException(
+            404, None, None)
+        future = self.tracker.track(self.client, new_task('running'))
+        self.assertIsInstance(future.exception(TIMEOUT), NotFoundException)
+        self.assertEqual(1, self.client.get_resource.call_count)
+
+    def test_07_timeout(self):
+        self.client.get_resource.return_value = new_task('running')
+        future = self.tracker.track(self.client, new_task('running'),
+                                    timeout=0.05)
+        self.assertIsInstance(future.exception(TIMEOUT),
+                              TaskTimeoutException)
+
+    def test_08_no_timeout_by_default(self):
+        polls = []
+
+        def get_resource(href):
+            polls.append(href)
+            if len(polls) < 20:
+                return new_task('running')
+            return new_task('success')
+        self.client.get_resource.side_effect = get_resource
+        future = self.tracker.track(self.client, new_task('running'))
+        self.assertEqual('success', future.result(TIMEOUT).get('status'))
+        self.assertEqual(20, len(polls))
+
+    def test_09_tasks_are_polled_concurrently(self):
+        # each poll waits for the other one, so polls made one after the
+        # other would fail
+        barrier = threading.Barrier(2, timeout=TIMEOUT)
+        # both tasks are tracked before the first pass
+        tracker = TaskTracker(poll_frequency=0.5)
+
+        def get_resource(href):
+            barrier.wait()
+            return new_task('success', href=href)
+        self.client.get_resource.side_effect = get_resource
+        futures = [
+            tracker.track(self.client, new_task('running', href=href))
+            for href in (HREF, HREF + '2')
+        ]
+        for future in futures:
+            self.assertEqual('success',
+                             future.result(TIMEOUT).get('status'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# container-service-extension
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import threading
+import unittest
+from unittest import mock
+
+from container_service_extension.vsphere_pool import VSphereSessionPool
+
+VC_INFO = {
+    'hostname': 'vc1',
+    'port': 443,
+    'username': 'administrator@vsphere.local',
+    'password': 'password'
+}
+
+
+def session_manager(vs):
+    return vs.service_instance.content.sessionManager
+
+
+@mock.patch('container_service_extension.vsphere_pool.time')
+@mock.patch('container_service_extension.vsphere_pool.VSphere',
+            side_effect=lambda *args: mock.Mock())
+class TestVSphereSessionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = VSphereSessionPool(max_idle_sessions=2, idle_timeout=600)
+
+    def test_01_idle_session_is_reused(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        vs = self.pool.acquire(VC_INFO)
+        vs.connect.assert_called_once_with()
+        self.pool.release(VC_INFO, vs)
+        time.time.return_value = 1010
+        self.assertIs(vs, self.pool.acquire(VC_INFO))
+        self.assertEqual(1, vsphere_cls.call_count)
+
+    def test_02_expired_session_is_logged_out(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        vs = self.pool.acquire(VC_INFO)
+        self.pool.release(VC_INFO, vs)
+        time.time.return_value = 1000 + 601
+        new_vs = self.pool.acquire(VC_INFO)
+        self.assertIsNot(vs, new_vs)
+        session_manager(vs).Logout.assert_called_once_with()
+        new_vs.connect.assert_called_once_with()
+
+    def test_03_old_idle_session_is_checked(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        vs = self.pool.acquire(VC_INFO)
+        self.pool.release(VC_INFO, vs)
+        time.time.return_value = 1000 + 60
+        # the session is still alive, so it is reused
+        self.assertIs(vs, self.pool.acquire(VC_INFO))
+        self.assertEqual(1, vsphere_cls.call_count)
+
+    def test_04_lost_session_is_replaced(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        vs = self.pool.acquire(VC_INFO)
+        self.pool.release(VC_INFO, vs)
+        session_manager(vs).currentSession = None
+        time.time.return_value = 1000 + 60
+        new_vs = self.pool.acquire(VC_INFO)
+        self.assertIsNot(vs, new_vs)
+        new_vs.connect.assert_called_once_with()
+
+    def test_05_discarded_and_extra_sessions_are_logged_out(self, vsphere_cls,
+                                                            time):
+        time.time.return_value = 1000
+        sessions = [self.pool.acquire(VC_INFO) for _ in range(4)]
+        self.pool.release(VC_INFO, sessions[0], discard=True)
+        for vs in sessions[1:]:
+            self.pool.release(VC_INFO, vs)
+        logged_out = [session_manager(vs).Logout.called for vs in sessions]
+        self.assertEqual([True, False, False, True], logged_out)
+
+    def test_06_clear(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        vs = self.pool.acquire(VC_INFO)
+        self.pool.release(VC_INFO, vs)
+        self.pool.clear()
+        session_manager(vs).Logout.assert_called_once_with()
+        self.assertIsNot(vs, self.pool.acquire(VC_INFO))
+
+    def test_07_max_sessions(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        self.pool.set_max_sessions(1)
+        vs = self.pool.acquire(VC_INFO)
+        acquired = []
+        waiter = threading.Thread(
+            target=lambda: acquired.append(self.pool.acquire(VC_INFO)))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        self.pool.release(VC_INFO, vs)
+        waiter.join(1)
+        self.assertEqual([vs], acquired)
+        self.assertEqual(1, vsphere_cls.call_count)
+
+    def test_08_failed_login_frees_its_slot(self, vsphere_cls, time):
+        time.time.return_value = 1000
+        self.pool.set_max_sessions(1)
+        vsphere_cls.side_effect = [mock.Mock(**{'connect.side_effect':
+                                                IOError()}),
+                                   mock.Mock()]
+        self.assertRaises(IOError, self.pool.acquire, VC_INFO)
+        self.assertIsNotNone(self.pool.acquire(VC_INFO))
+
+
+if __name__ == '__main__':
+    unittest.main()